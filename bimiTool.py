@@ -16,30 +16,131 @@
 #    You should have received a copy of the GNU General Public License        #
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.    #
 # ----------------------------------------------------------------------------#
-import sys, datetime, logging, argparse, subprocess
+import os, sys, time, atexit, datetime, logging, argparse, subprocess
+_start_time = time.time() ##< Before the imports, start of --startup-profile
 from urllib import quote
 from bimibase import BimiBase
+from bimiimport import BimiImport
+from bimimail import BimiMail
+from bimipool import BimiPool
+from bimistats import BimiStats
+from bimibackup import BimiBackup
+from bimireport import BimiReport
+from bimiexport import BimiExport
 from bimiconfig import BimiConfig
 
 try:
-    from gi.repository import Gtk, Pango
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+try:
+    from gi.repository import Gtk, Gdk, GLib, GObject, Pango
 except ImportError:
     print("--------------------------------------------------------------------------")
     print("| Check your python GTK+3 setup! (Debian/Ubuntu: install gir1.2-gtk-3.0) |")
     print("--------------------------------------------------------------------------")
     sys.exit(1)
+_imported_time = time.time()
+_stats = None ##< BimiStats recording the statements of all data base connections, see --stats
+
+
+## Returns the paths of the data bases of all floors, db_paths or only db_path
+def floorPaths():
+    settings = BimiConfig.settings()
+    return list(settings.db_paths or [settings.db_path])
+
+
+## Opens a data base with the connection settings from the config
+#
+#  \param read_only \b Bool, if True the data base is opened without taking the write lock
+#  \param record    \b Bool, if False the statements aren't recorded in _stats
+#  \param path      \b String containing the path of the data base, None for db_path
+#  \return          \b BimiBase
+#
+def openDataBase(read_only=False, record=True, path=None):
+    settings = BimiConfig.settings()
+    return BimiBase( settings.db_path if path is None else path,
+                     read_only=read_only,
+                     journal_mode=settings.db_journal_mode,
+                     synchronous=settings.db_synchronous,
+                     busy_timeout=settings.db_busy_timeout,
+                     cache_size=settings.db_cache_size,
+                     mmap_size=settings.db_mmap_size,
+                     stats=_stats if record else None )
+
+
+## Prints the statement statistics and query plans requested by --stats and --explain-queries
+#
+#  Registered with atexit, so it also runs after the command line options
+#  which exit without starting the GUI.
+#
+def printStats(show_stats, explain):
+    if show_stats:
+        print(_stats.report())
+    if explain:
+        try:
+            print(_stats.explain(openDataBase(read_only=True, record=False)))
+        except (IOError, SystemExit) as err:
+            logging.getLogger('BimiTool').error('Explaining the queries failed! [err: %s]', err)
 
 
-class BiMiTool:
+## Collects the end times of the start up phases for --startup-profile
+#
+#  The data base is opened by the worker thread while the main window is
+#  built, so phases can overlap. They are printed ordered by their end.
+#
+class StartupProfile:
     def __init__(self):
+        self.marks = [('imports', _imported_time)] ##< List of tuples (phase, end time)
+        self.reported = False
+
+
+    ## Records the end of phase
+    def mark(self, phase):
+        self.marks.append( (phase, time.time()) )
+
+
+    ## Prints all phases once the first frame is drawn and the accounts are loaded
+    def report(self):
+        phases = [phase for phase, end in self.marks]
+        if self.reported or 'first frame' not in phases or 'accounts loaded' not in phases:
+            return
+        self.reported = True
+        print('{0:<20} {1:>10} {2:>10}'.format('phase', 'ms', 'total ms'))
+        last = _start_time
+        for phase, end in sorted(self.marks, key=lambda mark: mark[1]):
+            print('{0:<20} {1:>10.1f} {2:>10.1f}'.format(phase, (end - last)*1000, (end - _start_time)*1000))
+            last = end
+
+
+class BiMiTool:
+    ## Builds the main window, the data base is opened in the background
+    #
+    #  \param profile \b StartupProfile recording the start up phases or None
+    #
+    def __init__(self, profile=None):
         self.account_window = None            ##< The most recent popup window to add/edit accounts
         self.drink_window = None              ##< The most recent popup window to add/edit drinks
         self.mail_window = None               ##< The most recent popup window to get the mail text
         self.edit_acc_infos = []              ##< Stores [account_id, name] while edit_account window is open
         self.edit_drink_infos = []            ##< Stores row from drinks_list while edit_drink window is open
         self.event_pos = []                   ##< [x,y] pos from event object that activated the last context menu popup
-        self.transactions = []                ##< Contains all informations and transactions from one account
+        self.transactions_aid = None          ##< Account id of the transactions shown in transactions_view
+        self.transactions_before = None       ##< Last tid loaded into transactions_list, None if all are loaded
+        self.transactions_page_size = 50      ##< Number of transactions loaded at once into transactions_list
         self.drinks_comboxes_spinbuttons = [] ##< Contains tuples (combobox,spinbutton)
+        self.accounts_generation = None       ##< BimiBase.generation() when accounts_list was loaded
+        self.drinks_generation = None         ##< BimiBase.generation() when drinks_list was loaded
+        self.mail_queue = []                  ##< Credit mails waiting to be opened together, see queueCreditMail()
+        self.mail_queue_timeout = None        ##< GLib source id of the timeout calling sendMailQueue()
+        self.failed = False                   ##< True if the data base couldn't be opened
+        self.profile = profile                ##< StartupProfile or None
+        self.ui_objects = {}                  ##< Maps ids of toplevel objects in gui_path to their xml
+        self.drinks_view_ready = False        ##< True once the columns of drinks_view have been created
+        self.backup = None                    ##< BimiBackup started last by backupIfDue(), or None
+        self.backups_started = {}             ##< Maps data base paths to time.time() when their last backup was started
+        self.floors_combobox = None           ##< Gtk.ComboBoxText to switch between floors, None if there is only one
         self.transactions_list = Gtk.ListStore(int, str, str)
         self.accounts_list = Gtk.ListStore(int, str)
         ## \var self.drinks_list for each float a str for visualisation
@@ -48,15 +149,25 @@ class BiMiTool:
 
         self._logger = logging.getLogger('BiMiTool')
 
-        # Create DataBase-object
-        self.db = BimiBase( BimiConfig.option('db_path') )
+        # All data base requests run in the worker thread of the current floor, which opens its data base
+        def openFloorDataBase(path):
+            return openDataBase(path=path)
+        def openProfiledDataBase(path):
+            db = openDataBase(path=path)
+            self.profile.mark('data base opened')
+            return db
+        self.pool = BimiPool(floorPaths(), openFloorDataBase if profile is None else openProfiledDataBase,
+                             GLib.idle_add, self.setBusy, self.dataBaseFailed)
+        self.worker = self.pool.worker(BimiConfig.settings().db_path)
 
         # Load main window from GtkBuilder file
+        self.loadUiDefinition()
+        self.markStartup('ui definition read')
         self.gui = Gtk.Builder()
         widgets = ['main_window', 'image1', 'image2', 'image3', 'image1',
                    'drinks_menu', 'accounts_menu', 'transactions_menu',
                    'adjustment7', 'adjustment8', 'adjustment9', 'adjustment10']
-        self.gui.add_objects_from_file( BimiConfig.option('gui_path'), widgets )
+        self.addObjects(widgets)
         try:
             # Create our dictionay and connect it
             dic = {'consume_clicked': self.consumeDrinks,
@@ -78,16 +189,26 @@ class BiMiTool:
 
                    'generate_mail': self.showSummaryMail,
                    #"preferences_activate": self.prefsPopup,
-                   'main_window_destroyed': Gtk.main_quit,
-                   'quit_activate' : Gtk.main_quit}
+                   'main_window_destroyed': self.quit,
+                   'quit_activate' : self.quit}
             self.gui.connect_signals(dic)
         except:
-            self._logger.critical('Autoconnection of widgets failed! Check if %s exists.', BimiConfig.option('gui_path'))
+            self._logger.critical('Autoconnection of widgets failed! Check if %s exists.', BimiConfig.settings().gui_path)
             sys.exit(1)
         self.main_window = self.gui.get_object('main_window')
         self.accounts_context_menu = self.gui.get_object('accounts_menu')
         self.drinks_context_menu = self.gui.get_object('drinks_menu')
         self.transactions_context_menu = self.gui.get_object('transactions_menu')
+        if len(self.pool.paths) > 1:
+            self.floors_combobox = Gtk.ComboBoxText()
+            for path in self.pool.paths:
+                self.floors_combobox.append_text(self.pool.name(path))
+            self.floors_combobox.set_active(self.pool.paths.index(BimiConfig.settings().db_path))
+            self.floors_combobox.connect('changed', self.floorSwitched)
+            box = self.gui.get_object('box1')
+            box.pack_start(self.floors_combobox, False, False, 0)
+            box.reorder_child(self.floors_combobox, 1)
+        self.markStartup('main window built')
 
         # Create column-headers and add accounts from database into rows
         self.accounts_view = self.gui.get_object("accounts_view")
@@ -96,16 +217,8 @@ class BiMiTool:
         self.accounts_view.append_column(self.accounts_name_col)
         self.updateAccountsView()
 
-        # Create column headers for drinks_view
+        # Columns of drinks_view are created when its tab is shown for the first time
         self.drinks_view = self.gui.get_object("drinks_view")
-        self.drinks_view.set_model(self.drinks_list)
-        col_names = ['Name', 'Sales Price', 'Purchase Price', 'Deposit', 'Full Bottles', 'Empty Bottles', 'Kings']
-        render_cols = [1,3,5,7,8,9,10]
-        for i in range(len(col_names)):
-            renderer = Gtk.CellRendererText()
-            renderer.set_alignment(1.0,0.5)
-            drinks_view_col = Gtk.TreeViewColumn(col_names[i], renderer, text=render_cols[i])
-            self.drinks_view.append_column(drinks_view_col)
 
         # Create column headers for transactions_view
         self.transactions_view = self.gui.get_object('transactions_view')
@@ -116,10 +229,14 @@ class BiMiTool:
             renderer.set_alignment(1.0,0.5)
             trans_view_col = Gtk.TreeViewColumn(col_names[i], renderer, text=i+1)
             self.transactions_view.append_column(trans_view_col)
+        # Load older transactions when scrolled to the end or if the view isn't filled
+        trans_vadjustment = self.gui.get_object('scrolledwindow1').get_vadjustment()
+        trans_vadjustment.connect('value-changed', self.transactionsScrolled)
+        trans_vadjustment.connect('changed', self.transactionsScrolled)
 
         # Set up and add text from database to comboboxes and spinbuttons
         grid = self.gui.get_object('drinks_grid')
-        num = BimiConfig.option('num_comboboxes')
+        num = BimiConfig.settings().num_comboboxes
         for i in range(num):
             cbox = Gtk.ComboBox.new_with_model(self.drinks_list)
             cbox.set_hexpand(True)
@@ -141,9 +258,28 @@ class BiMiTool:
         grid.child_set_property(self.gui.get_object('scrolledwindow1'), 'top-attach', num+2)
         self.updateDrinksList()
 
+        # Pick up changes of other BimiTool instances using the same data base
+        GLib.timeout_add_seconds(2, self.pollDataBase)
+        if BimiConfig.settings().config_hot_reload:
+            GLib.timeout_add_seconds(2, self.pollConfig)
+        if BimiConfig.settings().backup_dir is not None:
+            GLib.timeout_add_seconds(60, self.backupIfDue)
+
+        self.markStartup('views set up')
+        if self.profile is not None:
+            self.first_frame_handler = self.main_window.connect('draw', self.mainWindowDrawn)
         self.main_window.show_all()
 
 
+    ## Shows the accounts loaded by loadAccounts()
+    def accountsLoaded(self, result):
+        if result is None:
+            return
+        self.accounts_generation, accounts = result
+        self.syncListStore(self.accounts_list, accounts)
+        self.markStartup('accounts loaded')
+
+
     ## Called if mouse button is pressed in self.accounts_view
     #
     #  Checks for right mouse click and opens context menu
@@ -176,23 +312,83 @@ class BiMiTool:
         credit = int(round(100*self.gui.get_object('edit_acc_spinbutton').get_value()))
         if self.edit_acc_infos:
             if acc_name != self.edit_acc_infos[1]:
-                self.db.setAccountName(self.edit_acc_infos[0], acc_name)
+                self.worker.submit(BimiBase.setAccountName, [self.edit_acc_infos[0], acc_name])
             if credit != 0:
-                self.db.addCredit(self.edit_acc_infos[0],credit)
-                self.showCreditMail(acc_name, credit/100.0)
+                self.worker.submit(BimiBase.addCredit, [self.edit_acc_infos[0], credit])
+                self.queueCreditMail(acc_name, credit/100.0)
         else:
-            self.db.addAccount(acc_name, credit)
+            self.worker.submit(BimiBase.addAccount, [acc_name, credit])
         self.updateAccountsView()
         #TODO: reselect account after adding credit or select account after adding it
         self.account_window.destroy()
 
 
+    ## Adds objects from the UI definition in gui_path to self.gui
+    #
+    #  Only the requested toplevel objects are passed to GtkBuilder, so the
+    #  rest of the file isn't parsed again whenever a dialog is opened.
+    #
+    #  \param object_ids \b List of ids of toplevel objects, unknown ids are ignored
+    #
+    def addObjects(self, object_ids):
+        objects = [self.ui_objects[object_id] for object_id in object_ids if object_id in self.ui_objects]
+        self.gui.add_objects_from_string('<interface>' + ''.join(objects) + '</interface>', object_ids)
+
+
+    ## Appends one row per transaction to transactions_list
+    #
+    #  The opening balances of BimiBase.closePeriod() are dated before the
+    #  cutoff and can't be undone, their rows get the tid -1 like the
+    #  deposit and balance rows.
+    #
+    #  \param transactions  \b List of ntuples from BimiBase.transactionTotals()
+    #  \param closed_before \b String 'YYYY-MM' from BimiBase.closedBefore() or None
+    #
+    def appendTransactions(self, transactions, closed_before):
+        cur_symbol = BimiConfig.settings().currency
+        for tid, date, total in transactions:
+            if closed_before is not None and date.strftime('%Y-%m') < closed_before:
+                tid = -1
+            self.transactions_list.append( [tid, str(date.date()), str(total/100.0) + cur_symbol] )
+
+        # Fewer transactions than requested means there are no older ones
+        if len(transactions) < self.transactions_page_size:
+            self.transactions_before = None
+        else:
+            self.transactions_before = transactions[-1][0]
+
+
+    ## Starts a backup in the background if the newest one of a floor is older than backup_interval minutes
+    #
+    #  Called periodically, returns True to keep the timeout alive. Only one
+    #  backup runs at a time, the backups of the floors are named after the
+    #  floors. After a failed backup the next one of that floor is tried
+    #  backup_interval minutes later.
+    #
+    def backupIfDue(self):
+        settings = BimiConfig.settings()
+        if settings.backup_dir is None or not settings.backup_interval:
+            return True
+        if self.backup is not None and self.backup.is_alive():
+            return True
+        for path in self.pool.paths:
+            started = self.backups_started.get(path)
+            if started is not None and time.time() - started < settings.backup_interval*60:
+                continue
+            if BimiBackup.due(path, settings.backup_dir, settings.backup_interval, self.pool.name(path)):
+                self.backup = BimiBackup(path, settings.backup_dir, settings.backup_keep, label=self.pool.name(path))
+                self.backups_started[path] = time.time()
+                self.backup.start()
+                break
+        return True
+
+
     ## Builds the account window and connects signals
     #
     #  Drops following after being called for the second time 0_o
     #  Gtk-CRITICAL **: gtk_spin_button_get_adjustment: assertion `GTK_IS_SPIN_BUTTON (spin_button)' failed
     def buildAccountWindow(self):
-        self.gui.add_objects_from_file( BimiConfig.option('gui_path'), ['account_window', 'adjustment1'] )
+        self.addObjects(['account_window', 'adjustment1'])
         self.account_window = self.gui.get_object('account_window')
         self.gui.connect_signals({'account_window_cancel': self.accountWindowCancel,
                                   'account_window_save': self.accountWindowSave,
@@ -203,8 +399,7 @@ class BiMiTool:
     #
     #  No problems with gtk_spin_button_get_adjustment here, stupid gtk >_<
     def buildDrinkWindow(self):
-        widgets = ['drink_window', 'adjustment2', 'adjustment3', 'adjustment4', 'adjustment5', 'adjustment6']
-        self.gui.add_objects_from_file( BimiConfig.option('gui_path'), widgets )
+        self.addObjects(['drink_window', 'adjustment2', 'adjustment3', 'adjustment4', 'adjustment5', 'adjustment6'])
         self.drink_window = self.gui.get_object('drink_window')
         self.gui.connect_signals({'drink_window_cancel': self.drinkWindowCancel,
                                   'drink_window_save': self.drinkWindowSave,
@@ -212,7 +407,7 @@ class BiMiTool:
 
 
     def buildMailWindow(self):
-        self.gui.add_objects_from_file( BimiConfig.option('gui_path'), ['mail_window', 'mail_buffer'] )
+        self.addObjects(['mail_window', 'mail_buffer'])
         self.mail_window = self.gui.get_object('mail_window')
         self.gui.connect_signals({'mail_window_destroyed': self.mailWindowDestroyed})
         text_view =  self.gui.get_object('mail_view')
@@ -234,7 +429,7 @@ class BiMiTool:
             if row_num != -1 and amount > 0:
                 dids_amounts.append( (self.drinks_list[(row_num,0)][0], amount) )
 
-        self.db.consumeDrinks( lstore.get_value(it, 0), dids_amounts )
+        self.worker.submit(BimiBase.consumeDrinks, [lstore.get_value(it, 0), dids_amounts])
 
         # Reset Spinbuttons
         for item in self.drinks_comboxes_spinbuttons:
@@ -243,24 +438,48 @@ class BiMiTool:
         self.updateTransactionsView(self.accounts_view)
 
 
+    ## Quits if a worker couldn't open the data base of its floor
+    def dataBaseFailed(self, path):
+        self.failed = True
+        self.quit(None)
+
+
     def deleteAccount(self, widget):
         row_num = self.accounts_view.get_path_at_pos(self.event_pos[0], self.event_pos[1])[0]
-        self.db.delAccount( self.accounts_list[(row_num,0)][0] )
+        self.worker.submit(BimiBase.delAccount, [self.accounts_list[(row_num,0)][0]])
         self.updateAccountsView()
 
 
     def deleteDrink(self, widget):
         row_num = self.drinks_view.get_path_at_pos(self.event_pos[0], self.event_pos[1])[0]
-        self.db.delDrink( self.drinks_list[(row_num,0)][0] )
+        self.worker.submit(BimiBase.delDrink, [self.drinks_list[(row_num,0)][0]])
         self.updateDrinksList()
 
 
     def undoTransaction(self, widget):
         row_num = self.transactions_view.get_path_at_pos(self.event_pos[0], self.event_pos[1])[0]
-        self.db.undoTransaction( self.transactions_list[(row_num,0)][0] )
+        self.worker.submit(BimiBase.undoTransaction, [self.transactions_list[(row_num,0)][0]])
         self.updateTransactionsView(self.accounts_view)
 
 
+    ## Shows the drinks loaded by loadDrinks()
+    def drinksLoaded(self, result):
+        if result is None:
+            return
+        self.drinks_generation, drinks = result
+        cur_symbol = BimiConfig.settings().currency
+        rows = []
+        for item in drinks:
+            rows.append( [item[0], item[1],\
+                          item[2]/100.0, str(item[2]/100.0) + cur_symbol,\
+                          item[3]/100.0, str(item[3]/100.0) + cur_symbol,\
+                          item[4]/100.0, str(item[4]/100.0) + cur_symbol,\
+                          item[5], item[6], item[7],\
+                          item[1] + ' @ ' + str(item[2]/100.0) + cur_symbol] )
+        self.syncListStore(self.drinks_list, rows)
+        self.updateDrinksComboBoxes()
+
+
     def drinksViewClicked(self, widget, event):
         if (event.button == 3):
             self.event_pos = (event.x,event.y)
@@ -293,13 +512,45 @@ class BiMiTool:
         values.append(True)
 
         if self.edit_drink_infos:
-            self.db.setDrink(self.edit_drink_infos[0], values)
+            self.worker.submit(BimiBase.setDrink, [self.edit_drink_infos[0], values])
         else:
-            self.db.addDrink(values)
+            self.worker.submit(BimiBase.addDrink, [values])
         self.drink_window.destroy()
         self.updateDrinksList()
 
 
+    ## Wraps a callback of the worker, so its result is dropped once another floor has been selected
+    def floorCallback(self, callback):
+        worker = self.worker
+        return lambda result: callback(result) if self.worker is worker else None
+
+
+    ## Shows the data base of the floor selected in floors_combobox
+    #
+    #  The worker of the previous floor keeps its data base open, so
+    #  switching back doesn't have to open it again. Open edit windows are
+    #  closed, as they refer to accounts or drinks of the previous floor.
+    #
+    def floorSwitched(self, widget):
+        path = self.pool.paths[widget.get_active()]
+        if path == BimiConfig.settings().db_path:
+            return
+        BimiConfig.setOption('db_path', path)
+        self.worker = self.pool.worker(path)
+        for window in [self.account_window, self.drink_window]:
+            if window is not None:
+                window.destroy()
+        self.accounts_generation = None
+        self.drinks_generation = None
+        self.accounts_list.clear()
+        self.drinks_list.clear()
+        self.transactions_list.clear()
+        self.transactions_aid = None
+        self.transactions_before = None
+        self.updateAccountsView()
+        self.updateDrinksList()
+
+
     ## Generates mail text from credit_mail option and database
     #
     #  \param account_name \b String containing the name of the account which recived the credit
@@ -307,80 +558,97 @@ class BiMiTool:
     #  \return             \b Dictionary containing the 'body' and 'subject' strings of the credit mail
     #
     def generateCreditMail(self, account_name, credit):
-        mail_body = BimiConfig.option('credit_mail_text').replace('$amount', str(credit) + BimiConfig.option('currency'))\
-                                                         .replace('$name', account_name)
-        mail_subj = BimiConfig.option('credit_mail_subject').replace('$amount', str(credit) + BimiConfig.option('currency'))
-        return {'body': mail_body, 'subject': mail_subj}
-
-
-    ## Generates mail text from summary_mail option and database
-    #
-    #  \return \b Dictionary containing the 'body' and 'subject' strings of the summary mail
-    #
-    def generateSummaryMail(self):
-        mail_string = BimiConfig.option('summary_mail_text').split('\n')
-        mail_body = ''
-        for i,line in enumerate(mail_string):
-            # substitute $kings in file with the kings information
-            if line.find('$kings:') != -1:
-                parts = list(line.partition('$kings:'))
-                acc_drink_quaffed = self.db.kings()
-
-                # Check if there are kings
-                if acc_drink_quaffed:
-                    len_acc = max(map(lambda x: len(x[0]), acc_drink_quaffed))
-                    len_drink = max(map(lambda x: len(x[1]), acc_drink_quaffed))
-                    len_quaffed = max(map(lambda x: len(str(x[2])), acc_drink_quaffed))
-                    parts[2] = parts[2].replace('$name', '{name:<'+str(len_acc)+'}', 1)
-                    parts[2] = parts[2].replace('$drink', '{drink:<'+str(len_drink)+'}', 1)
-                    parts[2] = parts[2].replace('$amount', '{amount:>'+str(len_quaffed)+'}', 1)
-
-                    for item in acc_drink_quaffed:
-                        try:
-                            insert = unicode(parts[0]) + unicode(parts[2]).format(name=item[0], drink=item[1], amount=item[2])
-                        except StandardError as err:
-                            self._logger.error("Line %s in file %s is not as expected! [err: %s]", str(i+1), BimiConfig.option('mail_path'), err)
-                            return
-                        mail_body += insert + '\n'
-                else:
-                    mail_body += '{}The Rabble is delighted, there are no Kings and Queens!'.format(parts[0]) + '\n'
-
-            # substitute $accInfos in file with the account informations
-            elif line.find('$accInfos:') != -1:
-                cur_symbol = BimiConfig.option('currency')
-                parts = list(line.partition('$accInfos:'))
-
-                accnames_balances = []
-                for aid, name in self.db.accounts():
-                    balance = sum(map( lambda x: x[2]*x[3], self.db.transactions(aid) )) / 100.0 - BimiConfig.option('deposit')
-                    accnames_balances.append( (name, balance) )
-
-                # Check if there are accounts in DB
-                if accnames_balances:
-                    len_acc = max(map(lambda x: len(x[0]), accnames_balances))
-                    len_balance = max(map(lambda x: len(str(int(x[1]))), accnames_balances)) + 3 # +3 because .00
-                    parts[2] = parts[2].replace('$name', '{name:<'+str(len_acc)+'}', 1)
-                    parts[2] = parts[2].replace('$balance', '{balance:>'+str(len_balance)+'.2f}'+cur_symbol, 1)
-
-                    for item in accnames_balances:
-                        try:
-                            insert = parts[0] + parts[2].format(name=item[0], balance=item[1])
-                        except StandardError as err:
-                            self._logger.error("'$accInfos:' line in %s file is broken! [err: %s]", BimiConfig.option('mail_path'), err)
-                            return
-                        mail_body += insert + '\n'
-                else:
-                    mail_body += '{}No one lives in BimiTool-land ;_;'.format(parts[0]) + '\n'
-            else:
-                mail_body += line + '\n'
+        return BimiMail.credit(account_name, credit)
+
+
+    ## Returns the generation and the accounts, or None if generation is still current
+    #
+    #  Runs in the worker thread.
+    #
+    @staticmethod
+    def loadAccounts(db, generation):
+        new_generation = db.generation()
+        if new_generation == generation:
+            return None
+        return (new_generation, db.accounts())
+
+
+    ## Returns the generation and the drinks, or None if generation is still current
+    #
+    #  Runs in the worker thread.
+    #
+    @staticmethod
+    def loadDrinks(db, generation):
+        new_generation = db.generation()
+        if new_generation == generation:
+            return None
+        return (new_generation, db.drinks())
+
+
+    ## Returns (account_id, before_tid, transactions, balance, closed_before) for transactionsLoaded()
+    #
+    #  Runs in the worker thread. The balance is only loaded for the first page.
+    #
+    @staticmethod
+    def loadTransactions(db, account_id, limit, before_tid):
+        transactions = db.transactionTotals(account_id, limit, before_tid)
+        balance = db.balance(account_id) if before_tid is None else None
+        return (account_id, before_tid, transactions, balance, db.closedBefore())
+
+
+    ## Reads gui_path once and splits it into its toplevel objects
+    def loadUiDefinition(self):
+        try:
+            root = ElementTree.parse(BimiConfig.settings().gui_path).getroot()
+        except (IOError, SyntaxError) as err:
+            self._logger.critical('Reading %s failed! [err: %s]', BimiConfig.settings().gui_path, err)
+            sys.exit(1)
+        for obj in root.findall('object'):
+            obj.tail = None
+            self.ui_objects[obj.get('id')] = ElementTree.tostring(obj)
+
+
+    ## Logs the output of a mail program started by openMailProgram()
+    #
+    #  Called by a GLib io watch on its stdout, returns False to remove the
+    #  watch once the output is closed.
+    #
+    def mailProgramOutput(self, source, condition, process, mail_program):
+        data = ''
+        if condition & GLib.IO_IN:
+            data = os.read(process.stdout.fileno(), 4096)
+        if data:
+            self._logger.debug("%s: %s", mail_program, data.rstrip())
+            return True
+        process.stdout.close()
+        GLib.timeout_add_seconds(1, self.reapMailProgram, process, mail_program)
+        return False
+
+
+    ## Called by the GLib timeout started in queueCreditMail()
+    def mailQueueTimedOut(self):
+        self.mail_queue_timeout = None
+        self.sendMailQueue()
+        return False
+
 
-        return {'subject': BimiConfig.option('summary_mail_subject'), 'body': mail_body}
+    ## Records the first frame for --startup-profile
+    def mainWindowDrawn(self, widget, cairo_context):
+        self.main_window.disconnect(self.first_frame_handler)
+        self.markStartup('first frame')
 
 
     def mailWindowDestroyed(self, widget, stuff=None):
         self.mail_window = None
 
 
+    ## Records the end of a start up phase if --startup-profile is given
+    def markStartup(self, phase):
+        if self.profile is not None and not self.profile.reported:
+            self.profile.mark(phase)
+            self.profile.report()
+
+
     ## Open mail program if option was selected
     #
     #  Before opening the mail program in compose mode the strings in
@@ -388,11 +656,16 @@ class BiMiTool:
     #  difference is the character encoding with utf-8, which is not
     #  allowed in RFC 2368 but thunderbird supports it.
     #
+    #  The program runs in the background, its output is read by
+    #  mailProgramOutput() from the GLib main loop.
+    #
     #  \param mailto_dict \b Dictionary containing 'to', 'body' and 'subject' strings
+    #  \param watch       \b Bool, if False the output of the program is discarded,
+    #                         e.g. if BimiTool is about to quit
     #  \return            \b String containing the program name or None
     #
-    def openMailProgram(self, mailto_dict):
-        mail_program = BimiConfig.option('mail_program')
+    def openMailProgram(self, mailto_dict, watch=True):
+        mail_program = BimiConfig.settings().mail_program
         # Build mailto url from dictionary
         if mail_program is not None:
             if 'to' in mailto_dict:
@@ -408,12 +681,46 @@ class BiMiTool:
 
         # Check which program to start
         if mail_program == 'icedove' or  mail_program == 'thunderbird':
-            process = subprocess.Popen([mail_program, "-compose", mailto_url], stdout=subprocess.PIPE)
-            if process.communicate()[0] != '':
-                self._logger.debug("%s: %s", mail_program, process.communicate()[0])
+            try:
+                if watch:
+                    process = subprocess.Popen([mail_program, "-compose", mailto_url],
+                                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                    GLib.io_add_watch(process.stdout, GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+                                      self.mailProgramOutput, process, mail_program)
+                else:
+                    with open(os.devnull, 'w') as devnull:
+                        subprocess.Popen([mail_program, "-compose", mailto_url], stdout=devnull, stderr=devnull)
+            except OSError as err:
+                self._logger.error("Starting %s failed! [os: %s]", mail_program, err)
         return mail_program
 
 
+    ## Reloads the config file if it was modified and updates all views
+    #
+    #  Called periodically if config_hot_reload is set, returns True to
+    #  keep the timeout alive. Changes of num_comboboxes and the data base
+    #  options need a restart.
+    #
+    def pollConfig(self):
+        if BimiConfig.reloadIfChanged():
+            self.accounts_generation = None
+            self.drinks_generation = None
+            self.updateAccountsView()
+            self.updateDrinksList()
+            self.updateTransactionsView(self.accounts_view)
+        return True
+
+
+    ## Reloads accounts_list and drinks_list if the data base has changed
+    #
+    #  Called periodically, returns True to keep the timeout alive.
+    #
+    def pollDataBase(self):
+        self.updateAccountsView()
+        self.updateDrinksList()
+        return True
+
+
     ## Opens account_window
     def popAddAccWindow(self, widget):
         if self.account_window is None:
@@ -473,14 +780,83 @@ class BiMiTool:
         self.drink_window.show()
 
 
-    ## Open mail program in compose mode with credit_mail data
+    ## Adds the credit mail to mail_queue
+    #
+    #  The queue is opened as one mail once no credit has been added for
+    #  credit_mail_delay seconds, or when BimiTool quits.
     #
     #  \param account_name \b String containig the name of the account holder
     #  \param credit       \b Float representing the amount of added credit
     #
-    def showCreditMail(self, account_name, credit):
-        mail_dict = self.generateCreditMail(account_name, credit)
-        self.openMailProgram(mail_dict)
+    def queueCreditMail(self, account_name, credit):
+        if BimiConfig.settings().mail_program is None:
+            return
+        self.mail_queue.append( self.generateCreditMail(account_name.decode('utf-8'), credit) )
+        if self.mail_queue_timeout is not None:
+            GLib.source_remove(self.mail_queue_timeout)
+            self.mail_queue_timeout = None
+        delay = BimiConfig.settings().credit_mail_delay
+        if not delay:
+            self.sendMailQueue()
+        else:
+            self.mail_queue_timeout = GLib.timeout_add_seconds(delay, self.mailQueueTimedOut)
+
+
+    ## Opens the queued credit mails, waits for the pending writes and quits the main loop
+    def quit(self, widget):
+        self.sendMailQueue(watch=False)
+        self.pool.stop()
+        Gtk.main_quit()
+
+
+    ## Reaps a mail program whose output has been closed
+    #
+    #  Called by a GLib timeout until the program has exited.
+    #
+    def reapMailProgram(self, process, mail_program):
+        if process.poll() is None:
+            return True
+        self._logger.debug("%s exited with %i", mail_program, process.returncode)
+        return False
+
+
+    ## Opens all mails in mail_queue as one mail in the mail program
+    #
+    #  \param watch \b Bool, passed on to openMailProgram()
+    #
+    def sendMailQueue(self, watch=True):
+        if self.mail_queue_timeout is not None:
+            GLib.source_remove(self.mail_queue_timeout)
+            self.mail_queue_timeout = None
+        if self.mail_queue:
+            self._logger.debug("Opening %i queued credit mails.", len(self.mail_queue))
+            self.openMailProgram(BimiMail.batch(self.mail_queue), watch)
+            self.mail_queue = []
+
+
+    ## Shows a busy cursor while the worker has requests to run
+    def setBusy(self, busy):
+        window = self.main_window.get_window()
+        if window is not None:
+            window.set_cursor(Gdk.Cursor(Gdk.CursorType.WATCH) if busy else None)
+
+
+    ## Creates the column headers of drinks_view
+    def setupDrinksView(self):
+        self.drinks_view.set_model(self.drinks_list)
+        col_names = ['Name', 'Sales Price', 'Purchase Price', 'Deposit', 'Full Bottles', 'Empty Bottles', 'Kings']
+        render_cols = [1,3,5,7,8,9,10]
+        for i in range(len(col_names)):
+            renderer = Gtk.CellRendererText()
+            renderer.set_alignment(1.0,0.5)
+            drinks_view_col = Gtk.TreeViewColumn(col_names[i], renderer, text=render_cols[i])
+            self.drinks_view.append_column(drinks_view_col)
+        self.drinks_view_ready = True
+
+
+    ## Generates the summary mail in the worker thread, see summaryMailGenerated()
+    def showSummaryMail(self, widget):
+        self.worker.submit(BimiMail.summary, [], self.summaryMailGenerated, key='summary_mail')
 
 
     ## Show summary mail in a gtk+ window or opens mail program
@@ -488,8 +864,7 @@ class BiMiTool:
     #  size_request of scrolledwindow and textview doesn't work properly,
     #  which results in a too small window. stupid gtk
     #
-    def showSummaryMail(self, widget):
-        mail_dict = self.generateSummaryMail()
+    def summaryMailGenerated(self, mail_dict):
         if self.openMailProgram(mail_dict) is None:
             if self.mail_window is None:
                 self.buildMailWindow()
@@ -501,79 +876,132 @@ class BiMiTool:
             self.mail_window.show_all()
 
 
+    ## Updates the rows of a Gtk.ListStore, touching only rows which changed
+    #
+    #  Rows are identified by the id in column 0. Rows with an unknown id are
+    #  removed, new ones inserted and changed ones overwritten in place, so
+    #  selections and widgets using the store aren't reset.
+    #
+    #  \param store \b Gtk.ListStore to be updated
+    #  \param rows  \b List of rows in the order they should appear in store
+    #
+    @staticmethod
+    def syncListStore(store, rows):
+        ids = set([row[0] for row in rows])
+        it = store.get_iter_first()
+        while it is not None:
+            if store[it][0] in ids:
+                it = store.iter_next(it)
+            elif not store.remove(it):
+                it = None
+
+        for pos, row in enumerate(rows):
+            if pos < len(store) and store[pos][0] == row[0]:
+                if list(store[pos]) != list(row):
+                    store[store.get_iter(pos)] = row
+                continue
+            # Row moved, e.g. after renaming, remove it from its old position
+            for old_pos in range(pos+1, len(store)):
+                if store[old_pos][0] == row[0]:
+                    store.remove(store.get_iter(old_pos))
+                    break
+            store.insert(pos, row)
+
+
     def tabSwitched(self, widget, tab_child, activated_tab):
         if activated_tab == 1:
+            if not self.drinks_view_ready:
+                self.setupDrinksView()
             self.updateDrinksList()
 
 
+    ## Shows the transactions loaded by loadTransactions()
+    #
+    #  Results for an account or page which isn't the current one anymore,
+    #  e.g. because the selection changed in the meantime, are dropped.
+    #
+    def transactionsLoaded(self, result):
+        account_id, before_tid, transactions, balance, closed_before = result
+        if before_tid is not None:
+            if account_id == self.transactions_aid and before_tid == self.transactions_before:
+                self.appendTransactions(transactions, closed_before)
+            return
+
+        lstore, it = self.accounts_view.get_selection().get_selected()
+        if it is None or lstore.get_value(it, 0) != account_id:
+            return
+        self.transactions_list.clear()
+        self.transactions_aid = None
+        self.transactions_before = None
+        if transactions:
+            settings = BimiConfig.settings()
+            cur_symbol = settings.currency
+            if 0.009 < settings.deposit:
+                self.transactions_list.append( [-1, 'Deposit', str(-settings.deposit) + cur_symbol] )
+            balance = balance / 100.0
+            self.transactions_list.append( [-1, 'Balance', str(balance - settings.deposit) + cur_symbol] )
+            self.transactions_aid = account_id
+            self.appendTransactions(transactions, closed_before)
+
+
+    ## Loads the next page of transactions if the end of transactions_view is visible
+    def transactionsScrolled(self, adjustment):
+        if self.transactions_aid is None or self.transactions_before is None:
+            return
+        if adjustment.get_value() + 1.5*adjustment.get_page_size() < adjustment.get_upper():
+            return
+        self.worker.submit(self.loadTransactions, [self.transactions_aid, self.transactions_page_size, self.transactions_before],
+                           self.floorCallback(self.transactionsLoaded), key='transactions_page')
+
+
     def transactionsViewClicked(self, widget, event):
         if (event.button == 3):
             self.event_pos = (event.x,event.y)
             if widget.get_path_at_pos(event.x,event.y) is not None:
                 row_num = self.transactions_view.get_path_at_pos(event.x, event.y)[0]
-                # Check if a transaction was clicked
+                # Check if a transaction which can be undone was clicked
                 if self.transactions_list[(row_num,0)][0] != -1:
                     self.gui.get_object('transactions_menu_delete').set_sensitive(True)
                     self.transactions_context_menu.popup(None, None, None, None, event.button, event.time)
 
 
     ## Loads accounts infos from database and updates accounts_list
+    #
+    #  Does nothing if the data base hasn't changed since the last update.
+    #
     def updateAccountsView(self):
-        self.accounts_list.clear()
-        db_account_list = self.db.accounts()
-        for item in db_account_list:
-            self.accounts_list.append(item)
+        self.worker.submit(self.loadAccounts, [self.accounts_generation], self.floorCallback(self.accountsLoaded),
+                           key='accounts')
 
 
     def updateDrinksComboBoxes(self):
-        # set active items for comboxes
+        # set active items for comboxes without a selected drink
         for i in range(len(self.drinks_comboxes_spinbuttons)):
-            if i < len(self.drinks_list):
+            if i < len(self.drinks_list) and self.drinks_comboxes_spinbuttons[i][0].get_active() == -1:
                 self.drinks_comboxes_spinbuttons[i][0].set_active(i)
 
 
     # Loads drink infos from database into drinks_list and updates
-    # widget dependent on drinks_list.
+    # widget dependent on drinks_list. Does nothing if the data base
+    # hasn't changed since the last update.
     def updateDrinksList(self):
-        self.drinks_list.clear()
-        cur_symbol = BimiConfig.option('currency')
-        for item in self.db.drinks():
-            self.drinks_list.append( [item[0], item[1],\
-                                      item[2]/100.0, str(item[2]/100.0) + cur_symbol,\
-                                      item[3]/100.0, str(item[3]/100.0) + cur_symbol,\
-                                      item[4]/100.0, str(item[4]/100.0) + cur_symbol,\
-                                      item[5], item[6], item[7],\
-                                      item[1] + ' @ ' + str(item[2]/100.0) + cur_symbol] )
-        self.updateDrinksComboBoxes()
+        self.worker.submit(self.loadDrinks, [self.drinks_generation], self.floorCallback(self.drinksLoaded), key='drinks')
 
 
+    ## Shows the balance and the newest transactions of the selected account
+    #
+    #  Older transactions are appended by transactionsScrolled() when the
+    #  end of transactions_view is reached.
+    #
     def updateTransactionsView(self, widget):
-        self.transactions_list.clear()
         lstore, it =  self.accounts_view.get_selection().get_selected()
         if it is None:
+            self.transactions_list.clear()
+            self.transactions_aid = None
+            self.transactions_before = None
             return
-        self.transactions = self.db.transactions( lstore.get_value(it, 0) )
-
-        if self.transactions:
-            # show only one row per transaction
-            cur_symbol = BimiConfig.option('currency')
-            total = 0.0
-            tid_date_value = [self.transactions[0][0], str(self.transactions[0][4].date()), 0.0]
-            for i,item in enumerate(self.transactions):
-                if tid_date_value[0] == item[0]:
-                    tid_date_value[2] += item[3]/100.0*item[2]
-                else:
-                    tid_date_value[2] = str(tid_date_value[2]) + cur_symbol
-                    self.transactions_list.append(tid_date_value)
-                    tid_date_value[0] = item[0]
-                    tid_date_value[1] = str(item[4].date())
-                    tid_date_value[2] = item[3]/100.0*item[2]
-                total += item[3]/100.0*item[2]
-            tid_date_value[2] = str(tid_date_value[2]) + cur_symbol
-            self.transactions_list.append(tid_date_value)
-            if 0.009 < BimiConfig.option('deposit'):
-                self.transactions_list.append( [-1, 'Deposit', str(-BimiConfig.option('deposit')) + cur_symbol] )
-            self.transactions_list.append( [-1, 'Balance', str(total - BimiConfig.option('deposit')) + cur_symbol] )
+        self.worker.submit(self.loadTransactions, [lstore.get_value(it, 0), self.transactions_page_size, None],
+                           self.floorCallback(self.transactionsLoaded), key='transactions')
 
 
 if __name__ == "__main__":
@@ -590,8 +1018,114 @@ if __name__ == "__main__":
                         type=str)
     parser.add_argument('--database',
                         default=None,
-                        help="specify path to a sqlite data-base file",
+                        help="specify paths to sqlite data-base files, one per floor. Reports, --summary and "
+                             "--backup cover all floors, the other options use the first one",
+                        metavar='FILE',
+                        nargs='+',
+                        type=str)
+    parser.add_argument('--rebuild-balances',
+                        action='store_true',
+                        default=False,
+                        dest='rebuild_balances',
+                        help="recalculate all account balances from the transactions and exit")
+    parser.add_argument('--startup-profile',
+                        action='store_true',
+                        default=False,
+                        dest='startup_profile',
+                        help="print the time needed by each phase until the main window is drawn")
+    parser.add_argument('--stats',
+                        action='store_true',
+                        default=False,
+                        help="print calls, latencies and rows of all data base statements at exit")
+    parser.add_argument('--explain-queries',
+                        action='store_true',
+                        default=False,
+                        dest='explain_queries',
+                        help="print the query plans of all data base statements executed, at exit")
+    parser.add_argument('--check',
+                        action='store_true',
+                        default=False,
+                        dest='check',
+                        help="compare kings, balances and stock with the transactions, print all mismatches and exit")
+    parser.add_argument('--repair',
+                        action='store_true',
+                        default=False,
+                        dest='repair',
+                        help="like --check, but also fix all mismatches")
+    parser.add_argument('--backup',
+                        nargs='?',
+                        const='',
+                        default=None,
+                        help="back up the data base into DIR, default is backup_dir from the config, "
+                             "delete the old backups and exit",
+                        metavar='DIR')
+    parser.add_argument('--close-period',
+                        default=None,
+                        dest='close_period',
+                        help="move all transactions before this month into the archive, keeping one "
+                             "opening balance per account, and exit",
+                        metavar='YYYY[-MM]')
+    parser.add_argument('--archive',
+                        default=None,
+                        help="archive file of --close-period, default is the data base path with suffix _archive",
+                        metavar='FILE',
+                        type=str)
+    parser.add_argument('--report',
+                        choices=sorted(BimiReport.reports.keys()),
+                        default=None,
+                        help="print a sales report and exit")
+    parser.add_argument('--period',
+                        choices=['month', 'year'],
+                        default='month',
+                        help="period the sales are summed up for by --report, default is month")
+    parser.add_argument('--from',
+                        default=None,
+                        dest='report_from',
+                        help="first period of --report",
+                        metavar='YYYY[-MM]')
+    parser.add_argument('--to',
+                        default=None,
+                        dest='report_to',
+                        help="last period of --report",
+                        metavar='YYYY[-MM]')
+    parser.add_argument('--csv',
+                        action='store_true',
+                        default=False,
+                        help="print --report as csv")
+    parser.add_argument('--summary',
+                        action='store_true',
+                        default=False,
+                        help="print the summary mail of all floors and exit")
+    parser.add_argument('--export',
+                        choices=sorted(BimiExport.tables.keys()),
+                        default=None,
+                        help="write all accounts, drinks or transactions to --output and exit")
+    parser.add_argument('--format',
+                        choices=BimiExport.formats,
+                        default='csv',
+                        help="file format of --export, default is csv")
+    parser.add_argument('--output',
+                        default=None,
+                        help="file --export writes to, default is stdout",
+                        metavar='FILE',
+                        type=str)
+    parser.add_argument('--import-tallies',
+                        default=None,
+                        dest='import_tallies',
+                        help="import a csv file with rows 'name,drink,count' and exit",
+                        metavar='FILE',
                         type=str)
+    parser.add_argument('--import-credits',
+                        default=None,
+                        dest='import_credits',
+                        help="import a csv file with rows 'name,credit' and exit",
+                        metavar='FILE',
+                        type=str)
+    parser.add_argument('--dry-run',
+                        action='store_true',
+                        default=False,
+                        dest='dry_run',
+                        help="check the import files but don't write anything")
     options = parser.parse_args()
 
     # Initialize logger
@@ -605,7 +1139,110 @@ if __name__ == "__main__":
     # Setup config
     BimiConfig.load(options.config)
     if options.database is not None:
-        BimiConfig.setOption('db_path', options.database)
+        BimiConfig.setOption('db_path', options.database[0])
+        BimiConfig.setOption('db_paths', options.database if len(options.database) > 1 else None)
+    elif BimiConfig.settings().db_paths and BimiConfig.settings().db_path not in BimiConfig.settings().db_paths:
+        BimiConfig.setOption('db_path', BimiConfig.settings().db_paths[0])
+    if options.stats or options.explain_queries or BimiConfig.settings().db_slow_query_ms is not None:
+        _stats = BimiStats(BimiConfig.settings().db_slow_query_ms, BimiConfig.settings().db_slow_query_log)
+        if options.stats or options.explain_queries:
+            atexit.register(printStats, options.stats, options.explain_queries)
+
+    if options.rebuild_balances:
+        openDataBase().rebuildBalances()
+        sys.exit(0)
+
+    if options.check or options.repair:
+        if not os.path.isfile(BimiConfig.settings().db_path):
+            print('No data base found @ {0}.'.format(BimiConfig.settings().db_path))
+            sys.exit(1)
+        # Not read-only, so a data base of an older version is upgraded before it's checked
+        mismatches = openDataBase().check(options.repair)
+        for table, key, stored, expected in mismatches:
+            print(u'{0} {1}: {2} instead of {3}'.format(table, key, stored, expected).encode('utf-8'))
+        print('{0} mismatches{1}.'.format(len(mismatches), ' repaired' if options.repair and mismatches else ''))
+        sys.exit(0 if options.repair or not mismatches else 2)
+
+    if options.backup is not None:
+        settings = BimiConfig.settings()
+        backup_dir = options.backup or settings.backup_dir
+        if not backup_dir:
+            print('No backup directory given, pass one or set backup_dir in the config.')
+            sys.exit(1)
+        failed = False
+        for path, name in zip(floorPaths(), BimiPool.floorNames(floorPaths())):
+            backup = BimiBackup(path, backup_dir, settings.backup_keep, label=name)
+            backup.run()
+            if backup.error is not None:
+                print('Backup of {0} failed: {1}'.format(path, backup.error))
+                failed = True
+            else:
+                print('Backed up {0} to {1}.'.format(path, backup.path))
+        sys.exit(1 if failed else 0)
+
+    if options.close_period is not None:
+        archive = options.archive
+        if archive is None:
+            root, ext = os.path.splitext(BimiConfig.settings().db_path)
+            archive = root + '_archive' + (ext or '.sqlite')
+        try:
+            num_archived = openDataBase().closePeriod(options.close_period, os.path.abspath(archive))
+        except ValueError as err:
+            print(err)
+            sys.exit(1)
+        print('Archived {0} transactions to {1}.'.format(num_archived, archive))
+        sys.exit(0)
 
-    bmt = BiMiTool()
+    if options.report is not None or options.summary:
+        # Several floors are read in parallel by the workers of a pool
+        pool = BimiPool(floorPaths(), lambda path: openDataBase(path=path)) if len(floorPaths()) > 1 else None
+        try:
+            if options.summary:
+                mail = BimiMail.floorSummary(pool) if pool is not None else BimiMail.summary(openDataBase())
+                print((mail['subject'] + u'\n\n' + mail['body']).encode('utf-8'))
+            else:
+                if pool is not None:
+                    rows = BimiReport.floorRows(pool, options.report, options.period, options.report_from,
+                                                options.report_to)
+                else:
+                    rows = BimiReport.rows(openDataBase(), options.report, options.period, options.report_from,
+                                           options.report_to)
+                BimiReport.write(sys.stdout, rows, options.csv)
+        except (ValueError, IOError) as err:
+            print(err)
+            sys.exit(1)
+        finally:
+            if pool is not None:
+                pool.stop()
+        sys.exit(0)
+
+    if options.export is not None:
+        output = sys.stdout if options.output is None else open(options.output, 'wb')
+        try:
+            BimiExport.write(openDataBase(read_only=True), options.export, output, options.format)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        sys.exit(0)
+
+    if options.import_tallies is not None or options.import_credits is not None:
+        importer = BimiImport( openDataBase() )
+        reports = []
+        if options.import_credits is not None:
+            reports.append( importer.credits(options.import_credits, options.dry_run) )
+        if options.import_tallies is not None:
+            reports.append( importer.tallies(options.import_tallies, options.dry_run) )
+        for report in reports:
+            print(BimiImport.formatReport(report).encode('utf-8'))
+        sys.exit(0 if sum([report['num_rejected'] for report in reports]) == 0 else 2)
+
+    # Needed by PyGObject < 3.10 to run the worker thread while Gtk.main() is running
+    if hasattr(GObject, 'threads_init'):
+        GObject.threads_init()
+    profile = None
+    if options.startup_profile:
+        profile = StartupProfile()
+        profile.mark('config')
+    bmt = BiMiTool(profile)
     Gtk.main()
+    sys.exit(1 if bmt.failed else 0)
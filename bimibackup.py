@@ -0,0 +1,262 @@
+# vim: set fileencoding=utf-8
+# ----------------------------------------------------------------------------#
+#    Copyright 2012 Julian Weitz                                              #
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    any later version.                                                       #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.    #
+# ----------------------------------------------------------------------------#
+import os, re, time, datetime, logging, threading
+from bimibase import sqlite3
+
+
+## Thread which copies the data base into a backup directory while it is in use
+#
+#  The copy is made in small steps with a short sleep in between, so the
+#  GUI stays responsive. If the sqlite3 module has the online backup API
+#  (Connection.backup), pages_per_step pages are copied per step and the
+#  data base is unlocked in between, i.e. writes continue. A write of
+#  another connection restarts the copy at the next step. Otherwise the
+#  tables are copied rows_per_step rows at a time in one read transaction,
+#  which writes don't disturb if the data base uses the journal mode wal.
+#  With other journal modes writes wait until the copy is done.
+#
+#  Every copy is checked with PRAGMA integrity_check before it replaces
+#  the .tmp file it's written to. Backups are named after the data base,
+#  or the label passed in, and the time they were made, only the keep
+#  newest ones are kept.
+#
+#  backup = BimiBackup(db_path, backup_dir)
+#  backup.start()              # or backup.run() to wait for it
+#  ...
+#  print(backup.path, backup.error)
+#
+class BimiBackup(threading.Thread):
+    _time_format = '%Y%m%d-%H%M%S' ##< Time in the names of the backups
+
+    ## Creates the thread, the backup is made by start() or run()
+    #
+    #  \param db_path        \b String containing the path of the data base
+    #  \param backup_dir     \b String containing the directory of the backups, created if it doesn't exist
+    #  \param keep           \b Integer number of backups kept, older ones are deleted. None keeps all.
+    #  \param pages_per_step \b Integer number of pages copied per step by the backup API
+    #  \param rows_per_step  \b Integer number of rows copied per step without the backup API
+    #  \param sleep          \b Float seconds to wait after every step
+    #  \param label          \b String the names of the backups start with, None for the name of
+    #                           the data base file without extension
+    #
+    def __init__(self, db_path, backup_dir, keep=7, pages_per_step=100, rows_per_step=5000, sleep=0.01, label=None):
+        self.label = label or self._stem(db_path) ##< Start of the names of the backups
+        threading.Thread.__init__(self, name='BimiBackup-' + self.label)
+        self.daemon = True
+        self._logger = logging.getLogger('BimiBackup')
+        self.db_path = db_path
+        self.backup_dir = backup_dir
+        self.keep = keep
+        self.pages_per_step = pages_per_step
+        self.rows_per_step = rows_per_step
+        self.sleep = sleep
+        self.path = None  ##< Path of the backup once it has been made
+        self.error = None ##< Exception if the backup failed
+
+
+    ## Makes the backup and deletes the old ones
+    #
+    #  Raises sqlite3.Error if copying fails or the copy is corrupt, IOError
+    #  if there is no data base at db_path, which sqlite3 would create, and
+    #  OSError or IOError if the files can't be written.
+    #
+    #  \return \b String containing the path of the backup
+    #
+    def backup(self):
+        if not os.path.isfile(self.db_path):
+            raise IOError('No data base found @ {0}, nothing to back up!'.format(self.db_path))
+        if not os.path.isdir(self.backup_dir):
+            os.makedirs(self.backup_dir)
+        for path in self.backups(self.db_path, self.backup_dir, '.tmp', self.label):
+            self._logger.info('Deleting unfinished backup %s.', path)
+            os.remove(path)
+
+        path = os.path.join(self.backup_dir, '{0}-{1}.sqlite'.format(self.label,
+                                                                     datetime.datetime.now().strftime(self._time_format)))
+        start = time.time()
+        source = sqlite3.connect(self.db_path)
+        try:
+            if hasattr(source, 'backup'):
+                self._copyPages(source, path + '.tmp')
+            else:
+                self._copyRows(source, path + '.tmp')
+        except:
+            if os.path.isfile(path + '.tmp'):
+                os.remove(path + '.tmp')
+            raise
+        finally:
+            source.close()
+
+        problems = self.verify(path + '.tmp')
+        if problems:
+            os.rename(path + '.tmp', path + '.corrupt')
+            raise sqlite3.DatabaseError('Backup {0} is corrupt: {1}'.format(path + '.corrupt', '; '.join(problems)))
+        os.rename(path + '.tmp', path)
+        self._logger.info('Backed up %s to %s in %.1fs.', self.db_path, path, time.time() - start)
+        self._rotate()
+        return path
+
+
+    ## Returns the backups of a data base, oldest first
+    #
+    #  \param db_path    \b String containing the path of the data base
+    #  \param backup_dir \b String containing the directory of the backups
+    #  \param suffix     \b String appended to the names, e.g. '.tmp' for unfinished backups
+    #  \param label      \b String the names of the backups start with, None for the name of the data base
+    #  \return           \b List of strings containing the paths
+    #
+    @staticmethod
+    def backups(db_path, backup_dir, suffix='', label=None):
+        if not os.path.isdir(backup_dir):
+            return []
+        label = label or BimiBackup._stem(db_path)
+        pattern = re.compile(re.escape(label) + r'-\d{8}-\d{6}\.sqlite' + re.escape(suffix) + '$')
+        return [os.path.join(backup_dir, name) for name in sorted(os.listdir(backup_dir)) if pattern.match(name)]
+
+
+    ## Copies the data base with the backup API
+    def _copyPages(self, source, path):
+        target = sqlite3.connect(path)
+        try:
+            source.backup(target, pages=self.pages_per_step, sleep=self.sleep)
+        finally:
+            target.close()
+
+
+    ## Copies the data base table by table, used if the backup API isn't available
+    #
+    #  The schema is created by a connection to the copy, then the rows are
+    #  copied by source with the copy attached, all in one read transaction
+    #  of source. Indexes are created at the end.
+    #
+    def _copyRows(self, source, path):
+        cur = source.cursor()
+        cur.execute("PRAGMA page_size")
+        page_size = cur.fetchone()[0]
+        cur.execute("SELECT type, name, sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'")
+        items = cur.fetchall()
+        tables = [name for type, name, sql in items if type == 'table']
+
+        target = sqlite3.connect(path)
+        try:
+            target.execute("PRAGMA page_size={0}".format(int(page_size)))
+            for type, name, sql in items:
+                if type == 'table':
+                    target.execute(sql)
+            target.commit()
+        finally:
+            target.close()
+
+        source.isolation_level = None
+        cur.execute("ATTACH DATABASE ? AS backup", [path])
+        try:
+            cur.execute("PRAGMA backup.journal_mode=OFF")
+            cur.execute("PRAGMA backup.synchronous=OFF")
+            cur.execute("BEGIN")
+            try:
+                for table in tables:
+                    last = None
+                    while True:
+                        cur.execute('SELECT MAX(rowid) FROM (SELECT rowid FROM main."{0}" \
+                                                              WHERE rowid>? ORDER BY rowid LIMIT ?)'.format(table),
+                                    [last if last is not None else -2**63, self.rows_per_step])
+                        upto = cur.fetchone()[0]
+                        if upto is None:
+                            break
+                        cur.execute('INSERT INTO backup."{0}" SELECT * FROM main."{0}" \
+                                      WHERE rowid>? AND rowid<=?'.format(table),
+                                    [last if last is not None else -2**63, upto])
+                        last = upto
+                        time.sleep(self.sleep)
+                cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE name='sqlite_sequence'")
+                if cur.fetchone()[0]:
+                    cur.execute("DELETE FROM backup.sqlite_sequence")
+                    cur.execute("INSERT INTO backup.sqlite_sequence SELECT * FROM main.sqlite_sequence")
+                cur.execute("COMMIT")
+            except:
+                cur.execute("ROLLBACK")
+                raise
+        finally:
+            cur.execute("DETACH DATABASE backup")
+
+        target = sqlite3.connect(path)
+        try:
+            for type, name, sql in items:
+                if type != 'table':
+                    target.execute(sql)
+            target.commit()
+        finally:
+            target.close()
+
+
+    ## Returns True if the newest backup is older than interval minutes or there is none
+    #
+    #  \param db_path    \b String containing the path of the data base
+    #  \param backup_dir \b String containing the directory of the backups
+    #  \param interval   \b Integer minutes between two backups
+    #  \param label      \b String the names of the backups start with, None for the name of the data base
+    #
+    @staticmethod
+    def due(db_path, backup_dir, interval, label=None):
+        backups = BimiBackup.backups(db_path, backup_dir, '', label)
+        if not backups:
+            return True
+        made = datetime.datetime.strptime(os.path.basename(backups[-1])[-22:-7], BimiBackup._time_format)
+        return datetime.datetime.now() - made >= datetime.timedelta(minutes=interval)
+
+
+    ## Deletes all but the keep newest backups
+    def _rotate(self):
+        if self.keep is None:
+            return
+        backups = self.backups(self.db_path, self.backup_dir, '', self.label)
+        for path in backups[:max(len(backups) - self.keep, 0)]:
+            self._logger.info('Deleting old backup %s.', path)
+            os.remove(path)
+
+
+    ## Makes the backup, errors are logged and stored in error
+    def run(self):
+        try:
+            self.path = self.backup()
+        except (sqlite3.Error, OSError, IOError) as err:
+            self.error = err
+            self._logger.error('Backing up %s to %s failed! [err: %s]', self.db_path, self.backup_dir, err)
+
+
+    ## Returns the name of the data base file without extension
+    @staticmethod
+    def _stem(db_path):
+        return os.path.splitext(os.path.basename(db_path))[0]
+
+
+    ## Checks a backup with PRAGMA integrity_check
+    #
+    #  \param path \b String containing the path of the backup
+    #  \return     \b List of strings describing the problems, empty if the backup is fine
+    #
+    @staticmethod
+    def verify(path):
+        connection = sqlite3.connect(path)
+        try:
+            rows = connection.execute("PRAGMA integrity_check").fetchall()
+        except sqlite3.Error as err:
+            return [str(err)]
+        finally:
+            connection.close()
+        return [] if rows == [('ok',)] else [row[0] for row in rows]
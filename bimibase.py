@@ -15,7 +15,10 @@
 #    You should have received a copy of the GNU General Public License        #
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.    #
 # ----------------------------------------------------------------------------#
-import os, sys, datetime, logging
+import os, re, sys, time, datetime, logging
+from functools import wraps
+from itertools import islice
+from contextlib import contextmanager
 
 try:
     from pysqlite2 import dbapi2 as sqlite3
@@ -26,6 +29,41 @@ except ImportError:
     sys.exit(1)
 
 
+## Decorator for BimiBase methods which write to the data base
+#
+#  If another process holds the lock longer than the busy timeout, the
+#  transaction is rolled back and the method is called again after an
+#  exponentially growing delay. Inside of a batch() the error is passed
+#  on, because only the whole batch can be repeated.
+#
+def _retryOnBusy(method):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        delay = 0.05
+        for attempt in range(self.busy_retries + 1):
+            try:
+                return method(self, *args, **kwargs)
+            except sqlite3.OperationalError as err:
+                if self._batch_depth > 0 or attempt == self.busy_retries or\
+                   ('locked' not in str(err) and 'busy' not in str(err)):
+                    raise
+                self.dbcon.rollback()
+                self._logger.warning('Data base is busy, retrying %s in %.2fs. [sqlite3: %s]', method.__name__, delay, err)
+                time.sleep(delay)
+                delay *= 2
+    return wrapper
+
+
+## Decorator for public BimiBase methods, records their calls if the BimiBase has a BimiStats
+def _recordStats(method):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.stats is None:
+            return method(self, *args, **kwargs)
+        return self.stats.call(method, [self] + list(args), kwargs)
+    return wrapper
+
+
 ## sqlite3 data base interface
 #
 #  accounts            stores account ids and names
@@ -42,26 +80,126 @@ except ImportError:
 #    bottles_empty     number of empte bottles
 #    deleted           true if drink was deleted but is used in table transacts
 #    kings             true if drink should be returned by DataBase::kings()
+#    pid               from table products
+#
+#  products            groups drinks with the same name, e.g. a drink and its
+#                      successor with a different price
+#    pid               unique product id
+#    name              name of the drinks
 #
 #  kings               stores information about how many drinks a user has consumed
 #    aid               from table accounts
 #    did               from table drinks
 #    quaffed           number of drinks consumed
 #
+#  leaderboard         stores the kings per product, derived from tables kings and drinks
+#    pid               from table products
+#    aid               from table accounts
+#    quaffed           sum of kings.quaffed of all drinks of the product
+#
+#  transheads          stores one row per transaction, allocates the transaction ids
+#    tid               unique transaction id, never reused
+#    aid               from table accounts
+#    date              date and time of transaction
+#
 #  transacts           stores all debit and credit informations. Primary key = tid+aid+did
-#    tid               transaction id
+#    tid               from table transheads
 #    aid               from table accounts
 #    did               from table drinks (0 for plain credit/debit transactions)
 #    count             value multiplyer i.e. number of drinks
 #    value             value of one drink or credit/debit added
 #    date              date and time of transaction
 #
+#  balances            stores the balance of every account, derived from table transacts
+#    aid               from table accounts
+#    balance           sum of count*value of all transactions of the account
+#
+#  report_cache        stores the rows of salesReport() for past periods listed in
+#                      report_periods, derived from tables transacts and drinks
+#    period            string 'YYYY' or 'YYYY-MM'
+#    grp               group of salesReport(), '' for no group
+#    key               pid for group drink, aid for group account, 0 for no group
+#    units             sum of count of the sales
+#    revenue           sum of count*sales price of the sales
+#    cost              sum of count*purchase price of the drinks when the row was stored
+#
+#  report_periods      stores the periods and groups which have been stored in report_cache
+#    grp               group of salesReport(), '' for no group
+#    period            string 'YYYY' or 'YYYY-MM'
+#
+#  closings            stores the periods moved to an archive by closePeriod()
+#    cutoff            string 'YYYY-MM', the transactions before this month are archived
+#    oldest            string 'YYYY-MM' of the oldest archived transaction
+#    archive           path of the archive data base
+#    first_tid         tid of the first opening balance transaction
+#    openings          number of opening balance transactions, their tids are consecutive
+#    transactions      number of archived transactions
+#    date              date and time of the closing
+#
+#  opening_kings       stores the quaffed drinks of the archived transactions
+#    aid               from table accounts
+#    did               from table drinks
+#    quaffed           number of drinks consumed before the last cutoff
+#
+#  schema_version      stores the versions of all migrations applied to the data base
+#    version           index of the migration in BimiBase._migrations plus one
+#
+#  Indexes: transacts(aid, tid), transacts(tid), transacts(date), transheads(aid, date),
+#           leaderboard(pid, quaffed) and a unique one on kings(aid, did)
+#
 class BimiBase:
-    def __init__(self, path):
+    ## Schema migrations, entry i upgrades the data base from version i to i+1
+    #
+    #  Every entry is the name of a method which gets called inside of a
+    #  write transaction. Append new migrations, never change old ones!
+    _migrations = ['_migrateCreateTables',
+                   '_migrateIndexes',
+                   '_migrateBalances',
+                   '_migrateTransheads',
+                   '_migrateLeaderboard',
+                   '_migrateReports',
+                   '_migrateClosings',
+                   '_migrateHistoryIndex']
+
+    _journal_modes = ['delete', 'truncate', 'persist', 'memory', 'wal', 'off']
+    _synchronous_levels = ['off', 'normal', 'full', 'extra']
+
+    ## Groups of salesReport(), mapped to the SQL of the key, the name and the join of the name
+    _report_groups = {None: ("0", "NULL", ""),
+                      'drink': ("d.pid", "p.name", "LEFT OUTER JOIN products AS p ON p.pid=r.key"),
+                      'account': ("t.aid", "a.name", "LEFT OUTER JOIN accounts AS a ON a.aid=r.key")}
+
+    ## Opens or creates the data base at path
+    #
+    #  All connection settings are optional, None keeps the SQLite default.
+    #
+    #  \param path         \b String containing the path of the data base file
+    #  \param read_only    \b Bool, if True the data base is neither created, upgraded
+    #                          nor written, i.e. the write lock is never taken
+    #  \param journal_mode \b String, one of _journal_modes. 'wal' lets readers and a
+    #                          writer work at the same time. Not usable on network file systems!
+    #  \param synchronous  \b String, one of _synchronous_levels
+    #  \param busy_timeout \b Integer milliseconds to wait for a lock held by another process
+    #  \param cache_size   \b Integer, pages if positive or KiB if negative
+    #  \param mmap_size    \b Integer bytes of the data base file accessed via mmap
+    #  \param busy_retries \b Integer number of retries of a write which timed out waiting for a lock
+    #  \param stats        \b BimiStats recording all statements, or None
+    #
+    def __init__(self, path, read_only=False, journal_mode=None, synchronous=None,
+                 busy_timeout=None, cache_size=None, mmap_size=None, busy_retries=5, stats=None):
         self._logger = logging.getLogger('BimiBase')
+        self._batch_depth = 0 ##< Number of nested batch() blocks, commits are deferred while > 0
+        self._commits = 0     ##< Number of commits of this connection, part of generation()
+        self.read_only = read_only
+        self.busy_retries = busy_retries
+        self.stats = stats
+
+        if read_only and not os.path.isfile(path):
+            self._logger.error('No data base found @ %s, not possible to open it read-only!', path)
+            raise IOError('No data base found @ {0}, not possible to open it read-only!'.format(path))
 
         # Check for database file and directory structure
-        if not os.path.isdir(os.path.dirname(path)):
+        if not read_only and not os.path.isdir(os.path.dirname(path)):
             try:
                 os.makedirs(os.path.dirname(path))
             except OSError as oe:
@@ -70,54 +208,640 @@ class BimiBase:
                 raise OSError('Not possible to create directory %s! No database available! [os: %s]',\
                                os.path.dirname(path), oe)
 
-        self.dbcon = sqlite3.connect(path,detect_types=sqlite3.PARSE_DECLTYPES)
+        if busy_timeout is None:
+            self.dbcon = sqlite3.connect(path,detect_types=sqlite3.PARSE_DECLTYPES)
+        else:
+            self.dbcon = sqlite3.connect(path,detect_types=sqlite3.PARSE_DECLTYPES,timeout=busy_timeout/1000.0)
+        if stats is not None:
+            self.dbcon = stats.connection(self.dbcon)
         self.cur = self.dbcon.cursor()
+        self._setup(journal_mode, synchronous, cache_size, mmap_size)
+
+        if read_only:
+            self._checkVersion()
+            self._logger.info('Opened data base read-only @ ' + path)
+            return
+
+        # Create a new data base or upgrade an existing one to the current schema
+        self.cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='accounts'")
+        if self.cur.fetchone()[0] == 0:
+            self._logger.info('Creating new data base @ ' + path)
+        else:
+            self._logger.info('Found an existing data base @ ' + path)
+        self._migrate()
+        self._logger.info('Yay, database seems to be useable.')
+
 
-        # check if DB already exists, if not create one
+    ## Exits if the schema of a read-only data base isn't the current one
+    def _checkVersion(self):
         try:
-            self.cur.execute("CREATE TABLE accounts(aid INTEGER PRIMARY KEY,\
-                                                    name TEXT)")
-
-            self.cur.execute("CREATE TABLE drinks(did INTEGER PRIMARY KEY,\
-                                                  name TEXT,\
-                                                  sales_price INTEGER,\
-                                                  purchase_price INTEGER,\
-                                                  deposit INTEGER,\
-                                                  bottles_full INTEGER,\
-                                                  bottles_empty INTEGER,\
-                                                  deleted BOOL,\
-                                                  kings BOOL)")
-
-            self.cur.execute("CREATE TABLE kings(aid INTEGER,\
-                                                 did INTEGER,\
-                                                 quaffed INTEGER)")
-
-            self.cur.execute("CREATE TABLE transacts(tid INTEGER,\
-                                                     aid INTEGER,\
-                                                     did INTEGER,\
-                                                     count INTEGER,\
-                                                     value INTEGER,\
-                                                     date TIMESTAMP)")
+            self.cur.execute("SELECT MAX(version) FROM schema_version")
+            version = self.cur.fetchone()[0] or 0
+        except sqlite3.OperationalError:
+            version = 0
+        if version != len(self._migrations):
+            self._logger.critical('Data base schema is version %i instead of %i, open it once without read-only to upgrade it!',
+                                  version, len(self._migrations))
+            sys.exit(1)
+
+
+    ## Applies the connection settings, invalid values are logged and ignored
+    def _setup(self, journal_mode, synchronous, cache_size, mmap_size):
+        pragmas = []
+        if journal_mode is not None:
+            if str(journal_mode).lower() not in self._journal_modes:
+                self._logger.error('Unknown journal mode %s! Has to be one of %s.', journal_mode, ', '.join(self._journal_modes))
+            elif not self.read_only:
+                pragmas.append('journal_mode=' + str(journal_mode).lower())
+        if synchronous is not None:
+            if str(synchronous).lower() not in self._synchronous_levels:
+                self._logger.error('Unknown synchronous level %s! Has to be one of %s.', synchronous, ', '.join(self._synchronous_levels))
+            else:
+                pragmas.append('synchronous=' + str(synchronous).lower())
+        for name, value in [('cache_size', cache_size), ('mmap_size', mmap_size)]:
+            if value is not None:
+                try:
+                    pragmas.append('{0}={1}'.format(name, int(value)))
+                except ValueError:
+                    self._logger.error('%s has to be an integer, not %s!', name, value)
+        if self.read_only:
+            pragmas.append('query_only=1')
+
+        for pragma in pragmas:
+            self.cur.execute("PRAGMA " + pragma)
+            self._logger.debug('PRAGMA %s', pragma)
+
+
+    ## Applies all migrations from _migrations the data base is missing
+    #
+    #  Every migration runs in its own transaction together with the update of
+    #  schema_version, i.e. a failing migration leaves the data base untouched.
+    #  The version is read again after the write lock has been acquired, so
+    #  two instances starting at the same time don't apply a migration twice.
+    #
+    def _migrate(self):
+        self.dbcon.isolation_level = None
+        try:
+            while True:
+                self.cur.execute("BEGIN IMMEDIATE")
+                try:
+                    self.cur.execute("CREATE TABLE IF NOT EXISTS schema_version(version INTEGER)")
+                    self.cur.execute("SELECT MAX(version) FROM schema_version")
+                    version = self.cur.fetchone()[0] or 0
+                    if version >= len(self._migrations):
+                        self.cur.execute("COMMIT")
+                        break
+                    self._logger.info('Upgrading data base schema from version %i to %i', version, version+1)
+                    getattr(self, self._migrations[version])()
+                    self.cur.execute("INSERT INTO schema_version VALUES(?)", [version+1])
+                    self.cur.execute("COMMIT")
+                except sqlite3.Error as err:
+                    self.cur.execute("ROLLBACK")
+                    self._logger.critical('Oh noes, upgrading data base failed! Data base corrupt? [sqlite3: %s]', str(err))
+                    sys.exit(1)
+        finally:
+            self.dbcon.isolation_level = ''
+
+        if version > len(self._migrations):
+            self._logger.critical('Data base was created by a newer version (schema %i > %i)! Update BimiTool.',
+                                  version, len(self._migrations))
+            sys.exit(1)
+
+
+    ## Commits the current transaction unless a batch() block is active
+    def _commit(self):
+        if self._batch_depth == 0:
             self.dbcon.commit()
-            self._logger.info('Created new data base @ ' + path)
+            self._commits += 1
 
-        except sqlite3.OperationalError:
-            self._logger.info('Found an existing data base @ ' + path)
-            try:
-                self.cur.execute("select aid,name from accounts")
-                self.cur.execute("select tid,aid,did,count,value,date from transacts")
-                self.cur.execute("select did,name,sales_price,purchase_price,deposit,bottles_full from drinks")
-                self.cur.execute("select aid,did,quaffed from kings")
-            except sqlite3.OperationalError as err:
-                self._logger.critical('Oh noes, data base corrupt or created by an older version! [sqlite3: %s]', str(err))
-                sys.exit(1)
-            self._logger.info('Yay, database seems to be useable.')
+
+    ## Migration 1: creates the initial tables
+    #
+    #  Data bases created by older versions without a schema_version table
+    #  already contain these tables. Missing drinks columns get added and
+    #  all columns are checked to be available.
+    #
+    def _migrateCreateTables(self):
+        self.cur.execute("CREATE TABLE IF NOT EXISTS accounts(aid INTEGER PRIMARY KEY,\
+                                                              name TEXT)")
+
+        self.cur.execute("CREATE TABLE IF NOT EXISTS drinks(did INTEGER PRIMARY KEY,\
+                                                            name TEXT,\
+                                                            sales_price INTEGER,\
+                                                            purchase_price INTEGER,\
+                                                            deposit INTEGER,\
+                                                            bottles_full INTEGER,\
+                                                            bottles_empty INTEGER,\
+                                                            deleted BOOL,\
+                                                            kings BOOL)")
+
+        self.cur.execute("CREATE TABLE IF NOT EXISTS kings(aid INTEGER,\
+                                                           did INTEGER,\
+                                                           quaffed INTEGER)")
+
+        self.cur.execute("CREATE TABLE IF NOT EXISTS transacts(tid INTEGER,\
+                                                               aid INTEGER,\
+                                                               did INTEGER,\
+                                                               count INTEGER,\
+                                                               value INTEGER,\
+                                                               date TIMESTAMP)")
+
+        # Columns which were added to table drinks after the first release
+        self.cur.execute("PRAGMA table_info(drinks)")
+        drink_cols = [item[1] for item in self.cur.fetchall()]
+        for col, decl in [('bottles_empty', 'INTEGER DEFAULT 0'),
+                          ('deleted', 'BOOL DEFAULT 0'),
+                          ('kings', 'BOOL DEFAULT 1')]:
+            if col not in drink_cols:
+                self._logger.info('Adding column %s to table drinks.', col)
+                self.cur.execute("ALTER TABLE drinks ADD COLUMN " + col + " " + decl)
+
+        # Raises OperationalError if a table isn't usable
+        self.cur.execute("SELECT aid,name FROM accounts LIMIT 0")
+        self.cur.execute("SELECT tid,aid,did,count,value,date FROM transacts LIMIT 0")
+        self.cur.execute("SELECT did,name,sales_price,purchase_price,deposit,bottles_full,bottles_empty,deleted,kings FROM drinks LIMIT 0")
+        self.cur.execute("SELECT aid,did,quaffed FROM kings LIMIT 0")
+
+
+    ## Migration 2: adds indexes to transacts and kings
+    #
+    #  Rows in kings with the same (aid, did) get merged before the unique
+    #  index is created.
+    #
+    def _migrateIndexes(self):
+        self.cur.execute("SELECT EXISTS(SELECT aid, did FROM kings GROUP BY aid, did HAVING COUNT(*) > 1)")
+        if self.cur.fetchone()[0]:
+            self._logger.info('Merging duplicate rows in table kings.')
+            self.cur.execute("CREATE TEMP TABLE kings_merged AS \
+                                   SELECT aid, did, SUM(quaffed) AS quaffed FROM kings GROUP BY aid, did")
+            self.cur.execute("DELETE FROM kings")
+            self.cur.execute("INSERT INTO kings SELECT aid, did, quaffed FROM kings_merged")
+            self.cur.execute("DROP TABLE kings_merged")
+        self.cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS kings_aid_did ON kings(aid, did)")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS transacts_aid_tid ON transacts(aid, tid)")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS transacts_tid ON transacts(tid)")
+
+
+    ## Migration 3: adds the balances table and fills it from transacts
+    def _migrateBalances(self):
+        self.cur.execute("CREATE TABLE IF NOT EXISTS balances(aid INTEGER PRIMARY KEY,\
+                                                              balance INTEGER)")
+        self._rebuildBalances()
+
+
+    ## Migration 4: adds the transheads table and fills it from transacts
+    #
+    #  Older versions allocated tids with MAX(tid)+1, so two instances could
+    #  use the same tid for different accounts. The rows of every account
+    #  but the first one of such a tid get a new tid.
+    #
+    def _migrateTransheads(self):
+        self.cur.execute("CREATE TABLE IF NOT EXISTS transheads(tid INTEGER PRIMARY KEY AUTOINCREMENT,\
+                                                                aid INTEGER,\
+                                                                date TIMESTAMP)")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS transheads_aid ON transheads(aid)")
+        self.cur.execute("INSERT INTO transheads \
+                               SELECT tid, MIN(aid), MIN(date) FROM transacts GROUP BY tid")
+        self.cur.execute("SELECT t.tid, t.aid, MIN(t.date) \
+                            FROM transacts AS t \
+                            JOIN transheads AS h \
+                              ON h.tid=t.tid \
+                           WHERE t.aid!=h.aid \
+                        GROUP BY t.tid, t.aid")
+        for tid, aid, date in self.cur.fetchall():
+            new_tid = self._newTransaction(aid, date)
+            self._logger.info('Moving transaction %i of account %i to tid %i.', tid, aid, new_tid)
+            self.cur.execute("UPDATE transacts SET tid=? WHERE tid=? AND aid=?", [new_tid, tid, aid])
+
+
+    ## Migration 5: groups drinks by name into products and adds the leaderboard
+    def _migrateLeaderboard(self):
+        self.cur.execute("CREATE TABLE IF NOT EXISTS products(pid INTEGER PRIMARY KEY,\
+                                                              name TEXT UNIQUE)")
+        self.cur.execute("ALTER TABLE drinks ADD COLUMN pid INTEGER")
+        self.cur.execute("INSERT OR IGNORE INTO products SELECT NULL, name FROM drinks ORDER BY did")
+        self.cur.execute("UPDATE drinks SET pid=(SELECT pid FROM products WHERE products.name=drinks.name)")
+        self.cur.execute("CREATE TABLE IF NOT EXISTS leaderboard(pid INTEGER,\
+                                                                 aid INTEGER,\
+                                                                 quaffed INTEGER,\
+                                                                 PRIMARY KEY(pid, aid))")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS leaderboard_pid_quaffed ON leaderboard(pid, quaffed)")
+        self._rebuildLeaderboard()
+
+
+    ## Migration 6: adds the tables caching the sales reports of past periods and an index for date ranges
+    def _migrateReports(self):
+        self.cur.execute("CREATE TABLE IF NOT EXISTS report_cache(period TEXT,\
+                                                                  grp TEXT,\
+                                                                  key INTEGER,\
+                                                                  units INTEGER,\
+                                                                  revenue INTEGER,\
+                                                                  cost INTEGER,\
+                                                                  PRIMARY KEY(grp, period, key))")
+        self.cur.execute("CREATE TABLE IF NOT EXISTS report_periods(grp TEXT,\
+                                                                    period TEXT,\
+                                                                    PRIMARY KEY(grp, period))")
+        self.cur.execute("CREATE INDEX IF NOT EXISTS transacts_date ON transacts(date)")
+
+
+    ## Migration 7: adds the tables of closePeriod()
+    def _migrateClosings(self):
+        self.cur.execute("CREATE TABLE IF NOT EXISTS closings(cutoff TEXT PRIMARY KEY,\
+                                                              oldest TEXT,\
+                                                              archive TEXT,\
+                                                              first_tid INTEGER,\
+                                                              openings INTEGER,\
+                                                              transactions INTEGER,\
+                                                              date TIMESTAMP)")
+        self.cur.execute("CREATE TABLE IF NOT EXISTS opening_kings(aid INTEGER,\
+                                                                   did INTEGER,\
+                                                                   quaffed INTEGER,\
+                                                                   PRIMARY KEY(aid, did))")
+
+
+    ## Migration 8: replaces the index transheads(aid) by transheads(aid, date) for the history
+    def _migrateHistoryIndex(self):
+        self.cur.execute("CREATE INDEX IF NOT EXISTS transheads_aid_date ON transheads(aid, date)")
+        self.cur.execute("DROP INDEX IF EXISTS transheads_aid")
+
+
+    ## Adds delta to the balance of account_id in table balances
+    #
+    #  Doesn't commit, callers have to do it together with the change of
+    #  transacts the delta results from.
+    #
+    #  \param account_id \b Integer that corresponds to an aid in table accounts
+    #  \param delta      \b Integer value in cents added to the balance. Can be negative.
+    #
+    def _addBalance(self, account_id, delta):
+        self.cur.execute("UPDATE balances SET balance=balance+? WHERE aid=?", [int(delta), account_id])
+        if self.cur.rowcount == 0:
+            self.cur.execute("INSERT INTO balances VALUES(?,?)", [account_id, int(delta)])
+
+
+    ## Adds the deltas to the balances of many accounts without committing
+    #
+    #  \param aids_deltas \b Dictionary mapping aids to integer values in cents
+    #
+    def _addBalances(self, aids_deltas):
+        self.cur.executemany("INSERT OR IGNORE INTO balances VALUES(?,0)", [[aid] for aid in aids_deltas])
+        self.cur.executemany("UPDATE balances SET balance=balance+? WHERE aid=?",
+                             [[delta, aid] for aid, delta in aids_deltas.iteritems()])
+
+
+    ## Splits an iterable into lists of at most size items
+    @staticmethod
+    def _chunks(iterable, size):
+        iterator = iter(iterable)
+        chunk = list(islice(iterator, size))
+        while chunk:
+            yield chunk
+            chunk = list(islice(iterator, size))
+
+
+    ## Raises ValueError if month has been closed by closePeriod()
+    #
+    #  \param month \b String 'YYYY-MM'
+    #
+    def _checkOpen(self, month):
+        cutoff = self._closedBefore()
+        if cutoff is not None and month < cutoff:
+            raise ValueError('{0} is closed, the transactions before {1} are archived.'.format(month, cutoff))
+
+
+    ## Returns the month before which all transactions are archived, or None
+    def _closedBefore(self):
+        self.cur.execute("SELECT MAX(cutoff) FROM closings")
+        return self.cur.fetchone()[0]
+
+
+    ## Archives the transactions before cutoff, called by closePeriod() in a transaction
+    def _closePeriod(self, cutoff, archive_path):
+        # Opening balances of previous closings are replaced, not archived
+        self.cur.execute("CREATE TEMP TABLE closed_tids AS \
+                               SELECT h.tid, NOT EXISTS (SELECT * FROM closings AS c \
+                                                          WHERE h.tid>=c.first_tid AND h.tid<c.first_tid+c.openings) \
+                                      AS archived \
+                                 FROM transheads AS h \
+                                WHERE h.date<?", [cutoff])
+        try:
+            self.cur.execute("SELECT MIN(date) FROM transheads WHERE tid IN (SELECT tid FROM temp.closed_tids WHERE archived)")
+            oldest = self.cur.fetchone()[0]
+            if oldest is None:
+                return 0
+
+            # Store the sales reports of the months and whole years before cutoff
+            self.cur.execute("SELECT grp, period FROM report_periods")
+            stored = set(self.cur.fetchall())
+            months = self._months(oldest[:7], cutoff)[:-1]
+            years = sorted(set([month[:4] for month in months if month[:4] < cutoff[:4]]))
+            for group, (key, name, join) in self._report_groups.iteritems():
+                grp = group or ''
+                for periods in [years, months]:
+                    missing = [item for item in periods if (grp, item) not in stored]
+                    if missing:
+                        self._storeSales(grp, key, missing)
+
+            self.cur.execute("CREATE TABLE IF NOT EXISTS archive.transheads(tid INTEGER PRIMARY KEY,\
+                                                                            aid INTEGER,\
+                                                                            date TIMESTAMP)")
+            self.cur.execute("CREATE TABLE IF NOT EXISTS archive.transacts(tid INTEGER,\
+                                                                           aid INTEGER,\
+                                                                           did INTEGER,\
+                                                                           count INTEGER,\
+                                                                           value INTEGER,\
+                                                                           date TIMESTAMP)")
+            self.cur.execute("CREATE INDEX IF NOT EXISTS archive.transacts_aid_tid ON transacts(aid, tid)")
+            self.cur.execute("CREATE TABLE IF NOT EXISTS archive.accounts(aid INTEGER PRIMARY KEY,\
+                                                                          name TEXT)")
+            self.cur.execute("CREATE TABLE IF NOT EXISTS archive.drinks(did INTEGER PRIMARY KEY,\
+                                                                        name TEXT)")
+            self.cur.execute("INSERT INTO archive.transheads \
+                                   SELECT tid, aid, date FROM transheads \
+                                    WHERE tid IN (SELECT tid FROM temp.closed_tids WHERE archived)")
+            num_archived = self.cur.rowcount
+            self.cur.execute("INSERT INTO archive.transacts \
+                                   SELECT tid, aid, did, count, value, date FROM transacts \
+                                    WHERE tid IN (SELECT tid FROM temp.closed_tids WHERE archived)")
+            self.cur.execute("INSERT OR REPLACE INTO archive.accounts SELECT aid, name FROM accounts")
+            self.cur.execute("INSERT OR REPLACE INTO archive.drinks SELECT did, name FROM drinks")
+
+            self.cur.execute("SELECT aid, did, SUM(count) FROM transacts \
+                               WHERE did!=0 AND tid IN (SELECT tid FROM temp.closed_tids WHERE archived) \
+                            GROUP BY aid, did")
+            aids_dids_amounts = self.cur.fetchall()
+            self.cur.executemany("INSERT OR IGNORE INTO opening_kings VALUES(?,?,0)",
+                                 [[aid, did] for aid, did, amount in aids_dids_amounts])
+            self.cur.executemany("UPDATE opening_kings SET quaffed=quaffed+? WHERE aid=? AND did=?",
+                                 [[amount, aid, did] for aid, did, amount in aids_dids_amounts])
+
+            # Replace the closed transactions by one opening balance per account
+            self.cur.execute("SELECT aid, SUM(count*value) FROM transacts \
+                               WHERE tid IN (SELECT tid FROM temp.closed_tids) \
+                            GROUP BY aid \
+                              HAVING SUM(count*value)!=0")
+            aids_balances = self.cur.fetchall()
+            self.cur.execute("DELETE FROM transacts WHERE tid IN (SELECT tid FROM temp.closed_tids)")
+            self.cur.execute("DELETE FROM transheads WHERE tid IN (SELECT tid FROM temp.closed_tids)")
+            first_tid = None
+            if aids_balances:
+                date = datetime.datetime.strptime(cutoff, '%Y-%m') - datetime.timedelta(seconds=1)
+                first_tid = self._newTransactions([aid for aid, balance in aids_balances], date)
+                self.cur.executemany("INSERT INTO transacts VALUES(?,?,?,?,?,?)",
+                                     [[first_tid+i, aid, 0, 1, balance, date]
+                                      for i, (aid, balance) in enumerate(aids_balances)])
+            self.cur.execute("INSERT INTO closings VALUES(?,?,?,?,?,?,?)",
+                             [cutoff, oldest[:7], archive_path, first_tid, len(aids_balances), num_archived,
+                              datetime.datetime.now()])
+            return num_archived
+        finally:
+            self.cur.execute("DROP TABLE temp.closed_tids")
+
+
+    ## Appends a mismatch for every key whose stored and expected values differ
+    #
+    #  Missing keys count as 0 on both sides, so rows containing 0 and
+    #  missing rows aren't reported.
+    #
+    @staticmethod
+    def _compare(mismatches, table, stored, expected):
+        for key in sorted(set(stored) | set(expected)):
+            if stored.get(key, 0) != expected.get(key, 0):
+                mismatches.append( (table, key, stored.get(key), expected.get(key)) )
+
+
+    ## Returns the WHERE clause and its parameters selecting the history of an account in transheads h
+    #
+    #  The history is ordered descending by (date, tid), so the opening
+    #  balances of closePeriod(), whose tids are newer than the archived
+    #  transactions they replace, stay at its end.
+    #
+    #  \param account_id \b Integer that corresponds to an aid in table accounts
+    #  \param before_tid \b Integer, the last tid of the previous page, or None
+    #  \return           \b Tuple (where, params), or None if before_tid doesn't exist anymore
+    #
+    def _historyPage(self, account_id, before_tid):
+        if before_tid is None:
+            return ("h.aid=?", [account_id])
+        self.cur.execute("SELECT date FROM transheads WHERE tid=?", [before_tid])
+        row = self.cur.fetchone()
+        if row is None:
+            return None
+        return ("h.aid=? AND h.date<=? AND (h.date<? OR h.tid<?)", [account_id, row[0], row[0], before_tid])
+
+
+    ## Drops the cached sales reports of months and their years without committing
+    #
+    #  Has to be called whenever transactions of a past month are added or
+    #  removed. salesReport() stores the periods again.
+    #
+    #  \param months \b List of strings 'YYYY-MM'
+    #
+    def _invalidateReports(self, months):
+        periods = [[month, month[:4]] for month in months]
+        self.cur.executemany("DELETE FROM report_cache WHERE period IN (?,?)", periods)
+        self.cur.executemany("DELETE FROM report_periods WHERE period IN (?,?)", periods)
+
+
+    ## Yields the rows of a query, fetching chunk_size rows at a time with a cursor of its own
+    def _iterRows(self, sql, params, chunk_size):
+        cur = self.dbcon.cursor()
+        try:
+            cur.execute(sql, params)
+            rows = cur.fetchmany(chunk_size)
+            while rows:
+                for row in rows:
+                    yield row
+                rows = cur.fetchmany(chunk_size)
+        finally:
+            cur.close()
+
+
+    ## Returns the list of months from first to last
+    #
+    #  \param first \b String 'YYYY-MM'
+    #  \param last  \b String 'YYYY-MM', included
+    #  \return      \b List of strings 'YYYY-MM'
+    #
+    @staticmethod
+    def _months(first, last):
+        months = []
+        while first <= last:
+            months.append(first)
+            first = BimiBase._nextMonth(first)
+        return months
+
+
+    ## Returns the month after month, both strings 'YYYY-MM'
+    @staticmethod
+    def _nextMonth(month):
+        year, month = int(month[:4]), int(month[5:7])
+        return '{0:04d}-{1:02d}'.format(year + month/12, month % 12 + 1)
+
+
+    ## Returns the first month after period, a string 'YYYY' or 'YYYY-MM'
+    #
+    #  Date bounds are always months, because a plain year like '2024' would
+    #  be compared as number with the dates in transacts.
+    #
+    @staticmethod
+    def _periodEnd(period):
+        if len(period) == 4:
+            return '{0:04d}-01'.format(int(period) + 1)
+        return BimiBase._nextMonth(period)
+
+
+    ## Fixes the mismatches found by check() without committing
+    def _repair(self, mismatches):
+        for table, key, stored, expected in mismatches:
+            if table == 'transheads':
+                if expected is None:
+                    self.cur.execute("DELETE FROM transheads WHERE tid=?", [key])
+                elif stored is None:
+                    self.cur.execute("INSERT INTO transheads SELECT tid, aid, MIN(date) FROM transacts WHERE tid=? AND aid=?",
+                                     [key, expected])
+                else:
+                    self.cur.execute("UPDATE transheads SET aid=? WHERE tid=?", [expected, key])
+            elif table == 'drinks':
+                self.cur.execute("UPDATE drinks SET " + key[1] + "=? WHERE did=?", [expected, key[0]])
+            elif table == 'balances':
+                self.cur.execute("INSERT OR REPLACE INTO balances VALUES(?,?)", [key, expected or 0])
+            else:
+                self.cur.execute("INSERT OR REPLACE INTO " + table + " VALUES(?,?,?)", list(key) + [expected or 0])
+
+
+    ## Sums up the sales of past periods and stores them in report_cache without committing
+    #
+    #  \param grp     \b String, group of salesReport() or ''
+    #  \param key     \b String, SQL expression of the key column of the group
+    #  \param periods \b List of strings 'YYYY' or 'YYYY-MM', all of the same length and ascending
+    #
+    def _storeSales(self, grp, key, periods):
+        self.cur.execute("INSERT INTO report_cache \
+                               SELECT substr(t.date, 1, {0}), ?, {1}, SUM(t.count), SUM(-t.count*t.value), \
+                                      SUM(t.count*d.purchase_price) \
+                                 FROM transacts AS t \
+                                 JOIN drinks AS d \
+                                   ON d.did=t.did \
+                                WHERE t.did!=0 AND t.date>=? AND t.date<? \
+                                      AND substr(t.date, 1, {0}) IN ({2}) \
+                             GROUP BY 1, 3".format(len(periods[0]), key, ','.join('?'*len(periods))),
+                         [grp, periods[0] if len(periods[0]) == 7 else periods[0] + '-01',
+                          self._periodEnd(periods[-1])] + periods)
+        self.cur.executemany("INSERT INTO report_periods VALUES(?,?)", [[grp, item] for item in periods])
+
+
+    ## Adds the consumed amount of drinks to tables kings and leaderboard without committing
+    #
+    #  Inserts missing rows and updates all rows with one statement each,
+    #  which relies on the unique indexes on kings(aid, did) and
+    #  leaderboard(pid, aid). The product of a drink is looked up by SQLite.
+    #
+    #  \param aids_dids_amounts \b List of tuples (aid, did, amount), amount is negative for undone drinks
+    #
+    def _updateKings(self, aids_dids_amounts):
+        self.cur.executemany("INSERT OR IGNORE INTO kings VALUES(?,?,0)",
+                             [[aid, did] for aid, did, amount in aids_dids_amounts])
+        self.cur.executemany("UPDATE kings SET quaffed=quaffed+? WHERE aid=? AND did=?",
+                             [[amount, aid, did] for aid, did, amount in aids_dids_amounts])
+        self.cur.executemany("INSERT OR IGNORE INTO leaderboard SELECT pid, ?, 0 FROM drinks WHERE did=?",
+                             [[aid, did] for aid, did, amount in aids_dids_amounts])
+        self.cur.executemany("UPDATE leaderboard SET quaffed=quaffed+? \
+                               WHERE pid=(SELECT pid FROM drinks WHERE did=?) AND aid=?",
+                             [[amount, did, aid] for aid, did, amount in aids_dids_amounts])
+
+
+    ## Allocates a new transaction id in table transheads
+    #
+    #  \param account_id \b Integer that corresponds to an aid in table accounts
+    #  \param date       \b Datetime of the transaction
+    #  \return           \b Integer containing the new tid
+    #
+    def _newTransaction(self, account_id, date):
+        self.cur.execute("INSERT INTO transheads VALUES(?,?,?)", [None, account_id, date])
+        return self.cur.lastrowid
+
+
+    ## Allocates one new transaction id per account in account_ids
+    #
+    #  The first id is allocated as in _newTransaction, which takes the write
+    #  lock. The following ids are consecutive, AUTOINCREMENT guarantees
+    #  that no higher tid exists.
+    #
+    #  \param account_ids \b List of integers that correspond to aids in table accounts
+    #  \param date        \b Datetime of the transactions
+    #  \return            \b Integer containing the tid of the first account, account i has tid+i
+    #
+    def _newTransactions(self, account_ids, date):
+        first_tid = self._newTransaction(account_ids[0], date)
+        self.cur.executemany("INSERT INTO transheads VALUES(?,?,?)",
+                             [[first_tid+i, aid, date] for i, aid in enumerate(account_ids) if i > 0])
+        return first_tid
+
+
+    ## Returns the pid of the product name, adds the product if it doesn't exist
+    #
+    #  \param name \b Unicode string containing the name of a drink
+    #  \return     \b Integer pid from table products
+    #
+    def _productId(self, name):
+        self.cur.execute("SELECT pid FROM products WHERE name=?", [name])
+        row = self.cur.fetchone()
+        if row is not None:
+            return row[0]
+        self.cur.execute("INSERT INTO products VALUES(?,?)", [None, name])
+        return self.cur.lastrowid
+
+
+    ## Recalculates table balances from transacts without committing
+    def _rebuildBalances(self):
+        self.cur.execute("DELETE FROM balances")
+        self.cur.execute("INSERT INTO balances \
+                               SELECT a.aid, COALESCE(SUM(t.count*t.value), 0) \
+                                 FROM accounts AS a \
+                      LEFT OUTER JOIN transacts AS t \
+                                   ON t.aid=a.aid \
+                             GROUP BY a.aid")
+
+
+    ## Recalculates table leaderboard from kings without committing
+    #
+    #  \param product_ids \b List of pids to be recalculated, None for all products
+    #
+    def _rebuildLeaderboard(self, product_ids=None):
+        where = ""
+        if product_ids is not None:
+            where = "WHERE pid IN ({0})".format(','.join('?'*len(product_ids)))
+        self.cur.execute("DELETE FROM leaderboard " + where, product_ids or [])
+        self.cur.execute("INSERT INTO leaderboard \
+                               SELECT d.pid, k.aid, SUM(k.quaffed) \
+                                 FROM kings AS k \
+                                 JOIN drinks AS d \
+                                   ON d.did=k.did \
+                            " + where.replace('pid', 'd.pid') + " \
+                             GROUP BY d.pid, k.aid", product_ids or [])
+
+
+    ## Returns the balances of all accounts with one query
+    #
+    #  \return \b List of tuples containing (aid, name, balance) ordered ascending
+    #             by names. balance is an integer in cents.
+    #
+    @_recordStats
+    def accountBalances(self):
+        self.cur.execute("SELECT a.aid, a.name, COALESCE(b.balance, 0) \
+                            FROM accounts AS a \
+                 LEFT OUTER JOIN balances AS b \
+                              ON b.aid=a.aid \
+                        ORDER BY a.name ASC")
+        return self.cur.fetchall()
 
 
     ## Returns a list containing account IDs and names odered ascending by names
     #
     #  \return \b List of tuples containing (aid,name) from table accounts
     #
+    @_recordStats
     def accounts(self):
         self.cur.execute("SELECT * FROM accounts ORDER BY name ASC")
         return self.cur.fetchall()
@@ -128,11 +852,15 @@ class BimiBase:
     #  \param account_name \b String containing the name of the user
     #  \param credit       \b Integer value of the credit to be added. Can be negative.
     #
+    @_recordStats
+    @_retryOnBusy
     def addAccount(self, account_name, credit=None):
-        self.cur.execute("INSERT INTO accounts VALUES(?,?)", [None, account_name.decode('utf-8')])
-        self.dbcon.commit()
-        if credit is not None:
-            self.addCredit(self.cur.lastrowid, credit)
+        with self.batch():
+            self.cur.execute("INSERT INTO accounts VALUES(?,?)", [None, account_name.decode('utf-8')])
+            account_id = self.cur.lastrowid
+            self.cur.execute("INSERT INTO balances VALUES(?,?)", [account_id, 0])
+            if credit is not None:
+                self.addCredit(account_id, credit)
 
 
     ## Creates a transaction which adds credit to account_id.
@@ -142,15 +870,15 @@ class BimiBase:
     #  \param account_id \b Integer that corresponds to an aid in table accounts
     #  \param credit     \b Integer value of the credit to be added. Can be negative.
     #
+    @_recordStats
+    @_retryOnBusy
     def addCredit(self, account_id, credit):
-        self.cur.execute("SELECT EXISTS(SELECT * FROM transacts)")
-        if self.cur.fetchone()[0] != 0:
-            self.cur.execute("INSERT INTO transacts VALUES((SELECT MAX(tid) FROM transacts)+1,?,?,?,?,?)",\
-                             [int(account_id), 0, 1, int(credit), datetime.datetime.now()])
-        else:
-            self.cur.execute("INSERT INTO transacts VALUES(1,?,?,?,?,?)",\
-                             [int(account_id), 0, 1, int(credit), datetime.datetime.now()])
-        self.dbcon.commit()
+        now = datetime.datetime.now()
+        new_tid = self._newTransaction(int(account_id), now)
+        self.cur.execute("INSERT INTO transacts VALUES(?,?,?,?,?,?)",\
+                         [new_tid, int(account_id), 0, 1, int(credit), now])
+        self._addBalance(int(account_id), credit)
+        self._commit()
 
 
     ## Adds a new drink to drinks table.
@@ -163,12 +891,263 @@ class BimiBase:
     #                                        integer number of empty bottles
     #                                        bool    if drink should show up in kings() call
     #
+    @_recordStats
+    @_retryOnBusy
     def addDrink(self, nspdfek=[]):
         nspdfek = [None] + nspdfek
         nspdfek.insert(7, False)
         nspdfek[1] = nspdfek[1].decode('utf-8')
-        self.cur.execute("INSERT INTO drinks VALUES(?,?,?,?,?,?,?,?,?)", nspdfek)
-        self.dbcon.commit()
+        nspdfek.append(self._productId(nspdfek[1]))
+        self.cur.execute("INSERT INTO drinks(did, name, sales_price, purchase_price, deposit, bottles_full,\
+                                             bottles_empty, deleted, kings, pid) \
+                          VALUES(?,?,?,?,?,?,?,?,?,?)", nspdfek)
+        self._commit()
+
+
+    ## Returns the archived transactions of an user, newest first
+    #
+    #  The archives are attached only while they are read.
+    #
+    #  \param account_id   \b Integer that corresponds to an aid in table accounts
+    #  \param archive_path \b String containing the path of an archive, None for all
+    #                         archives written by closePeriod()
+    #  \return             \b List of ntuples (tid, drinks.name, count, value, date) like
+    #                         transactions()
+    #
+    @_recordStats
+    def archivedTransactions(self, account_id, archive_path=None):
+        if archive_path is not None:
+            paths = [archive_path]
+        else:
+            self.cur.execute("SELECT DISTINCT archive FROM closings")
+            paths = [row[0] for row in self.cur.fetchall()]
+        rows = []
+        for path in paths:
+            if not os.path.isfile(path):
+                self._logger.error('Archive %s not found!', path)
+                continue
+            self.cur.execute("ATTACH DATABASE ? AS archive", [path])
+            try:
+                self.cur.execute("SELECT t.tid, d.name, t.count, t.value, t.date \
+                                    FROM archive.transacts AS t \
+                         LEFT OUTER JOIN archive.drinks AS d \
+                                      ON d.did=t.did \
+                                   WHERE t.aid=? \
+                                ORDER BY t.tid DESC, t.did ASC", [account_id])
+                rows += self.cur.fetchall()
+            finally:
+                self.cur.execute("DETACH DATABASE archive")
+        return sorted(rows, key=lambda row: -row[0])
+
+
+    ## Returns the balance of an account from table balances
+    #
+    #  \param account_id \b Integer that corresponds to an aid in table accounts
+    #  \return           \b Integer balance in cents, 0 if the account has no balance
+    #
+    @_recordStats
+    def balance(self, account_id):
+        self.cur.execute("SELECT balance FROM balances WHERE aid=?", [account_id])
+        row = self.cur.fetchone()
+        if row is None:
+            return 0
+        return row[0]
+
+
+    ## Returns the balances of all accounts from table balances
+    #
+    #  \return \b List of tuples containing (aid, balance) ordered ascending by aid.
+    #             balance is an integer in cents.
+    #
+    @_recordStats
+    def balances(self):
+        self.cur.execute("SELECT aid, balance FROM balances ORDER BY aid ASC")
+        return self.cur.fetchall()
+
+
+    ## Context manager which groups writes into one transaction
+    #
+    #  All methods called inside the with block skip their own commit. The
+    #  outermost block commits once at its end or rolls back everything if
+    #  it is left with an exception. Outside of a batch every method
+    #  commits on its own, as before.
+    #
+    #  with db.batch():
+    #      db.addCredit(1, 500)
+    #      db.consumeDrinks(2, [(1, 3)])
+    #
+    @contextmanager
+    def batch(self):
+        self._batch_depth += 1
+        try:
+            yield self
+        except:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.dbcon.rollback()
+            raise
+        self._batch_depth -= 1
+        if self._batch_depth == 0:
+            self.dbcon.commit()
+            self._commits += 1
+
+
+    ## Compares the derived tables with transacts and optionally repairs them
+    #
+    #  transacts is streamed once in tid order, summing up kings, balances
+    #  and the leaderboard in memory bounded by accounts times drinks, and
+    #  merged with transheads. The kings start with opening_kings, which
+    #  contains the drinks of the transactions archived by closePeriod(). Negative stock counts are reported too.
+    #  Everything runs in one transaction, with repair it takes the write
+    #  lock first, so nothing can change between the check and the repair.
+    #  Therefore it can't be called inside of a batch() block, which raises
+    #  ValueError.
+    #
+    #  The stock can't be recalculated, because setDrink() overwrites it
+    #  without a transaction being recorded.
+    #
+    #  \param repair \b Bool, if True all mismatches get fixed
+    #  \return       \b List of tuples (table, key, stored, expected), stored or
+    #                    expected is None for a missing row. key is (aid, did)
+    #                    for kings, (pid, aid) for leaderboard, aid for
+    #                    balances, tid for transheads and (did, column) for drinks.
+    #
+    @_recordStats
+    @_retryOnBusy
+    def check(self, repair=False):
+        if self._batch_depth > 0:
+            raise ValueError('check() runs in a transaction of its own, call it outside of batch().')
+        mismatches = []
+        self.dbcon.isolation_level = None
+        try:
+            self.cur.execute("BEGIN IMMEDIATE" if repair else "BEGIN")
+            try:
+                # Stream transacts and transheads, both ordered by tid
+                heads = iter(self.dbcon.cursor().execute("SELECT tid, aid FROM transheads ORDER BY tid"))
+                head = next(heads, None)
+                rows = self.dbcon.cursor().execute("SELECT tid, aid, did, count, value FROM transacts ORDER BY tid")
+                self.cur.execute("SELECT aid, did, quaffed FROM opening_kings")
+                kings = dict([((aid, did), quaffed) for aid, did, quaffed in self.cur])
+                balances = {}
+                last_tid = None
+                for tid, aid, did, count, value in rows:
+                    if tid != last_tid:
+                        while head is not None and head[0] < tid:
+                            if head[0] != last_tid:
+                                mismatches.append( ('transheads', head[0], head[1], None) )
+                            head = next(heads, None)
+                        if head is None or head[0] != tid:
+                            mismatches.append( ('transheads', tid, None, aid) )
+                        elif head[1] != aid:
+                            mismatches.append( ('transheads', tid, head[1], aid) )
+                        last_tid = tid
+                    balances[aid] = balances.get(aid, 0) + count*value
+                    if did != 0:
+                        kings[(aid, did)] = kings.get((aid, did), 0) + count
+                while head is not None:
+                    if head[0] != last_tid:
+                        mismatches.append( ('transheads', head[0], head[1], None) )
+                    head = next(heads, None)
+
+                self.cur.execute("SELECT aid, did, quaffed FROM kings")
+                self._compare(mismatches, 'kings', dict([((aid, did), quaffed) for aid, did, quaffed in self.cur]), kings)
+
+                self.cur.execute("SELECT did, pid FROM drinks")
+                dids_pids = dict(self.cur.fetchall())
+                leaderboard = {}
+                for (aid, did), quaffed in kings.iteritems():
+                    if did in dids_pids:
+                        key = (dids_pids[did], aid)
+                        leaderboard[key] = leaderboard.get(key, 0) + quaffed
+                self.cur.execute("SELECT pid, aid, quaffed FROM leaderboard")
+                self._compare(mismatches, 'leaderboard', dict([((pid, aid), quaffed) for pid, aid, quaffed in self.cur]), leaderboard)
+
+                self.cur.execute("SELECT aid, balance FROM balances")
+                self._compare(mismatches, 'balances', dict(self.cur.fetchall()), balances)
+
+                self.cur.execute("SELECT did, bottles_full, bottles_empty FROM drinks WHERE bottles_full<0 OR bottles_empty<0")
+                for did, full, empty in self.cur.fetchall():
+                    for col, value in [('bottles_full', full), ('bottles_empty', empty)]:
+                        if value < 0:
+                            mismatches.append( ('drinks', (did, col), value, 0) )
+
+                if repair and mismatches:
+                    self._repair(mismatches)
+                    self._logger.info('Repaired %i mismatches.', len(mismatches))
+                self.cur.execute("COMMIT")
+            except:
+                self.cur.execute("ROLLBACK")
+                raise
+        finally:
+            self.dbcon.isolation_level = ''
+        if repair and mismatches:
+            self._commits += 1
+        return mismatches
+
+
+    ## Moves all transactions before cutoff into an archive data base
+    #
+    #  Every account gets one opening balance transaction dated a second
+    #  before cutoff, containing the sum of its archived transactions, so
+    #  the balances stay exactly the same. The drinks quaffed in the
+    #  archived transactions are kept in opening_kings and the sales
+    #  reports of all periods before cutoff are stored, see salesReport().
+    #  Afterwards transactions before cutoff can neither be imported nor
+    #  undone.
+    #
+    #  The archive is a SQLite file containing the tables transheads and
+    #  transacts plus the names from accounts and drinks. It's written in
+    #  the same transaction as the data base and can be used by several
+    #  closings, see archivedTransactions(). Finally the data base is
+    #  vacuumed, otherwise the file wouldn't get smaller. Like check() it
+    #  can't be called inside of a batch() block, which raises ValueError.
+    #
+    #  \param cutoff       \b String 'YYYY' or 'YYYY-MM' of the first month which is kept
+    #  \param archive_path \b String containing the path of the archive, created if it doesn't exist
+    #  \param vacuum       \b Bool, if False the freed pages are only reused by the data base
+    #  \return             \b Integer number of archived transactions
+    #
+    @_recordStats
+    @_retryOnBusy
+    def closePeriod(self, cutoff, archive_path, vacuum=True):
+        if self._batch_depth > 0:
+            raise ValueError('closePeriod() runs in a transaction of its own, call it outside of batch().')
+        if not re.match(r'^\d{4}(-(0[1-9]|1[0-2]))?$', cutoff):
+            raise ValueError('Cutoff {0} has to be YYYY or YYYY-MM.'.format(cutoff))
+        cutoff = cutoff if len(cutoff) == 7 else cutoff + '-01'
+        if cutoff > datetime.date.today().strftime('%Y-%m'):
+            raise ValueError('Cutoff {0} is in the future.'.format(cutoff))
+        closed = self._closedBefore()
+        if closed is not None and cutoff <= closed:
+            raise ValueError('The transactions before {0} are archived already.'.format(closed))
+
+        self.cur.execute("ATTACH DATABASE ? AS archive", [archive_path])
+        self.dbcon.isolation_level = None
+        try:
+            self.cur.execute("BEGIN IMMEDIATE")
+            try:
+                num_archived = self._closePeriod(cutoff, archive_path)
+                self.cur.execute("COMMIT")
+            except:
+                self.cur.execute("ROLLBACK")
+                raise
+        finally:
+            self.dbcon.isolation_level = ''
+            self.cur.execute("DETACH DATABASE archive")
+        self._commits += 1
+        self._logger.info('Archived %i transactions before %s to %s.', num_archived, cutoff, archive_path)
+        if vacuum:
+            self.cur.execute("VACUUM")
+        return num_archived
+
+
+    ## Returns the cutoff of the last closePeriod() as string 'YYYY-MM', or None
+    #
+    #  Transactions dated before it, i.e. the opening balances, can't be undone.
+    #
+    @_recordStats
+    def closedBefore(self):
+        return self._closedBefore()
 
 
     ## Creates one db-entry per drink in transacts with the same tid.
@@ -176,56 +1155,65 @@ class BimiBase:
     #  \param account_id        \b Integer that corresponds to an aid in table accounts
     #  \param drinkIDs_amounts  \b List that contains tuples (did, amount) to know the amount of drinks consumed
     #
+    @_recordStats
+    @_retryOnBusy
     def consumeDrinks(self, account_id, drinkIDs_amounts):
-        # Get drink informations from drinks table
-        drink_infos = {}
-        for item in drinkIDs_amounts:
-            self.cur.execute("SELECT sales_price,bottles_full,bottles_empty FROM drinks WHERE did=?", [item[0]])
-            data = self.cur.fetchone()
-            if not data:
-                self._logger.error("DrinkID %d in table drinks not found. Can't consume this drink :(", item[0])
-                return
-            # Check if drink ist listed multiple times
-            if item[0] in drink_infos:
-                buf = list(drink_infos[item[0]])
-                buf[0] += item[1]
-                drink_infos[item[0]] = tuple(buf)
-            else:
-                drink_infos[item[0]] = ((item[1]),) + data
-
-        # get max(tid)
-        new_tid = 0
-        for item in self.cur.execute("SELECT MAX(tid) FROM transacts"):
-            new_tid = item[0]+1;
-        if new_tid == sys.maxint:
-            self._logger.error("TID in table transacts reached maxINT! Can't commit any transactions X_X")
+        # Sum up amounts of drinks listed multiple times
+        dids_amounts = {}
+        for did, amount in drinkIDs_amounts:
+            dids_amounts[did] = dids_amounts.get(did, 0) + amount
+        if not dids_amounts:
             return
 
-        # update transacts and drinks tables
-        for k,v in drink_infos.iteritems():
-            self.cur.execute("INSERT INTO transacts VALUES(?,?,?,?,?,?)", [new_tid, account_id, k, v[0], -v[1], datetime.datetime.now()])
-            if v[2]-v[0] < 0:
-                self.cur.execute("UPDATE drinks SET bottles_full=?,bottles_empty=? WHERE did=?", [0, v[3]+v[0], k])
-            else:
-                self.cur.execute("UPDATE drinks SET bottles_full=?,bottles_empty=? WHERE did=?", [v[2]-v[0], v[3]+v[0], k])
-        self.dbcon.commit()
+        # Get sales prices of all drinks with one query
+        self.cur.execute("SELECT did, sales_price FROM drinks WHERE did IN ({0})".format(','.join('?'*len(dids_amounts))),
+                         dids_amounts.keys())
+        dids_prices = dict(self.cur.fetchall())
+        for did in dids_amounts:
+            if did not in dids_prices:
+                self._logger.error("DrinkID %d in table drinks not found. Can't consume this drink :(", did)
+                return
 
-        # update kings table
-        self.updateKing(account_id, drinkIDs_amounts)
+        # update transheads, transacts, drinks, kings and balances tables in one transaction
+        now = datetime.datetime.now()
+        new_tid = self._newTransaction(account_id, now)
+        self.cur.executemany("INSERT INTO transacts VALUES(?,?,?,?,?,?)",
+                             [[new_tid, account_id, did, amount, -dids_prices[did], now] for did, amount in dids_amounts.iteritems()])
+        self.cur.executemany("UPDATE drinks SET bottles_full=MAX(bottles_full-?, 0), bottles_empty=bottles_empty+? WHERE did=?",
+                             [[amount, amount, did] for did, amount in dids_amounts.iteritems()])
+        self._updateKings([(account_id, did, amount) for did, amount in dids_amounts.iteritems()])
+        self._addBalance(account_id, -sum([amount*dids_prices[did] for did, amount in dids_amounts.iteritems()]))
+        self._commit()
 
 
     ## Deletes all references to account_id in the database
     #
+    #  The stored sales reports of the months with transactions of the
+    #  account are dropped, so they are summed up again without its sales
+    #  like the months which aren't stored. Months before the cutoff of
+    #  closePeriod() can't be summed up again, their totals keep the
+    #  archived sales of the account.
+    #
     #  \param account_id \b Integer that corresponds to an aid in table accounts
     #
+    @_recordStats
+    @_retryOnBusy
     def delAccount(self, account_id):
+        self.cur.execute("SELECT DISTINCT substr(date, 1, 7) FROM transheads WHERE aid=? AND date>=?",
+                         [account_id, self._closedBefore() or '0000-01'])
+        self._invalidateReports([row[0] for row in self.cur.fetchall()])
         # delete account from account-table
         self.cur.execute("DELETE FROM accounts WHERE aid=?", [account_id])
         # delete all transactions related to the account
         self.cur.execute("DELETE FROM transacts WHERE aid=?", [account_id])
+        self.cur.execute("DELETE FROM transheads WHERE aid=?", [account_id])
         #delete account from kings
         self.cur.execute("DELETE FROM kings WHERE aid=?", [account_id])
-        self.dbcon.commit()
+        self.cur.execute("DELETE FROM opening_kings WHERE aid=?", [account_id])
+        self.cur.execute("DELETE FROM leaderboard WHERE aid=?", [account_id])
+        self.cur.execute("DELETE FROM balances WHERE aid=?", [account_id])
+        self.cur.execute("DELETE FROM report_cache WHERE grp='account' AND key=?", [account_id])
+        self._commit()
 
 
     ## Marks the drink as deleted in table drinks
@@ -233,15 +1221,18 @@ class BimiBase:
     #  \param drink_id \b Integer containing the did from table drinks
     #
     #TODO: delete drink if there are no transactions attached
+    @_recordStats
+    @_retryOnBusy
     def delDrink(self, drink_id):
         self.cur.execute("UPDATE drinks SET deleted=1, kings=0 WHERE did=?", [drink_id])
-        self.dbcon.commit()
+        self._commit()
 
 
     ## Returns a list of all available drinks
     #
     #  \return \b List of ntuples containing all columns form table drinks except deleted
     #
+    @_recordStats
     def drinks(self):
         self.cur.execute("SELECT did, name, sales_price, purchase_price, deposit, bottles_full, bottles_empty, kings \
                             FROM drinks \
@@ -250,78 +1241,432 @@ class BimiBase:
         return self.cur.fetchall()
 
 
-    ## Returns those who have consumed the most for each drink
+    ## Returns the query plan of a statement
     #
-    #  For every relevant drink name and username calculate the amount
-    #  and keep only the user with MAX(quaffed)
+    #  \param sql    \b String containing the statement
+    #  \param params \b List of parameters of the statement
+    #  \return       \b List of strings, one per step of the plan, or the error
     #
-    #  \return \b List of ntuples (accounts.name, drinks.name, quaffed) for every
-    #             drink with drinks.kings=True and quaffed = MAX(quaffed)ordered
-    #             ascending by accounts.name
+    def explain(self, sql, params=[]):
+        try:
+            self.cur.execute("EXPLAIN QUERY PLAN " + sql, params)
+            return [row[-1] for row in self.cur.fetchall()]
+        except sqlite3.Error as err:
+            return ['[sqlite3: {0}]'.format(err)]
+
+
+    ## Returns a value which changes whenever the data base content changes
     #
+    #  Covers commits of this BimiBase and, via PRAGMA data_version, commits
+    #  of other connections and processes. Cheap enough to be polled, e.g.
+    #  to skip reloading views if nothing has changed.
+    #
+    #  \return \b Tuple which is only equal to a previous result if nothing was committed in between
+    #
+    @_recordStats
+    def generation(self):
+        self.cur.execute("PRAGMA data_version")
+        data_version = self.cur.fetchone()
+        return (self._commits, data_version[0] if data_version else None)
+
+
+    ## Adds many credit transactions at once
+    #
+    #  aids_credits is consumed in chunks, so it can be a generator streaming
+    #  from a file. Every item becomes a transaction of its own. Runs in
+    #  one transaction, i.e. inside of the callers batch() if there is one.
+    #  Not retried if the data base is busy, the iterable can't be rewound.
+    #
+    #  \param aids_credits \b Iterable of tuples (aid, credit), credit is an integer in cents
+    #  \param chunk_size   \b Integer number of rows inserted per executemany
+    #  \param date         \b datetime of the transactions, None for now. Raises
+    #                         ValueError if it's before the cutoff of closePeriod().
+    #  \return             \b Integer number of added transactions
+    #
+    @_recordStats
+    def importCredits(self, aids_credits, chunk_size=1000, date=None):
+        if date is not None:
+            self._checkOpen(date.strftime('%Y-%m'))
+        now = date or datetime.datetime.now()
+        aids_deltas = {}
+        count = 0
+        with self.batch():
+            for chunk in self._chunks(aids_credits, chunk_size):
+                first_tid = self._newTransactions([aid for aid, credit in chunk], now)
+                self.cur.executemany("INSERT INTO transacts VALUES(?,?,?,?,?,?)",
+                                     [[first_tid+i, aid, 0, 1, credit, now] for i, (aid, credit) in enumerate(chunk)])
+                for aid, credit in chunk:
+                    aids_deltas[aid] = aids_deltas.get(aid, 0) + credit
+                count += len(chunk)
+            self._addBalances(aids_deltas)
+            if date is not None:
+                self._invalidateReports([date.strftime('%Y-%m')])
+        return count
+
+
+    ## Adds many drink consumptions at once
+    #
+    #  Works like importCredits. Every item becomes a transaction of its own
+    #  and drinks, kings, leaderboard and balances are updated once per drink
+    #  and account at the end.
+    #
+    #  \param aids_dids_counts \b Iterable of tuples (aid, did, count)
+    #  \param chunk_size       \b Integer number of rows inserted per executemany
+    #  \param date             \b datetime of the transactions, None for now. Raises
+    #                             ValueError if it's before the cutoff of closePeriod().
+    #  \return                 \b Integer number of added transactions
+    #
+    @_recordStats
+    def importDrinks(self, aids_dids_counts, chunk_size=1000, date=None):
+        if date is not None:
+            self._checkOpen(date.strftime('%Y-%m'))
+        self.cur.execute("SELECT did, sales_price FROM drinks")
+        dids_prices = dict(self.cur.fetchall())
+        now = date or datetime.datetime.now()
+        aids_deltas = {}
+        dids_counts = {}
+        kings_counts = {}
+        count = 0
+        with self.batch():
+            for chunk in self._chunks(aids_dids_counts, chunk_size):
+                for aid, did, amount in chunk:
+                    if did not in dids_prices:
+                        raise ValueError('DrinkID {0} in table drinks not found.'.format(did))
+                    aids_deltas[aid] = aids_deltas.get(aid, 0) - amount*dids_prices[did]
+                    dids_counts[did] = dids_counts.get(did, 0) + amount
+                    kings_counts[(aid, did)] = kings_counts.get((aid, did), 0) + amount
+                first_tid = self._newTransactions([item[0] for item in chunk], now)
+                self.cur.executemany("INSERT INTO transacts VALUES(?,?,?,?,?,?)",
+                                     [[first_tid+i, aid, did, amount, -dids_prices[did], now]
+                                      for i, (aid, did, amount) in enumerate(chunk)])
+                count += len(chunk)
+            self.cur.executemany("UPDATE drinks SET bottles_full=MAX(bottles_full-?, 0), bottles_empty=bottles_empty+? WHERE did=?",
+                                 [[amount, amount, did] for did, amount in dids_counts.iteritems()])
+            self._updateKings([(aid, did, amount) for (aid, did), amount in kings_counts.iteritems()])
+            self._addBalances(aids_deltas)
+            if date is not None:
+                self._invalidateReports([date.strftime('%Y-%m')])
+        return count
+
+
+    ## Iterates over the accounts like accounts(), without fetching all of them at once
+    #
+    #  The rows are read in chunks by a cursor of its own, so other reading
+    #  methods can be called while iterating. Nothing should be written
+    #  before the iteration has finished, a commit may end it early.
+    #
+    #  \param chunk_size \b Integer number of rows fetched at once
+    #  \return           \b Generator of tuples (aid, name) ordered ascending by names
+    #
+    def iterAccounts(self, chunk_size=1000):
+        return self._iterRows("SELECT * FROM accounts ORDER BY name ASC", [], chunk_size)
+
+
+    ## Iterates over the drinks like drinks(), see iterAccounts()
+    #
+    #  \param chunk_size \b Integer number of rows fetched at once
+    #  \return           \b Generator of tuples like drinks()
+    #
+    def iterDrinks(self, chunk_size=1000):
+        return self._iterRows("SELECT did, name, sales_price, purchase_price, deposit, bottles_full, bottles_empty, kings \
+                                 FROM drinks \
+                                WHERE deleted=0 \
+                             ORDER BY name ASC", [], chunk_size)
+
+
+    ## Iterates over the transactions of an user or of all users, oldest first
+    #
+    #  Works like iterAccounts(), the memory needed doesn't depend on the
+    #  number of transactions. The order is the one of transactions()
+    #  reversed, so the opening balances of closePeriod() come before the
+    #  newer transactions. The date of transacts equals the one of
+    #  transheads, sorting by it uses the index transacts(date) and only
+    #  the rows of the same date get sorted by tid.
+    #
+    #  \param account_id \b Integer that corresponds to an aid in table accounts, None for all accounts
+    #  \param chunk_size \b Integer number of rows fetched at once
+    #  \return           \b Generator of tuples (tid, aid, drinks.name, count, value, date) ordered
+    #                       ascending by (date, tid). value is the cost of one bottle like in transactions().
+    #
+    def iterTransactions(self, account_id=None, chunk_size=1000):
+        where = "" if account_id is None else "WHERE t.aid=?"
+        return self._iterRows("SELECT t.tid, t.aid, d.name, t.count, t.value, t.date \
+                                 FROM transacts AS t \
+                      LEFT OUTER JOIN drinks AS d \
+                                   ON d.did=t.did \
+                                " + where + " \
+                             ORDER BY t.date ASC, t.tid ASC, t.did ASC", [] if account_id is None else [account_id], chunk_size)
+
+
+    ## Returns those who have consumed the most for each product
+    #
+    #  Accounts sharing the first place are all returned.
+    #
+    #  \return \b List of ntuples (accounts.name, products.name, quaffed) for every
+    #             product with a drink with drinks.kings=True, ordered ascending
+    #             by accounts.name
+    #
+    @_recordStats
     def kings(self):
-        self.cur.execute('''SELECT name, dname, MAX(total)
-                            FROM (SELECT k.aid, d.name AS dname, SUM(k.quaffed) AS total
-                                  FROM kings AS k
-                                  JOIN drinks AS d ON k.did=d.did
-                                  WHERE d.name IN (SELECT DISTINCT name FROM drinks WHERE kings=1 AND deleted=0)
-                                  GROUP BY k.aid, d.name) AS b
-                            JOIN accounts AS a ON b.aid=a.aid
-                            GROUP BY dname
-                            ORDER BY name ASC''')
+        return sorted([(name, pname, quaffed) for pid, pname, aid, name, quaffed in self.leaderboard(1)])
+
+
+    ## Returns the top consumers of every product from table leaderboard
+    #
+    #  Per product the rows with the top largest quaffed values are
+    #  returned, plus all rows tied with the last of them. Both lookups
+    #  are range reads of the index on leaderboard(pid, quaffed), the rest
+    #  of the table isn't scanned. Accounts which haven't quaffed anything
+    #  aren't ranked.
+    #
+    #  \param top \b Integer number of places per product
+    #  \return    \b List of ntuples (pid, products.name, aid, accounts.name, quaffed) for every
+    #                product with a drink with drinks.kings=True and not deleted,
+    #                ordered by products.name and descending by quaffed
+    #
+    @_recordStats
+    def leaderboard(self, top=3):
+        self.cur.execute("SELECT p.pid, p.name, l.aid, a.name, l.quaffed \
+                            FROM products AS p \
+                            JOIN leaderboard AS l \
+                              ON l.pid=p.pid \
+                             AND l.quaffed>=COALESCE((SELECT quaffed FROM leaderboard \
+                                                       WHERE pid=p.pid AND quaffed>0 \
+                                                    ORDER BY quaffed DESC LIMIT 1 OFFSET ?), 1) \
+                            JOIN accounts AS a \
+                              ON a.aid=l.aid \
+                           WHERE p.pid IN (SELECT pid FROM drinks WHERE kings=1 AND deleted=0) \
+                        ORDER BY p.name ASC, l.quaffed DESC, a.name ASC", [top-1])
+        return self.cur.fetchall()
+
+
+    ## Recalculates the balances of all accounts from table transacts
+    #
+    #  Only needed if table balances got out of sync, e.g. after transacts
+    #  has been edited by hand.
+    #
+    @_recordStats
+    @_retryOnBusy
+    def rebuildBalances(self):
+        self._rebuildBalances()
+        self._commit()
+
+
+    ## Returns the sales per period, optionally per drink or account
+    #
+    #  Past years and months are summed up once and stored in report_cache,
+    #  unless the data base is read-only. A report is one query adding up
+    #  the stored periods and the transactions of the others, usually only
+    #  those of the current month. Years which aren't completely in the
+    #  range or not over yet are added up from their months. Stored periods
+    #  keep the purchase prices of the time they were stored, the names are
+    #  joined when the report is made. Credits are not included.
+    #
+    #  \param period \b String, 'month' or 'year'
+    #  \param group  \b String, None for the totals of all sales, 'drink' for every
+    #                    product or 'account' for every account
+    #  \param first  \b String 'YYYY' or 'YYYY-MM' of the first month, None for the oldest
+    #  \param last   \b String 'YYYY' or 'YYYY-MM' of the last month, None for the newest
+    #  \return       \b List of tuples (period, name, units, revenue, cost) ordered by period
+    #                    and name. period is a string 'YYYY' or 'YYYY-MM', name is None
+    #                    without group, revenue and cost are integers in cents.
+    #
+    @_recordStats
+    @_retryOnBusy
+    def salesReport(self, period='month', group=None, first=None, last=None):
+        if period not in ['month', 'year']:
+            raise ValueError('Unknown period {0}, has to be month or year.'.format(period))
+        if group not in self._report_groups:
+            raise ValueError('Unknown group {0}, has to be drink or account.'.format(group))
+        for value in [first, last]:
+            if value is not None and not re.match(r'^\d{4}(-(0[1-9]|1[0-2]))?$', value):
+                raise ValueError('Period {0} has to be YYYY or YYYY-MM.'.format(value))
+        first = '0000-01' if first is None else first if len(first) == 7 else first + '-01'
+        last = '9999-12' if last is None else last if len(last) == 7 else last + '-12'
+
+        self.cur.execute("SELECT (SELECT MIN(date) FROM transacts), (SELECT MAX(date) FROM transacts), \
+                                 (SELECT MIN(oldest) FROM closings), (SELECT MAX(cutoff) FROM closings)")
+        oldest, newest, archived, cutoff = self.cur.fetchone()
+        if archived is not None:
+            # The months before cutoff have been stored by closePeriod()
+            last_closed = self._months(archived, cutoff)[-2]
+            oldest = min(oldest or archived, archived)
+            newest = max(newest or last_closed, last_closed)
+        if oldest is None or max(first, oldest[:7]) > min(last, newest[:7]):
+            return []
+        months = self._months(max(first, oldest[:7]), min(last, newest[:7]))
+        grp = group or ''
+        key, name, join = self._report_groups[group]
+        current = datetime.date.today().strftime('%Y-%m')
+        cutoff = cutoff or '0000-01'
+        self.cur.execute("SELECT period FROM report_periods WHERE grp=? AND period>=? AND period<=?",
+                         [grp, months[0][:4], months[-1]])
+        stored = set([row[0] for row in self.cur.fetchall()])
+
+        # Store the missing past years completely in the range, then the missing past months of the other years
+        years = []
+        missing = []
+        if period == 'year':
+            years = sorted(set([month[:4] for month in months if first <= month[:4] + '-01' and month[:4] + '-12' <= last]))
+            missing = [year for year in years if cutoff <= year + '-01' and year < current[:4] and year not in stored]
+            if missing and not self.read_only:
+                self._storeSales(grp, key, missing)
+                stored.update(missing)
+            years = [year for year in years if year in stored]
+            months = [month for month in months if month[:4] not in years]
+        missing_months = [month for month in months if cutoff <= month < current and month not in stored]
+        if missing_months and not self.read_only:
+            self._storeSales(grp, key, missing_months)
+            stored.update(missing_months)
+        if (missing or missing_months) and not self.read_only:
+            self._commit()
+
+        # Add up the stored periods and the transactions of the months which aren't stored
+        cached = years + [month for month in months if month in stored]
+        live = [month for month in months if month not in stored]
+        length = 7 if period == 'month' else 4
+        parts = []
+        params = []
+        if cached:
+            parts.append("SELECT substr(period, 1, {0}) AS period, key, units, revenue, cost \
+                            FROM report_cache \
+                           WHERE grp=? AND period IN ({1})".format(length, ','.join('?'*len(cached))))
+            params += [grp] + cached
+        if live:
+            skipped = [month for month in months if live[0] < month < live[-1] and month in stored]
+            parts.append("SELECT substr(t.date, 1, {0}) AS period, {1} AS key, SUM(t.count) AS units, \
+                                 SUM(-t.count*t.value) AS revenue, SUM(t.count*d.purchase_price) AS cost \
+                            FROM transacts AS t \
+                            JOIN drinks AS d \
+                              ON d.did=t.did \
+                           WHERE t.did!=0 AND t.date>=? AND t.date<? {2} \
+                        GROUP BY 1, 2".format(length, key, "AND substr(t.date, 1, 7) NOT IN ({0})".format(
+                                              ','.join('?'*len(skipped))) if skipped else ""))
+            params += [live[0], self._nextMonth(live[-1])] + skipped
+        self.cur.execute("SELECT r.period, {0}, SUM(r.units), SUM(r.revenue), SUM(r.cost) \
+                            FROM ({1}) AS r \
+                            {2} \
+                        GROUP BY r.period, r.key \
+                        ORDER BY r.period ASC, 2 ASC".format(name, " UNION ALL ".join(parts), join), params)
         return self.cur.fetchall()
 
 
     ## Sets the name from account_id to name
+    @_recordStats
+    @_retryOnBusy
     def setAccountName(self, account_id, name):
         self.cur.execute("UPDATE accounts SET name=? WHERE aid=?", [name.decode('utf-8'), account_id])
-        self.dbcon.commit()
+        self._commit()
 
 
     ## Sets columns of drinks table, depending on values in nspdfek
+    #
+    #  If the name changes, the drink moves to the product of the new name
+    #  and the leaderboard of both products is recalculated.
+    #
+    @_recordStats
+    @_retryOnBusy
     def setDrink(self, drink_id, nspdfek=[]):
-        nspdfek[0] = nspdfek[0].decode('utf-8')
         if len(nspdfek) == 7:
-            nspdfek.append(drink_id)
+            self.cur.execute("SELECT pid FROM drinks WHERE did=?", [drink_id])
+            old_pid = self.cur.fetchone()
+            new_pid = self._productId(nspdfek[0].decode('utf-8'))
+            # Copy, _retryOnBusy may call this method again with the same list
+            nspdfek = [nspdfek[0].decode('utf-8')] + nspdfek[1:] + [new_pid, drink_id]
             self.cur.execute("UPDATE drinks SET name=?,\
                                                 sales_price=?,\
                                                 purchase_price=?,\
                                                 deposit=?,\
                                                 bottles_full=?,\
                                                 bottles_empty=?,\
-                                                kings=? \
+                                                kings=?,\
+                                                pid=? \
                                             WHERE did=?", nspdfek)
-            self.dbcon.commit()
+            if old_pid is not None and old_pid[0] != new_pid:
+                self._rebuildLeaderboard([old_pid[0], new_pid])
+            self._commit()
         else:
             self._logger.debug("Invalid parameter count (%i), nothing done!", len(nspdfek)-1)
 
 
-    ## Returns a list including all transactions of an user
+    ## Returns one row per transaction of an user with its total, newest first
+    #
+    #  Paging works like in transactions(). The balance of the account,
+    #  i.e. the sum of all totals, is returned by balance().
+    #
+    #  \param account_id \b Integer that corresponds to an aid in table accounts
+    #  \param limit      \b Integer maximal number of transactions or None
+    #  \param before_tid \b Integer, only transactions after it in the history are returned, or None
+    #  \return           \b List of ntuples (tid, date, total) ordered descending by (date, tid).
+    #                       total is the sum of count*value in cents.
+    #
+    @_recordStats
+    def transactionTotals(self, account_id, limit=None, before_tid=None):
+        page = self._historyPage(account_id, before_tid)
+        if page is None:
+            return []
+        self.cur.execute("SELECT h.tid, h.date, (SELECT COALESCE(SUM(t.count*t.value), 0) \
+                                                   FROM transacts AS t \
+                                                  WHERE t.tid=h.tid) \
+                            FROM transheads AS h \
+                           WHERE " + page[0] + " \
+                        ORDER BY h.date DESC, h.tid DESC \
+                           LIMIT ?", page[1] + [limit if limit is not None else -1])
+        return self.cur.fetchall()
+
+
+    ## Returns a list including the transactions of an user, newest first
+    #
+    #  The transactions are ordered by date and by tid for the same date.
+    #  Without limit all transactions are returned. For paging pass the
+    #  last tid of the previous page as before_tid, which uses the index
+    #  transheads(aid, date) instead of skipping rows like OFFSET does.
+    #  If that transaction has been undone meanwhile, nothing is returned.
     #
     #  \param account_id \b Integer that corresponds to an aid in table accounts
-    #  \return           \b List of ntuples (tid, drinks.name, count, value, date).
-    #                       tid can occur multiple times and value is the cost of
-    #                       one bottle, i.e. it is negative.
+    #  \param limit      \b Integer maximal number of transactions (not rows) or None
+    #  \param before_tid \b Integer, only transactions after it in the history are returned, or None
+    #  \return           \b List of ntuples (tid, drinks.name, count, value, date)
+    #                       ordered descending by (date, tid). tid can occur
+    #                       multiple times and value is the cost of one
+    #                       bottle, i.e. it is negative.
     #
-    def transactions(self, account_id):
-        self.cur.execute("SELECT tid, name, count, value, date FROM (SELECT * FROM transacts WHERE aid=?) AS t \
-                 LEFT OUTER JOIN drinks \
-                              ON drinks.did=t.did \
-                        ORDER BY tid ASC", [account_id])
-        balance_list = self.cur.fetchall()
-        return balance_list
+    @_recordStats
+    def transactions(self, account_id, limit=None, before_tid=None):
+        page = self._historyPage(account_id, before_tid)
+        if page is None:
+            return []
+        self.cur.execute("SELECT t.tid, d.name, t.count, t.value, t.date \
+                            FROM (SELECT h.tid, h.date FROM transheads AS h \
+                                   WHERE " + page[0] + " \
+                                ORDER BY h.date DESC, h.tid DESC \
+                                   LIMIT ?) AS p \
+                            JOIN transacts AS t \
+                              ON t.tid=p.tid \
+                 LEFT OUTER JOIN drinks AS d \
+                              ON d.did=t.did \
+                        ORDER BY p.date DESC, p.tid DESC, t.did ASC", page[1] + [limit if limit is not None else -1])
+        return self.cur.fetchall()
 
 
     ## Reverses a credit/debit transaction
     #
     #  The given transaction will be deleted from transacts and if
-    #  drinks were consumed the drinks and kings tables will be
-    #  updated to reflect the reversion.
+    #  drinks were consumed the drinks, kings and leaderboard tables will
+    #  be updated to reflect the reversion.
     #
     #  \param transact_id \b Integer containing the tid to be deleted
-    #                        from table transacts.
+    #                        from table transacts. Raises ValueError if it's
+    #                        before the cutoff of closePeriod().
+    @_recordStats
+    @_retryOnBusy
     def undoTransaction(self, transact_id):
-        self.cur.execute("SELECT aid, did, count FROM transacts WHERE tid=?", [transact_id])
+        self.cur.execute("SELECT substr(date, 1, 7) FROM transheads WHERE tid=?", [transact_id])
+        months = [row[0] for row in self.cur.fetchall()]
+        for month in months:
+            self._checkOpen(month)
+        self._invalidateReports(months)
+        self.cur.execute("SELECT aid, did, count, value FROM transacts WHERE tid=?", [transact_id])
         aids_dids_counts = self.cur.fetchall()
         # Update drinks table
         for item in aids_dids_counts:
@@ -330,33 +1675,24 @@ class BimiBase:
                 full_empty = self.cur.fetchone()
                 self.cur.execute("UPDATE drinks SET bottles_full=?, bottles_empty=? WHERE did=?",
                                  [full_empty[0]+item[2], full_empty[1]-item[2], item[1]])
-        # Update kings table
+        # Update kings and leaderboard tables
+        self._updateKings([(item[0], item[1], -item[2]) for item in aids_dids_counts if item[1] != 0])
+        # Update balances table
         for item in aids_dids_counts:
-            if item[1] != 0:
-                self.cur.execute("SELECT quaffed FROM kings WHERE aid=? AND did=?", [item[0], item[1]])
-                actual_quaffed = self.cur.fetchone()
-                if actual_quaffed:
-                    self.cur.execute("UPDATE kings SET quaffed=? WHERE aid=? AND did=?", [actual_quaffed[0]-item[2], item[0], item[1]])
+            self._addBalance(item[0], -item[2]*item[3])
         # Update transacts table
         self.cur.execute("DELETE FROM transacts WHERE tid=?", [transact_id])
-        self.dbcon.commit()
+        self.cur.execute("DELETE FROM transheads WHERE tid=?", [transact_id])
+        self._commit()
 
 
-    ## Adds the consumed amount of drinks to the quaffed value in the table kings
+    ## Adds the consumed amount of drinks to the quaffed value in the tables kings and leaderboard
     #
     #  \param account_id        \b Integer that corresponds to an aid in table accounts
     #  \param drinkIDs_amounts  \b List that contains tuples (did, amount) to know the amount of drinks consumed
     #
+    @_recordStats
+    @_retryOnBusy
     def updateKing(self, account_id, drinkIDs_amounts):
-        for item in drinkIDs_amounts:
-            self.cur.execute("SELECT quaffed FROM kings WHERE aid=? AND did=?", [account_id, item[0]])
-
-            # check if account,drink combination is already in database
-            actual_quaffed = self.cur.fetchone()
-            if actual_quaffed:
-                # add number of quaffed drinks to existing number
-                self.cur.execute("UPDATE kings SET quaffed=? WHERE aid=? AND did=?",\
-                                  [actual_quaffed[0] + item[1], account_id, item[0]])
-            else:
-                self.cur.execute("INSERT INTO kings VALUES(?,?,?)", [account_id, item[0], item[1]])
-        self.dbcon.commit()
+        self._updateKings([(account_id, did, amount) for did, amount in drinkIDs_amounts])
+        self._commit()
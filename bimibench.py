@@ -0,0 +1,888 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8
+# ----------------------------------------------------------------------------#
+#    Copyright 2012 Julian Weitz                                              #
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    any later version.                                                       #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.    #
+# ----------------------------------------------------------------------------#
+import os, csv, sys, json, time, bisect, random, shutil, timeit, logging, argparse, datetime, platform, resource, tempfile
+import subprocess, multiprocessing
+from bimibase import BimiBase
+from bimiconfig import BimiConfig
+from bimiexport import BimiExport
+from bimimail import BimiMail
+from bimipool import BimiPool
+from bimiworker import BimiWorker
+from bimistats import BimiStats
+
+
+## Cursor proxy which counts the statements executed by BimiBase
+class CountingCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.count = 0
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, *args):
+        self.count += 1
+        return self.cursor.execute(*args)
+
+    def executemany(self, *args):
+        self.count += 1
+        return self.cursor.executemany(*args)
+
+
+## Creates a BimiBase in a temporary directory
+#
+#  By default commits aren't synced to disk, the benchmarks measure the
+#  statements and not the speed of the disk.
+#
+#  \param synchronous \b String containing the value of PRAGMA synchronous
+#  \param stats       \b BimiStats recording the statements, or None
+#
+#  \return \b Tuple (BimiBase, String containing the temporary directory)
+#
+def createBase(synchronous='OFF', stats=None):
+    tmp_dir = tempfile.mkdtemp(prefix='bimibench')
+    db = BimiBase(os.path.join(tmp_dir, 'bench.sqlite'), stats=stats)
+    db.cur.execute("PRAGMA synchronous=" + synchronous)
+    return db, tmp_dir
+
+
+## Fills db with accounts, drinks and tallies
+#
+#  \param db           \b BimiBase to be filled
+#  \param num_accounts \b Integer number of accounts to be added
+#  \param num_drinks   \b Integer number of drinks to be added
+#  \param num_tallies  \b Integer number of consumeDrinks calls per account
+#
+def populate(db, num_accounts, num_drinks, num_tallies):
+    rnd = random.Random(42)
+    for i in range(num_drinks):
+        db.addDrink(['Drink {0}'.format(i), rnd.randint(50, 200), 40, 8, 10**6, 0, True])
+    for i in range(num_accounts):
+        db.addAccount('Account {0}'.format(i), rnd.randint(0, 5000))
+    for aid, name in db.accounts():
+        for i in range(num_tallies):
+            db.consumeDrinks(aid, [(rnd.randint(1, num_drinks), rnd.randint(1, 5)) for j in range(rnd.randint(1, 3))])
+
+
+## Calls func repeat times and measures the statements and the time of the last call
+#
+#  \return \b Tuple (number of statements, seconds) of one call
+#
+def measure(db, func, repeat=3):
+    cursor = db.cur
+    db.cur = CountingCursor(cursor)
+    try:
+        for i in range(repeat):
+            db.cur.count = 0
+            start = time.time()
+            func()
+            duration = time.time() - start
+        return db.cur.count, duration
+    finally:
+        db.cur = cursor
+
+
+## consumeDrinks as it was implemented before it became a single transaction
+#
+#  One SELECT per drink, one INSERT and UPDATE per drink, a commit and
+#  another commit in the old read-modify-write updateKing. The balances
+#  table isn't updated, it didn't exist back then.
+#
+def legacyConsumeDrinks(db, account_id, drinkIDs_amounts):
+    drink_infos = {}
+    for item in drinkIDs_amounts:
+        db.cur.execute("SELECT sales_price,bottles_full,bottles_empty FROM drinks WHERE did=?", [item[0]])
+        data = db.cur.fetchone()
+        if item[0] in drink_infos:
+            buf = list(drink_infos[item[0]])
+            buf[0] += item[1]
+            drink_infos[item[0]] = tuple(buf)
+        else:
+            drink_infos[item[0]] = ((item[1]),) + data
+
+    new_tid = 0
+    for item in db.cur.execute("SELECT MAX(tid) FROM transacts"):
+        new_tid = (item[0] or 0)+1
+
+    for k,v in drink_infos.iteritems():
+        db.cur.execute("INSERT INTO transacts VALUES(?,?,?,?,?,?)", [new_tid, account_id, k, v[0], -v[1], datetime.datetime.now()])
+        db.cur.execute("UPDATE drinks SET bottles_full=?,bottles_empty=? WHERE did=?", [max(v[2]-v[0], 0), v[3]+v[0], k])
+    db.dbcon.commit()
+
+    for item in drinkIDs_amounts:
+        db.cur.execute("SELECT quaffed FROM kings WHERE aid=? AND did=?", [account_id, item[0]])
+        actual_quaffed = db.cur.fetchone()
+        if actual_quaffed:
+            db.cur.execute("UPDATE kings SET quaffed=? WHERE aid=? AND did=?", [actual_quaffed[0] + item[1], account_id, item[0]])
+        else:
+            db.cur.execute("INSERT INTO kings VALUES(?,?,?)", [account_id, item[0], item[1]])
+    db.dbcon.commit()
+
+
+## Compares the per account balance lookup formerly used by the summary
+#  mail with BimiBase.accountBalances()
+def benchSummary(options):
+    print('{0:>8} | {1:>12} {2:>10} | {3:>12} {4:>10}'.format('accounts', 'N+1 queries', 'N+1 ms', 'bulk queries', 'bulk ms'))
+    for num_accounts in options.accounts:
+        db, tmp_dir = createBase()
+        try:
+            populate(db, num_accounts, 10, options.tallies)
+
+            def perAccount():
+                return [(name, sum([x[2]*x[3] for x in db.transactions(aid)])) for aid, name in db.accounts()]
+
+            def bulk():
+                return [(name, balance) for aid, name, balance in db.accountBalances()]
+
+            if perAccount() != bulk():
+                print('Balances of both methods differ!')
+                return 1
+            old_queries, old_time = measure(db, perAccount)
+            new_queries, new_time = measure(db, bulk)
+            print('{0:>8} | {1:>12} {2:>10.2f} | {3:>12} {4:>10.2f}'.format(num_accounts, old_queries, old_time*1000,
+                                                                           new_queries, new_time*1000))
+        finally:
+            shutil.rmtree(tmp_dir)
+    return 0
+
+
+## Groups the rows of BimiBase.transactions() by tid like the transactions
+#  view did before BimiBase.transactionTotals() existed
+#
+#  \param size \b Integer number of transactions per call of BimiBase.transactions(), None for all at once
+#  \return     \b List of tuples (tid, date, total in cents) in the order of the history
+#
+def legacyTransactionTotals(db, account_id, size=None):
+    totals = []
+    before_tid = None
+    while True:
+        rows = db.transactions(account_id, size, before_tid)
+        for tid, name, count, value, date in rows:
+            if totals and totals[-1][0] == tid:
+                totals[-1][2] += count*value
+            else:
+                totals.append([tid, date.date(), count*value])
+        # A page not getting past before_tid would be read forever
+        if size is None or len(set([row[0] for row in rows])) < size or totals[-1][0] == before_tid:
+            return [tuple(item) for item in totals]
+        before_tid = totals[-1][0]
+
+
+## Reads all transactionTotals() of an account page by page like the transactions view
+def pagedTransactionTotals(db, account_id, size):
+    totals = []
+    before_tid = None
+    while True:
+        page = db.transactionTotals(account_id, size, before_tid)
+        totals += [(tid, date.date(), total) for tid, date, total in page]
+        if len(page) < size or page[-1][0] == before_tid:
+            return totals
+        before_tid = page[-1][0]
+
+
+## Checks that BimiBase.transactionTotals() matches the old Python grouping
+#  and compares the time needed for the first page of the transactions view
+#
+#  Whole histories and histories read in pages via before_tid are
+#  compared. Returns 1 on the first mismatch, so the exit code of
+#  'bimibench.py totals' can be used as a regression check.
+#
+def benchTotals(options):
+    db, tmp_dir = createBase()
+    try:
+        populate(db, options.accounts, 10, options.tallies)
+        # Backdated credits get newer tids than the tallies and the same date, like opening balances
+        past = datetime.datetime.now() - datetime.timedelta(days=40)
+        db.importCredits([(aid, 100*i) for aid, name in db.accounts() for i in range(1, 4)], date=past)
+        for aid, name in db.accounts():
+            totals = [(tid, date.date(), total) for tid, date, total in db.transactionTotals(aid)]
+            if totals != legacyTransactionTotals(db, aid):
+                print('Totals of account {0} differ from the Python grouping!'.format(aid))
+                return 1
+            for size in [1, 7, 50]:
+                if pagedTransactionTotals(db, aid, size) != totals or legacyTransactionTotals(db, aid, size) != totals:
+                    print('Pages of {0} transactions of account {1} differ from the whole history!'.format(size, aid))
+                    return 1
+            if sum([item[2] for item in totals]) != db.balance(aid):
+                print('Totals of account {0} differ from its balance!'.format(aid))
+                return 1
+        print('Totals of {0} accounts match the Python grouping, also in pages.'.format(options.accounts))
+
+        aid = db.accounts()[0][0]
+        old_queries, old_time = measure(db, lambda: legacyTransactionTotals(db, aid)[:50])
+        new_queries, new_time = measure(db, lambda: db.transactionTotals(aid, 50))
+        print('{0:>12} | {1:>12} {2:>10} | {3:>12} {4:>10}'.format('transactions', 'old queries', 'old ms', 'new queries', 'new ms'))
+        print('{0:>12} | {1:>12} {2:>10.2f} | {3:>12} {4:>10.2f}'.format(options.tallies+4, old_queries, old_time*1000,
+                                                                       new_queries, new_time*1000))
+    finally:
+        shutil.rmtree(tmp_dir)
+    return 0
+
+
+## Compares BimiConfig.option() and config() with the BimiConfig.settings() snapshot
+def benchConfig(options):
+    BimiConfig.load(options.config)
+    results = [('option(\'deposit\')', lambda: BimiConfig.option('deposit')),
+               ('settings().deposit', lambda: BimiConfig.settings().deposit),
+               ('option(\'summary_mail_text\')', lambda: BimiConfig.option('summary_mail_text')),
+               ('settings().summary_mail_text', lambda: BimiConfig.settings().summary_mail_text),
+               ('config()', BimiConfig.config),
+               ('settings()', BimiConfig.settings),
+               ('reloadIfChanged()', BimiConfig.reloadIfChanged)]
+    print('{0:>30} | {1:>12}'.format('accessor', 'ns per call'))
+    for name, func in results:
+        seconds = min(timeit.repeat(func, number=options.number, repeat=3))
+        print('{0:>30} | {1:>12.0f}'.format(name, seconds/options.number*1e9))
+    return 0
+
+
+## The query of BimiBase.kings() before the leaderboard table existed
+#
+#  Sums up table kings per account and drink name on every call and
+#  returns one arbitrary account of those sharing the first place.
+#
+def legacyKings(db):
+    db.cur.execute('''SELECT name, dname, MAX(total)
+                      FROM (SELECT k.aid, d.name AS dname, SUM(k.quaffed) AS total
+                            FROM kings AS k
+                            JOIN drinks AS d ON k.did=d.did
+                            WHERE d.name IN (SELECT DISTINCT name FROM drinks WHERE kings=1 AND deleted=0)
+                            GROUP BY k.aid, d.name) AS b
+                      JOIN accounts AS a ON b.aid=a.aid
+                      GROUP BY dname
+                      ORDER BY name ASC''')
+    return db.cur.fetchall()
+
+
+## Checks BimiBase.kings() against legacyKings and compares their time
+def benchKings(options):
+    print('{0:>8} | {1:>10} | {2:>10} {3:>12}'.format('accounts', 'old ms', 'kings ms', 'top 3 ms'))
+    for num_accounts in options.accounts:
+        db, tmp_dir = createBase()
+        try:
+            populate(db, num_accounts, options.drinks, options.tallies)
+            # Drinks sharing a name form one product
+            for did, name in db.cur.execute("SELECT did, name FROM drinks WHERE did%2=0").fetchall():
+                db.setDrink(did, ['Drink {0}'.format(did-1), 100, 50, 8, 100, 0, True])
+            old = dict([(dname, quaffed) for name, dname, quaffed in legacyKings(db)])
+            new = dict([(dname, quaffed) for name, dname, quaffed in db.kings()])
+            if old != new:
+                print('Kings differ from the old query!')
+                return 1
+            old_time = measure(db, lambda: legacyKings(db))[1]
+            kings_time = measure(db, db.kings)[1]
+            top_time = measure(db, lambda: db.leaderboard(3))[1]
+            print('{0:>8} | {1:>10.2f} | {2:>10.2f} {3:>12.2f}'.format(num_accounts, old_time*1000,
+                                                                      kings_time*1000, top_time*1000))
+        finally:
+            shutil.rmtree(tmp_dir)
+    return 0
+
+
+## Times BimiBase.check() on a generated history with a few broken rows
+def benchCheck(options):
+    db, tmp_dir = createBase()
+    try:
+        populate(db, options.accounts, options.drinks, 0)
+        rnd = random.Random(42)
+        start = time.time()
+        db.importDrinks((rnd.randint(1, options.accounts), rnd.randint(1, options.drinks), rnd.randint(1, 3))
+                        for i in xrange(options.rows))
+        print('Imported {0} transactions in {1:.1f}s.'.format(options.rows, time.time() - start))
+
+        db.cur.execute("UPDATE kings SET quaffed=quaffed+1 WHERE rowid IN (SELECT rowid FROM kings LIMIT 3)")
+        db.cur.execute("UPDATE balances SET balance=balance-100 WHERE aid=1")
+        db.cur.execute("DELETE FROM transheads WHERE tid IN (SELECT tid FROM transheads LIMIT 2)")
+        db.cur.execute("UPDATE drinks SET bottles_empty=-1 WHERE did=1")
+        db.dbcon.commit()
+
+        for repair in [False, True, False]:
+            start = time.time()
+            mismatches = db.check(repair)
+            print('check(repair={0}): {1} mismatches in {2:.2f}s'.format(repair, len(mismatches), time.time() - start))
+        return 0 if not mismatches else 1
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+## Exports all transactions as csv the way it was done before BimiBase.iterTransactions()
+def legacyExport(db, output):
+    db.cur.execute("SELECT t.tid, t.aid, d.name, t.count, t.value, t.date \
+                      FROM transacts AS t \
+           LEFT OUTER JOIN drinks AS d \
+                        ON d.did=t.did \
+                  ORDER BY t.tid ASC, t.did ASC")
+    rows = db.cur.fetchall()
+    names = dict(db.accounts())
+    writer = csv.writer(output)
+    writer.writerow(BimiExport.tables['transactions'])
+    for tid, aid, drink, count, value, date in rows:
+        writer.writerow([tid, unicode(date), aid, names.get(aid).encode('utf-8'), drink.encode('utf-8') if drink else None,
+                         count, '{0:.2f}'.format(value/100.0), '{0:.2f}'.format(count*value/100.0)])
+
+
+## Exports the transactions in a child process and puts its time and peak RSS into queue
+#
+#  \param variant \b String, 'fetchall' for legacyExport or 'iterate' for BimiExport.write
+#
+def exportProcess(path, variant, queue):
+    db = BimiBase(path, read_only=True)
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    with open(os.devnull, 'wb') as output:
+        if variant == 'fetchall':
+            legacyExport(db, output)
+        else:
+            BimiExport.write(db, 'transactions', output)
+    queue.put( (time.time() - start, base_rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) )
+
+
+## Generates the data base of benchExport() and puts its directory and the time into queue
+def exportBaseProcess(options, queue):
+    db, tmp_dir = createBase()
+    populate(db, options.accounts, options.drinks, 0)
+    rnd = random.Random(42)
+    start = time.time()
+    db.importDrinks((rnd.randint(1, options.accounts), rnd.randint(1, options.drinks), rnd.randint(1, 3))
+                    for i in xrange(options.rows))
+    db.dbcon.close()
+    queue.put( (tmp_dir, time.time() - start) )
+
+
+## Compares time and peak RSS of exporting all transactions with fetchall and with the iterators
+#
+#  The data base is generated in a child process and every export runs in
+#  a process of its own, so neither the memory freed by the generation nor
+#  the peak RSS of the other export hides the one measured.
+#
+def benchExport(options):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=exportBaseProcess, args=(options, queue))
+    process.start()
+    tmp_dir, seconds = queue.get()
+    process.join()
+    try:
+        path = os.path.join(tmp_dir, 'bench.sqlite')
+        print('Imported {0} transactions in {1:.1f}s, {2:.1f} MiB.'.format(options.rows, seconds,
+                                                                          os.path.getsize(path)/1024.0**2))
+
+        print('{0:<10} {1:>10} {2:>14} {3:>14}'.format('variant', 'seconds', 'base RSS MiB', 'peak RSS MiB'))
+        for variant in options.variants:
+            process = multiprocessing.Process(target=exportProcess, args=(path, variant, queue))
+            process.start()
+            seconds, base_rss, peak_rss = queue.get()
+            process.join()
+            print('{0:<10} {1:>10.1f} {2:>14.1f} {3:>14.1f}'.format(variant, seconds, base_rss/1024.0, peak_rss/1024.0))
+        return 0
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+## Compares BimiBase.check() on several floors, one after another and in parallel by BimiPool.map()
+#
+#  check() reads all transactions, so it stands for the expensive reads of
+#  the cross floor reports. Every floor is a copy of the same data base.
+#  Both variants run in the workers of the pool after one warm up, the
+#  speedup is limited by the number of CPU cores. The pool runs in
+#  parallel even with a single CPU, which it wouldn't do by default.
+#
+def benchFloors(options):
+    db, tmp_dir = createBase()
+    try:
+        populate(db, options.accounts, options.drinks, 0)
+        rnd = random.Random(42)
+        db.importDrinks((rnd.randint(1, options.accounts), rnd.randint(1, options.drinks), rnd.randint(1, 3))
+                        for i in xrange(options.rows))
+        db.dbcon.close()
+        paths = []
+        for i in range(options.floors):
+            paths.append(os.path.join(tmp_dir, 'floor{0}.sqlite'.format(i)))
+            shutil.copy(os.path.join(tmp_dir, 'bench.sqlite'), paths[-1])
+
+        pool = BimiPool(paths, BimiBase, parallel=True)
+        try:
+            pool.map(BimiBase.check)
+            start = time.time()
+            for path in paths:
+                BimiWorker.wait(pool.worker(path).submit(BimiBase.check))
+            sequential = time.time() - start
+            start = time.time()
+            pool.map(BimiBase.check)
+            parallel = time.time() - start
+        finally:
+            pool.stop()
+        print('{0} floors with {1} transactions, {2} CPUs'.format(options.floors, options.rows,
+                                                                  multiprocessing.cpu_count()))
+        print('sequential {0:.2f}s, parallel {1:.2f}s, speedup {2:.1f}x'.format(sequential, parallel,
+                                                                                sequential/parallel))
+        return 0
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+## Data source for BimiMail.summary() returning generated rows instead of
+#  querying a data base, so only the rendering is measured
+class MailRows:
+    def __init__(self, num_accounts, num_drinks):
+        rnd = random.Random(42)
+        self.balances = [(aid, u'Account {0}'.format(aid), rnd.randint(-5000, 5000)) for aid in range(num_accounts)]
+        self.kings_rows = [(u'Account {0}'.format(rnd.randint(0, num_accounts)), u'Drink {0}'.format(did), rnd.randint(1, 999))
+                           for did in range(num_drinks)]
+
+    def accountBalances(self):
+        return iter(self.balances)
+
+    def kings(self):
+        return iter(self.kings_rows)
+
+
+## Renders the summary mail for growing numbers of accounts
+def benchMail(options):
+    BimiConfig.load(options.config)
+    print('{0:>8} | {1:>10} {2:>12} {3:>10}'.format('accounts', 'ms', 'us/account', 'KiB'))
+    for num_accounts in options.accounts:
+        rows = MailRows(num_accounts, options.drinks)
+        seconds = min(timeit.repeat(lambda: BimiMail.summary(rows), number=1, repeat=3))
+        size = len(BimiMail.summary(rows)['body'].encode('utf-8'))
+        print('{0:>8} | {1:>10.2f} {2:>12.2f} {3:>10.1f}'.format(num_accounts, seconds*1000,
+                                                                  seconds/max(num_accounts, 1)*1e6, size/1024.0))
+    return 0
+
+
+## Compares tallies per second of legacyConsumeDrinks and BimiBase.consumeDrinks
+def benchTallies(options):
+    rnd = random.Random(42)
+    tallies = [(rnd.randint(1, 30), [(rnd.randint(1, 30), rnd.randint(1, 5)) for j in range(options.drinks)])
+               for i in range(options.tallies)]
+    print('{0:>8} | {1:>12} {2:>10} | {3:>12} {4:>10}'.format('tallies', 'old tally/s', 'old stmts', 'new tally/s', 'new stmts'))
+    results = []
+    for consume in [lambda aid, dids_amounts: legacyConsumeDrinks(db, aid, dids_amounts),
+                    lambda aid, dids_amounts: db.consumeDrinks(aid, dids_amounts)]:
+        db, tmp_dir = createBase(options.synchronous)
+        try:
+            populate(db, 30, 30, 0)
+
+            def tally():
+                for aid, dids_amounts in tallies:
+                    consume(aid, dids_amounts)
+
+            statements, duration = measure(db, tally, 1)
+            results += [len(tallies)/duration, statements/len(tallies)]
+        finally:
+            shutil.rmtree(tmp_dir)
+    print('{0:>8} | {1:>12.1f} {2:>10} | {3:>12.1f} {4:>10}'.format(len(tallies), *results))
+    return 0
+
+
+## Calls every public BimiBase method, prints their statistics and the query plans of all statements
+def benchStats(options):
+    stats = BimiStats()
+    db, tmp_dir = createBase(stats=stats)
+    try:
+        populate(db, options.accounts, options.drinks, options.tallies)
+        db.addDrink(['Drink 0', 150, 40, 8, 100, 0, True])
+        db.setDrink(1, ['Drink 0', 120, 40, 8, 100, 0, True])
+        db.setAccountName(1, 'Renamed')
+        db.addCredit(2, 500)
+        db.updateKing(2, [(1, 1)])
+        db.importCredits([(2, 100), (3, 200)])
+        db.importDrinks([(2, 1, 1), (3, 2, 2)])
+        for aid, name in db.accounts()[:options.accounts/2]:
+            db.balance(aid)
+            totals = db.transactionTotals(aid, 20)
+            db.transactions(aid, 20, totals[-1][0] if totals else None)
+        for i in range(10):
+            db.accountBalances()
+            db.balances()
+            db.drinks()
+            db.kings()
+            db.leaderboard(3)
+            db.generation()
+        db.undoTransaction(db.transactionTotals(2, 1)[0][0])
+        db.delDrink(2)
+        db.delAccount(3)
+        db.rebuildBalances()
+        db.check()
+        print(stats.report(20))
+        print('')
+        print(stats.explain(BimiBase(db.dbcon.execute("PRAGMA database_list").fetchone()[2], read_only=True)))
+        return 0
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+## Names of the drinks of generateBase(), further drinks get a number appended
+DRINK_NAMES = [u'Pils', u'Export', u'Weizen', u'Radler', u'Kölsch', u'Cola', u'Mate', u'Spezi', u'Apfelschorle', u'Wasser']
+FIRST_NAMES = [u'Anna', u'Jörg', u'Lena', u'Max', u'Sören', u'Julia', u'Ahmet', u'Marie', u'Lukas', u'Zoë', u'Jan', u'Friederike']
+
+
+## Fills an empty db with a generated history
+#
+#  Accounts and drinks are picked with log-normal distributed weights,
+#  so some accounts drink a lot more than others and a few drinks sell
+#  best, like on a real floor. The transactions are spread over days, one importCredits() and
+#  one importDrinks() per day, and every 16th transaction is a credit.
+#  Every tenth drink gets a more expensive successor with the same name
+#  halfway through the history and is deleted at the end.
+#
+#  \param db               \b BimiBase without accounts and drinks
+#  \param num_accounts     \b Integer number of accounts
+#  \param num_drinks       \b Integer number of drinks, not counting the successors
+#  \param num_transactions \b Integer number of transactions
+#  \param days             \b Integer number of days the history covers, ending today
+#  \param seed             \b Integer seed of the random numbers, equal seeds generate equal histories
+#
+def generateBase(db, num_accounts, num_drinks, num_transactions, days=730, seed=42):
+    rnd = random.Random(seed)
+    for i in range(num_drinks):
+        name = DRINK_NAMES[i % len(DRINK_NAMES)]
+        if i >= len(DRINK_NAMES):
+            name += u' {0}'.format(i/len(DRINK_NAMES) + 1)
+        price = rnd.choice([80, 100, 120, 150, 200])
+        db.addDrink([name.encode('utf-8'), price, price*7/10, rnd.choice([8, 15, 25]), 10**6, 0, rnd.random() < 0.8])
+    successors = {}
+    for did in range(10, num_drinks + 1, 10):
+        db.cur.execute("SELECT name, sales_price, purchase_price, deposit FROM drinks WHERE did=?", [did])
+        name, price, purchase_price, deposit = db.cur.fetchone()
+        db.addDrink([name.encode('utf-8'), price + 20, purchase_price + 10, deposit, 10**6, 0, True])
+        successors[did] = num_drinks + len(successors) + 1
+    for i in range(num_accounts):
+        name = u'{0} {1}. {2}'.format(rnd.choice(FIRST_NAMES), chr(ord('A') + rnd.randint(0, 25)), i + 1)
+        db.addAccount(name.encode('utf-8'))
+
+    account_weights = cumulativeWeights([rnd.lognormvariate(0, 1) for i in range(num_accounts)])
+    drink_weights = cumulativeWeights([rnd.lognormvariate(0, 1.2) for i in range(num_drinks)])
+    first_day = datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days - 1), datetime.time(20))
+    for day in range(days):
+        count = num_transactions*(day + 1)/days - num_transactions*day/days
+        date = first_day + datetime.timedelta(day)
+        num_credits = count/16
+        db.importCredits([(bisect.bisect(account_weights, rnd.random()*account_weights[-1]) + 1,
+                           rnd.choice([500, 1000, 2000, 5000])) for i in range(num_credits)], date=date)
+        tallies = []
+        for i in range(count - num_credits):
+            did = bisect.bisect(drink_weights, rnd.random()*drink_weights[-1]) + 1
+            if day >= days/2:
+                did = successors.get(did, did)
+            tallies.append( (bisect.bisect(account_weights, rnd.random()*account_weights[-1]) + 1,
+                             did, 1 if rnd.random() < 0.8 else rnd.randint(2, 6)) )
+        db.importDrinks(tallies, date=date)
+    for did in successors:
+        db.delDrink(did)
+
+
+## Returns the running sums of weights, for picking indexes with bisect
+def cumulativeWeights(weights):
+    sums = []
+    total = 0.0
+    for weight in weights:
+        total += weight
+        sums.append(total)
+    return sums
+
+
+## Generates a data base file with generateBase()
+def benchGenerate(options):
+    if os.path.exists(options.path):
+        print('{0} already exists!'.format(options.path))
+        return 1
+    start = time.time()
+    db = BimiBase(os.path.abspath(options.path))
+    db.cur.execute("PRAGMA synchronous=OFF")
+    generateBase(db, options.accounts, options.drinks, options.transactions, options.days, options.seed)
+    print('Generated {0} accounts, {1} drinks and {2} transactions in {3:.1f}s, {4:.1f} MiB.'.format(
+          options.accounts, options.drinks, options.transactions, time.time() - start,
+          os.path.getsize(options.path)/1024.0**2))
+    return 0
+
+
+## Calls every function once and returns the statistics of their durations
+#
+#  \param calls \b List of functions without arguments
+#  \return      \b Dictionary containing 'calls', 'min_ms', 'median_ms', 'max_ms' and 'total_ms'
+#
+def timeCalls(calls):
+    durations = []
+    for call in calls:
+        start = time.time()
+        call()
+        durations.append(time.time() - start)
+    durations.sort()
+    return {'calls': len(durations), 'min_ms': durations[0]*1000, 'median_ms': durations[len(durations)/2]*1000,
+            'max_ms': durations[-1]*1000, 'total_ms': sum(durations)*1000}
+
+
+## Yields tuples (operation name, list of functions) of the suite
+#
+#  The functions of an operation have to be called before the next one is
+#  requested, the writes depend on each other.
+#
+def suiteOperations(db, options):
+    rnd = random.Random(options.seed)
+    aids = [aid for aid, name in db.accounts()]
+    dids = [drink[0] for drink in db.drinks()]
+    db.cur.execute("SELECT aid FROM transheads GROUP BY aid ORDER BY COUNT(*) DESC LIMIT 1")
+    busiest = db.cur.fetchone()[0]
+
+    yield 'accounts', [db.accounts]*options.repeat
+    yield 'drinks', [db.drinks]*options.repeat
+    yield 'kings', [db.kings]*options.repeat
+    yield 'transactions(page)', [lambda: db.transactions(busiest, 50)]*options.repeat
+    yield 'transactions(all)', [lambda: db.transactions(busiest)]*options.repeat
+    yield 'transactionTotals(page)', [lambda: db.transactionTotals(busiest, 50)]*options.repeat
+    yield 'summary mail', [lambda: BimiMail.summary(db)]*options.repeat
+    yield 'consumeDrinks', [lambda aid=rnd.choice(aids), dids_amounts=[(rnd.choice(dids), rnd.randint(1, 3))]:
+                            db.consumeDrinks(aid, dids_amounts) for i in range(options.writes)]
+    yield 'addCredit', [lambda aid=rnd.choice(aids), credit=rnd.choice([500, 1000]): db.addCredit(aid, credit)
+                        for i in range(options.writes)]
+    db.cur.execute("SELECT tid FROM transheads ORDER BY tid DESC LIMIT ?", [options.writes])
+    yield 'undoTransaction', [lambda tid=tid: db.undoTransaction(tid) for tid, in db.cur.fetchall()]
+    yield 'delAccount', [lambda aid=aid: db.delAccount(aid) for aid in rnd.sample(aids, min(options.deletes, len(aids)))]
+
+
+## Returns the git revision of the benchmarked code or None
+def gitRevision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=devnull,
+                                           cwd=os.path.dirname(os.path.realpath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+## Runs the operations of suiteOperations() on generated data bases and writes the results as json
+#
+#  Generated data bases are kept in --cache-dir if given, every size is
+#  benchmarked on a copy of them.
+#
+def benchSuite(options):
+    BimiConfig.load(options.config)
+    cache_dir = options.cache_dir or tempfile.mkdtemp(prefix='bimibench')
+    results = []
+    sqlite_version = None
+    print('{0:>8} {1:>10} | {2:<24} {3:>6} {4:>10} {5:>10} {6:>10}'.format('accounts', 'transacts', 'operation',
+                                                                          'calls', 'min ms', 'median ms', 'max ms'))
+    try:
+        for num_transactions in options.transactions:
+            for num_accounts in options.accounts:
+                path = os.path.join(cache_dir, 'generated_{0}_{1}_{2}_{3}_{4}.sqlite'.format(
+                                    num_accounts, options.drinks, num_transactions, options.days, options.seed))
+                if not os.path.isfile(path):
+                    db = BimiBase(path)
+                    db.cur.execute("PRAGMA synchronous=OFF")
+                    generateBase(db, num_accounts, options.drinks, num_transactions, options.days, options.seed)
+                    db.dbcon.close()
+                tmp_dir = tempfile.mkdtemp(prefix='bimibench')
+                try:
+                    shutil.copy(path, os.path.join(tmp_dir, 'bench.sqlite'))
+                    db = BimiBase(os.path.join(tmp_dir, 'bench.sqlite'))
+                    db.cur.execute("PRAGMA synchronous=" + options.synchronous)
+                    sqlite_version = db.cur.execute("SELECT sqlite_version()").fetchone()[0]
+                    for operation, calls in suiteOperations(db, options):
+                        result = timeCalls(calls)
+                        result.update({'accounts': num_accounts, 'drinks': options.drinks,
+                                       'transactions': num_transactions, 'operation': operation})
+                        results.append(result)
+                        print('{accounts:>8} {transactions:>10} | {operation:<24} {calls:>6} {min_ms:>10.2f} '
+                              '{median_ms:>10.2f} {max_ms:>10.2f}'.format(**result))
+                    db.dbcon.close()
+                finally:
+                    shutil.rmtree(tmp_dir)
+    finally:
+        if options.cache_dir is None:
+            shutil.rmtree(cache_dir)
+
+    report = {'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+              'revision': gitRevision(),
+              'python': platform.python_version(),
+              'sqlite': sqlite_version,
+              'platform': platform.platform(),
+              'options': {'days': options.days, 'seed': options.seed, 'repeat': options.repeat,
+                          'writes': options.writes, 'deletes': options.deletes, 'synchronous': options.synchronous},
+              'results': results}
+    if options.output is not None:
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=1, sort_keys=True)
+    if options.compare is not None:
+        compareSuite(options.compare, report)
+    return 0
+
+
+## Prints the median times of a previous suite run next to the ones of report
+def compareSuite(path, report):
+    with open(path, 'r') as old_file:
+        old = json.load(old_file)
+    old_medians = dict([((item['accounts'], item['drinks'], item['transactions'], item['operation']), item['median_ms'])
+                        for item in old['results']])
+    print('')
+    print('Compared with {0} (revision {1}, {2}):'.format(path, old.get('revision'), old.get('date')))
+    print('{0:>8} {1:>10} | {2:<24} {3:>10} {4:>10} {5:>7}'.format('accounts', 'transacts', 'operation',
+                                                                  'old ms', 'new ms', 'ratio'))
+    for item in report['results']:
+        old_median = old_medians.get((item['accounts'], item['drinks'], item['transactions'], item['operation']))
+        if old_median is None:
+            continue
+        print('{0:>8} {1:>10} | {2:<24} {3:>10.2f} {4:>10.2f} {5:>7.2f}'.format(
+              item['accounts'], item['transactions'], item['operation'], old_median, item['median_ms'],
+              item['median_ms']/old_median if old_median > 0 else float('inf')))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(add_help=True, description='Benchmarks for the BimiTool data base')
+    subparsers = parser.add_subparsers()
+
+    summary_parser = subparsers.add_parser('summary', help="query count and time of the summary mail balances")
+    summary_parser.add_argument('--accounts', default=[50, 200, 1000], nargs='+', type=int,
+                                help="numbers of accounts to be benchmarked")
+    summary_parser.add_argument('--tallies', default=20, type=int,
+                                help="number of tallies per account")
+    summary_parser.set_defaults(func=benchSummary)
+
+    tallies_parser = subparsers.add_parser('tallies', help="tallies per second of consumeDrinks")
+    tallies_parser.add_argument('--tallies', default=500, type=int,
+                                help="number of consumeDrinks calls")
+    tallies_parser.add_argument('--drinks', default=3, type=int,
+                                help="number of drinks per tally")
+    tallies_parser.add_argument('--synchronous', default='FULL', choices=['OFF', 'NORMAL', 'FULL'],
+                                help="PRAGMA synchronous of the benchmark data base")
+    tallies_parser.set_defaults(func=benchTallies)
+
+    totals_parser = subparsers.add_parser('totals', help="check and time the per transaction totals, "
+                                                         "exits with 1 on a mismatch")
+    totals_parser.add_argument('--accounts', default=20, type=int,
+                               help="number of accounts to be checked")
+    totals_parser.add_argument('--tallies', default=2000, type=int,
+                               help="number of tallies per account")
+    totals_parser.set_defaults(func=benchTotals)
+
+    config_parser = subparsers.add_parser('config', help="time of the config accessors")
+    config_parser.add_argument('--config', default=None, type=str,
+                               help="path to a config file, default is bmt_config.yaml")
+    config_parser.add_argument('--number', default=100000, type=int,
+                               help="number of calls per accessor")
+    config_parser.set_defaults(func=benchConfig)
+
+    check_parser = subparsers.add_parser('check', help="time of the consistency check")
+    check_parser.add_argument('--rows', default=1000000, type=int,
+                              help="number of transactions")
+    check_parser.add_argument('--accounts', default=200, type=int,
+                              help="number of accounts")
+    check_parser.add_argument('--drinks', default=20, type=int,
+                              help="number of drinks")
+    check_parser.set_defaults(func=benchCheck)
+
+    export_parser = subparsers.add_parser('export', help="time and peak RSS of exporting all transactions")
+    export_parser.add_argument('--rows', default=10000000, type=int,
+                               help="number of transactions to be exported")
+    export_parser.add_argument('--accounts', default=500, type=int,
+                               help="number of accounts")
+    export_parser.add_argument('--drinks', default=30, type=int,
+                               help="number of drinks")
+    export_parser.add_argument('--variants', default=['iterate', 'fetchall'], nargs='+', choices=['iterate', 'fetchall'],
+                               help="exports to be measured, fetchall needs memory for all rows")
+    export_parser.set_defaults(func=benchExport)
+
+    floors_parser = subparsers.add_parser('floors', help="time of reading several floors one after another and in parallel")
+    floors_parser.add_argument('--floors', default=4, type=int,
+                               help="number of data bases")
+    floors_parser.add_argument('--rows', default=200000, type=int,
+                               help="number of transactions per data base")
+    floors_parser.add_argument('--accounts', default=200, type=int,
+                               help="number of accounts")
+    floors_parser.add_argument('--drinks', default=20, type=int,
+                               help="number of drinks")
+    floors_parser.set_defaults(func=benchFloors)
+
+    kings_parser = subparsers.add_parser('kings', help="check and time the kings and the leaderboard")
+    kings_parser.add_argument('--accounts', default=[50, 200, 1000], nargs='+', type=int,
+                              help="numbers of accounts to be benchmarked")
+    kings_parser.add_argument('--drinks', default=20, type=int,
+                              help="number of drinks, every two of them share a name")
+    kings_parser.add_argument('--tallies', default=20, type=int,
+                              help="number of tallies per account")
+    kings_parser.set_defaults(func=benchKings)
+
+    mail_parser = subparsers.add_parser('mail', help="rendering time of the summary mail")
+    mail_parser.add_argument('--accounts', default=[100, 1000, 10000, 100000], nargs='+', type=int,
+                             help="numbers of accounts to be rendered")
+    mail_parser.add_argument('--drinks', default=20, type=int,
+                             help="number of kings lines")
+    mail_parser.add_argument('--config', default=None, type=str,
+                             help="path to a config file, default is bmt_config.yaml")
+    mail_parser.set_defaults(func=benchMail)
+
+    stats_parser = subparsers.add_parser('stats', help="statement statistics and query plans of all BimiBase methods")
+    stats_parser.add_argument('--accounts', default=200, type=int,
+                              help="number of accounts")
+    stats_parser.add_argument('--drinks', default=20, type=int,
+                              help="number of drinks")
+    stats_parser.add_argument('--tallies', default=20, type=int,
+                              help="number of tallies per account")
+    stats_parser.set_defaults(func=benchStats)
+
+    generate_parser = subparsers.add_parser('generate', help="generate a data base with a realistic history")
+    generate_parser.add_argument('path', type=str,
+                                 help="path of the new data base file")
+    generate_parser.add_argument('--accounts', default=500, type=int,
+                                 help="number of accounts")
+    generate_parser.add_argument('--drinks', default=30, type=int,
+                                 help="number of drinks")
+    generate_parser.add_argument('--transactions', default=100000, type=int,
+                                 help="number of transactions")
+    generate_parser.add_argument('--days', default=730, type=int,
+                                 help="number of days covered by the history")
+    generate_parser.add_argument('--seed', default=42, type=int,
+                                 help="seed of the random numbers")
+    generate_parser.set_defaults(func=benchGenerate)
+
+    suite_parser = subparsers.add_parser('suite', help="time the BimiBase methods used by the GUI on generated data bases")
+    suite_parser.add_argument('--accounts', default=[50, 500, 5000], nargs='+', type=int,
+                              help="numbers of accounts to be benchmarked")
+    suite_parser.add_argument('--drinks', default=30, type=int,
+                              help="number of drinks")
+    suite_parser.add_argument('--transactions', default=[10000, 100000], nargs='+', type=int,
+                              help="numbers of transactions to be benchmarked")
+    suite_parser.add_argument('--days', default=730, type=int,
+                              help="number of days covered by the history")
+    suite_parser.add_argument('--seed', default=42, type=int,
+                              help="seed of the random numbers")
+    suite_parser.add_argument('--repeat', default=5, type=int,
+                              help="number of calls of every read")
+    suite_parser.add_argument('--writes', default=100, type=int,
+                              help="number of calls of consumeDrinks, addCredit and undoTransaction")
+    suite_parser.add_argument('--deletes', default=5, type=int,
+                              help="number of calls of delAccount")
+    suite_parser.add_argument('--synchronous', default='OFF', choices=['OFF', 'NORMAL', 'FULL'],
+                              help="PRAGMA synchronous of the benchmark data bases")
+    suite_parser.add_argument('--config', default=None, type=str,
+                              help="path to a config file with the summary mail, default is bmt_config.yaml")
+    suite_parser.add_argument('--cache-dir', default=None, dest='cache_dir', type=str,
+                              help="directory keeping the generated data bases for the next run")
+    suite_parser.add_argument('--output', default=None, type=str,
+                              help="json file the results are written to")
+    suite_parser.add_argument('--compare', default=None, type=str,
+                              help="json file of a previous run to compare the results with")
+    suite_parser.set_defaults(func=benchSuite)
+
+    options = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    sys.exit(options.func(options))
@@ -19,6 +19,7 @@ import os
 import sys
 import logging
 from copy import copy, deepcopy
+from collections import namedtuple
 
 try:
     import yaml
@@ -29,6 +30,36 @@ except ImportError:
     sys.exit(1)
 
 
+## The LibYAML based loader parses much faster, if PyYAML was built with it
+_YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+## Converts a config value to a unicode string
+def _text(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+
+## Converts a config value to a tuple of paths, a single path is a list of one
+def _paths(value):
+    if isinstance(value, basestring):
+        value = [value]
+    if not isinstance(value, (list, tuple)):
+        raise TypeError('{0!r} is not a list of paths'.format(value))
+    return tuple([str(path) for path in value]) or None
+
+
+## Read-only snapshot of all known config options, see BimiConfig.settings()
+BimiSettings = namedtuple('BimiSettings', ['db_path', 'db_paths', 'gui_path', 'mail_path', 'currency', 'deposit',
+                                           'num_comboboxes', 'mail_program', 'config_hot_reload',
+                                           'summary_mail_subject', 'summary_mail_text',
+                                           'credit_mail_subject', 'credit_mail_text', 'credit_mail_delay',
+                                           'db_journal_mode', 'db_synchronous', 'db_busy_timeout',
+                                           'db_cache_size', 'db_mmap_size', 'db_slow_query_ms', 'db_slow_query_log',
+                                           'backup_dir', 'backup_interval', 'backup_keep'])
+
+
 class BimiConfig:
     _logger = logging.getLogger('BimiConfig')
     _script_dir = os.path.realpath(os.path.dirname(sys.argv[0]))
@@ -41,6 +72,9 @@ class BimiConfig:
                             'currency': '€'.decode('utf-8'),
                             'deposit': 0.0,
                             'num_comboboxes': 4,
+                            'credit_mail_delay': 60,
+                            'backup_interval': 1440,
+                            'backup_keep': 7,
                             'mail_text':\
 """Guten Tag werter Flur,
 die aktuelle Abrechnung der Getränkeliste zeigt folgende Kontostände:
@@ -55,7 +89,18 @@ Auf ein munteres Weiterzechen!
 Euer BiMi"""               }
 
     _config_dict = _default_config_dict
-    _rm_opts = ['db_path', 'gui_path', 'mail_path'] ##< Options that will be removed before dumping the config
+    _rm_opts = ['db_path', 'db_paths', 'gui_path', 'mail_path'] ##< Options that will be removed before dumping the config
+
+    ## Type conversions of the options in BimiSettings, options without a value are None
+    _option_types = {'db_path': str, 'db_paths': _paths, 'gui_path': str, 'mail_path': str, 'currency': _text, 'deposit': float,
+                     'num_comboboxes': int, 'mail_program': str, 'config_hot_reload': bool,
+                     'summary_mail_subject': _text, 'summary_mail_text': _text,
+                     'credit_mail_subject': _text, 'credit_mail_text': _text, 'credit_mail_delay': int,
+                     'db_journal_mode': str, 'db_synchronous': str, 'db_busy_timeout': int,
+                     'db_cache_size': int, 'db_mmap_size': int, 'db_slow_query_ms': int, 'db_slow_query_log': str,
+                     'backup_dir': str, 'backup_interval': int, 'backup_keep': int}
+    _settings = None     ##< BimiSettings built from _config_dict, see settings()
+    _config_mtime = None ##< Modification time of the config file when it was loaded
 
 
     ## Returns a copy of _config_dict.
@@ -67,6 +112,26 @@ Euer BiMi"""               }
         return deepcopy(BimiConfig._config_dict)
 
 
+    ## Creates _settings from _config_dict
+    #
+    #  Values which can't be converted are logged and replaced by their
+    #  default or None.
+    #
+    @staticmethod
+    def _buildSettings():
+        values = {}
+        for field in BimiSettings._fields:
+            value = BimiConfig._config_dict.get(field)
+            if value is not None:
+                try:
+                    value = BimiConfig._option_types[field](value)
+                except (TypeError, ValueError, UnicodeDecodeError) as err:
+                    BimiConfig._logger.error('Option %s has an invalid value %r! Using default. [err: %s]', field, value, err)
+                    value = BimiConfig._default_config_dict.get(field)
+            values[field] = value
+        BimiConfig._settings = BimiSettings(**values)
+
+
     ## Loads config options from a file or sets the defaults
     #
     #  Raises exceptions if no file can be found at conf_file_path or if file
@@ -80,36 +145,38 @@ Euer BiMi"""               }
             BimiConfig._config_file_path = conf_file_path
 
         try:
+            BimiConfig._config_mtime = os.path.getmtime(BimiConfig._config_file_path)
             yaml_file = open(BimiConfig._config_file_path, 'r')
-        except IOError as io:
+        except (IOError, OSError) as io:
             if conf_file_path is None:
                 BimiConfig._logger.debug('No config file found. Writing one to %s', BimiConfig._config_file_path)
                 BimiConfig.writeConfig()
             else:
                 BimiConfig._logger.error('Reading file %s failed! Using default configuration. [io: %s]', BimiConfig._config_file_path, io)
+            BimiConfig._buildSettings()
             return
 
         try:
-            BimiConfig._config_dict = yaml.safe_load(yaml_file)
+            BimiConfig._config_dict = yaml.load(yaml_file, Loader=_YamlLoader)
         except yaml.YAMLError as yamlerr:
             yaml_file.close()
             BimiConfig._logger.error('%s is not a valid config file! Using default configuration. [yaml: %s]', BimiConfig._config_file_path, yamlerr)
+            BimiConfig._buildSettings()
             return
         yaml_file.close()
 
         if not BimiConfig._config_dict:
             BimiConfig._config_dict = BimiConfig._default_config_dict
             BimiConfig._logger.debug('No options specified in %s. Using default configuration.', BimiConfig._config_file_path)
-            return
         elif type(BimiConfig._config_dict) is not dict:
             BimiConfig._config_dict = BimiConfig._default_config_dict
             BimiConfig._logger.error('%s is not a valid config file! Using default configuration. [yaml: No dictionary found!]', BimiConfig._config_file_path)
-            return
-
-        # Check for mandatory but missing options
-        for k,v in BimiConfig._default_config_dict.items():
-            if BimiConfig.option(k) is None:
-                BimiConfig.setOption(k, v)
+        else:
+            # Check for mandatory but missing options
+            for k,v in BimiConfig._default_config_dict.items():
+                if k not in BimiConfig._config_dict or BimiConfig._config_dict[k] is None:
+                    BimiConfig._config_dict[k] = deepcopy(v)
+        BimiConfig._buildSettings()
 
 
     ## Returns a copy of the specified option or None if option was not found
@@ -126,6 +193,30 @@ Euer BiMi"""               }
             return None
 
 
+    ## Loads the config file again if it has been modified since it was loaded
+    #
+    #  Options which are never written to the config file (_rm_opts), e.g.
+    #  db_path set by a command line argument, keep their current values.
+    #
+    #  \return \b Bool, True if the config was reloaded
+    #
+    @staticmethod
+    def reloadIfChanged():
+        try:
+            mtime = os.path.getmtime(BimiConfig._config_file_path)
+        except OSError:
+            return False
+        if mtime == BimiConfig._config_mtime:
+            return False
+
+        BimiConfig._logger.debug('%s has been modified, reloading it.', BimiConfig._config_file_path)
+        kept_opts = dict([(k, BimiConfig._config_dict.get(k)) for k in BimiConfig._rm_opts])
+        BimiConfig.load()
+        BimiConfig._config_dict.update(kept_opts)
+        BimiConfig._buildSettings()
+        return True
+
+
     ## Sets the _config_dict to a copy of the given dictionary
     #
     #  \param conf_dict \b Dictionary (const) which will be copied and used as new config
@@ -133,6 +224,7 @@ Euer BiMi"""               }
     @staticmethod
     def setConfig(conf_dict):
         BimiConfig._config_dict = deepcopy(conf_dict)
+        BimiConfig._buildSettings()
         BimiConfig.writeConfig()
 
 
@@ -146,6 +238,22 @@ Euer BiMi"""               }
         if option not in BimiConfig._config_dict:
             BimiConfig._logger.debug('Adding option %s to _config_dict.',option)
         BimiConfig._config_dict[option] = deepcopy(value)
+        BimiConfig._buildSettings()
+
+
+    ## Returns the read-only snapshot of all known config options
+    #
+    #  The snapshot is validated and converted once when the config changes,
+    #  reading an attribute, e.g. BimiConfig.settings().deposit, doesn't copy
+    #  anything. Use option() for options not listed in BimiSettings.
+    #
+    #  \return \b BimiSettings (namedtuple)
+    #
+    @staticmethod
+    def settings():
+        if BimiConfig._settings is None:
+            BimiConfig._buildSettings()
+        return BimiConfig._settings
 
 
     ## Writes _config_dict to a yaml file.
@@ -0,0 +1,100 @@
+# vim: set fileencoding=utf-8
+# ----------------------------------------------------------------------------#
+#    Copyright 2012 Julian Weitz                                              #
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    any later version.                                                       #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.    #
+# ----------------------------------------------------------------------------#
+import csv, json
+from bimiconfig import BimiConfig
+
+
+## Exports accounts, drinks or transactions as csv or json lines
+#
+#  Every row is written as soon as it has been read with the iterators of
+#  BimiBase, so the memory needed doesn't grow with the history. Only the
+#  account names and balances are kept in memory. Money is written in the
+#  currency, not in cents. The balances of the accounts are reduced by the
+#  deposit of the config like in the GUI.
+#
+#  with open('transactions.csv', 'wb') as output:
+#      BimiExport.write(db, 'transactions', output)
+#
+class BimiExport:
+    formats = ['csv', 'jsonl']
+
+    ## Columns of the exported tables
+    tables = {'accounts': ['aid', 'name', 'balance'],
+              'drinks': ['did', 'name', 'sales_price', 'purchase_price', 'deposit', 'bottles_full', 'bottles_empty',
+                         'kings'],
+              'transactions': ['tid', 'date', 'aid', 'account', 'drink', 'count', 'value', 'total']}
+    _money = set(['balance', 'sales_price', 'purchase_price', 'deposit', 'value', 'total']) ##< Columns in the currency
+    _text = set(['name', 'date', 'account', 'drink'])                                      ##< Unicode columns, or None
+
+
+    ## Returns a generator of the rows of a table
+    #
+    #  \param db    \b BimiBase the rows are read from
+    #  \param table \b String, a key of tables
+    #  \return      \b Generator of tuples containing the columns of the table
+    #
+    @staticmethod
+    def rows(db, table):
+        if table == 'accounts':
+            balances = dict(db.balances())
+            deposit = BimiConfig.settings().deposit
+            return ((aid, name, balances.get(aid, 0)/100.0 - deposit) for aid, name in db.iterAccounts())
+        if table == 'drinks':
+            return ((did, name, sales/100.0, purchase/100.0, deposit/100.0, full, empty, bool(kings))
+                    for did, name, sales, purchase, deposit, full, empty, kings in db.iterDrinks())
+        names = dict(db.iterAccounts())
+        return ((tid, unicode(date), aid, names.get(aid), drink, count, value/100.0, count*value/100.0)
+                for tid, aid, drink, count, value, date in db.iterTransactions())
+
+
+    ## Writes a table to output
+    #
+    #  The values are converted by column, not by checking their types, as
+    #  this runs once per value. The keys of the json objects aren't
+    #  ordered, because the json module encodes plain dictionaries much
+    #  faster.
+    #
+    #  \param db          \b BimiBase the rows are read from
+    #  \param table       \b String, a key of tables
+    #  \param output      \b File the rows are written to
+    #  \param file_format \b String, 'csv' with a header line or 'jsonl' with one object per line
+    #  \return            \b Integer number of written rows
+    #
+    @staticmethod
+    def write(db, table, output, file_format='csv'):
+        columns = BimiExport.tables[table]
+        count = 0
+        if file_format == 'csv':
+            money = [i for i, column in enumerate(columns) if column in BimiExport._money]
+            text = [i for i, column in enumerate(columns) if column in BimiExport._text]
+            writer = csv.writer(output)
+            writer.writerow(columns)
+            for row in BimiExport.rows(db, table):
+                row = list(row)
+                for i in money:
+                    row[i] = '{0:.2f}'.format(row[i])
+                for i in text:
+                    if row[i] is not None:
+                        row[i] = row[i].encode('utf-8')
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in BimiExport.rows(db, table):
+                output.write(json.dumps(dict(zip(columns, row))) + '\n')
+                count += 1
+        return count
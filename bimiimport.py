@@ -0,0 +1,177 @@
+# vim: set fileencoding=utf-8
+# ----------------------------------------------------------------------------#
+#    Copyright 2012 Julian Weitz                                              #
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    any later version.                                                       #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.    #
+# ----------------------------------------------------------------------------#
+import csv, math, time, logging
+
+
+## Raised inside of BimiBase.batch() to roll back a dry run
+class _DryRun(Exception):
+    pass
+
+
+## Imports tally sheets and credits from csv files into a BimiBase
+#
+#  Tally files contain rows 'name,drink,count', credit files contain rows
+#  'name,credit' with credit as float in the currency of the config, e.g.
+#  12.50. An optional header row starting with 'name' is skipped. name is
+#  the name of an account or its aid, drink is the name of an available
+#  drink or its did. Ambiguous names are rejected.
+#
+#  The files are streamed row by row, names are resolved through maps
+#  built once when the BimiImport is created. All rows of one file are
+#  written in a single transaction.
+#
+class BimiImport:
+    max_rejected = 100      ##< Number of rejected rows which are kept in the report
+    max_credit = 10**9      ##< Largest absolute credit in cents accepted per row
+    max_count = 10**6       ##< Largest number of drinks accepted per row
+
+    def __init__(self, db):
+        self._logger = logging.getLogger('BimiImport')
+        self.db = db
+
+        self.accounts = {} ##< Maps account names and aids as strings to aids, None if the name is ambiguous
+        for aid, name in db.accounts():
+            self.accounts[name] = None if name in self.accounts else aid
+        for aid, name in db.accounts():
+            self.accounts[unicode(aid)] = aid
+
+        self.drinks = {} ##< Maps drink names and dids as strings to dids, None if the name is ambiguous
+        for item in db.drinks():
+            self.drinks[item[1]] = None if item[1] in self.drinks else item[0]
+            self.drinks[unicode(item[0])] = item[0]
+
+
+    ## Imports a credit file
+    #
+    #  \param path    \b String containing the path of the csv file
+    #  \param dry_run \b Bool, if True everything is checked and written but rolled back at the end
+    #  \return        \b Dictionary containing the report, see _run()
+    #
+    def credits(self, path, dry_run=False):
+        return self._run(path, 2, self._resolveCredit, self.db.importCredits, dry_run)
+
+
+    ## Imports a tally file
+    #
+    #  \param path    \b String containing the path of the csv file
+    #  \param dry_run \b Bool, if True everything is checked and written but rolled back at the end
+    #  \return        \b Dictionary containing the report, see _run()
+    #
+    def tallies(self, path, dry_run=False):
+        return self._run(path, 3, self._resolveTally, self.db.importDrinks, dry_run)
+
+
+    ## Returns a printable string of a report returned by credits() or tallies()
+    @staticmethod
+    def formatReport(report):
+        lines = [u'{0}: {1} rows read, {2} imported, {3} rejected in {4:.2f}s ({5:.0f} rows/s){6}'.format(
+                     report['path'], report['rows'], report['imported'], report['num_rejected'],
+                     report['seconds'], report['rows']/max(report['seconds'], 1e-6),
+                     ' [dry run, nothing written]' if report['dry_run'] else '')]
+        for line_num, reason in report['rejected']:
+            lines.append(u'  line {0}: {1}'.format(line_num, reason))
+        if report['num_rejected'] > len(report['rejected']):
+            lines.append(u'  ... {0} more'.format(report['num_rejected'] - len(report['rejected'])))
+        return u'\n'.join(lines)
+
+
+    ## Resolves a row of a credit file to (aid, credit in cents)
+    def _resolveCredit(self, row):
+        aid = self._resolveAccount(row[0])
+        try:
+            credit = float(row[1])
+        except ValueError:
+            raise ValueError(u"credit '{0}' is not a number".format(row[1]))
+        if math.isinf(credit) or math.isnan(credit) or abs(credit) > self.max_credit/100.0:
+            raise ValueError(u"credit '{0}' is out of range".format(row[1]))
+        return (aid, int(round(100*credit)))
+
+
+    ## Resolves a row of a tally file to (aid, did, count)
+    def _resolveTally(self, row):
+        aid = self._resolveAccount(row[0])
+        drink = row[1].strip()
+        if drink not in self.drinks:
+            raise ValueError(u"unknown drink '{0}'".format(drink))
+        if self.drinks[drink] is None:
+            raise ValueError(u"drink name '{0}' is ambiguous, use the drink id".format(drink))
+        try:
+            count = int(row[2])
+        except ValueError:
+            raise ValueError(u"count '{0}' is not an integer".format(row[2]))
+        if count <= 0:
+            raise ValueError("count {0} is not positive".format(count))
+        if count > self.max_count:
+            raise ValueError("count {0} is out of range".format(count))
+        return (aid, self.drinks[drink], count)
+
+
+    ## Resolves an account name or aid to the aid
+    def _resolveAccount(self, name):
+        name = name.strip()
+        if name not in self.accounts:
+            raise ValueError(u"unknown account '{0}'".format(name))
+        if self.accounts[name] is None:
+            raise ValueError(u"account name '{0}' is ambiguous, use the account id".format(name))
+        return self.accounts[name]
+
+
+    ## Streams path through resolve into write and collects the report
+    #
+    #  \param path      \b String containing the path of the csv file
+    #  \param num_cols  \b Integer number of columns a row must have
+    #  \param resolve   \b Function converting a list of unicode strings to a tuple for write
+    #  \param write     \b Function of BimiBase consuming an iterable of resolved tuples
+    #  \param dry_run   \b Bool, if True all writes get rolled back
+    #  \return          \b Dictionary containing path, rows, imported, num_rejected,
+    #                      rejected (list of (line number, reason)), seconds and dry_run
+    #
+    def _run(self, path, num_cols, resolve, write, dry_run):
+        report = {'path': path, 'rows': 0, 'imported': 0, 'num_rejected': 0,
+                  'rejected': [], 'seconds': 0.0, 'dry_run': dry_run}
+
+        def reject(line_num, reason):
+            report['num_rejected'] += 1
+            if len(report['rejected']) < self.max_rejected:
+                report['rejected'].append( (line_num, reason) )
+
+        def rows(csv_file):
+            for line_num, row in enumerate(csv.reader(csv_file), 1):
+                if not row or (line_num == 1 and row[0].strip().lower() == 'name'):
+                    continue
+                report['rows'] += 1
+                if len(row) != num_cols:
+                    reject(line_num, 'expected {0} columns, got {1}'.format(num_cols, len(row)))
+                    continue
+                try:
+                    yield resolve([col.decode('utf-8') for col in row])
+                except (ValueError, OverflowError, UnicodeDecodeError) as err:
+                    reject(line_num, unicode(err))
+
+        start = time.time()
+        with open(path, 'rb') as csv_file:
+            try:
+                with self.db.batch():
+                    report['imported'] = write(rows(csv_file))
+                    if dry_run:
+                        raise _DryRun()
+            except _DryRun:
+                pass
+        report['seconds'] = time.time() - start
+        self._logger.info('Imported %i of %i rows from %s', report['imported'], report['rows'], path)
+        return report
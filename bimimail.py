@@ -0,0 +1,255 @@
+# vim: set fileencoding=utf-8
+# ----------------------------------------------------------------------------#
+#    Copyright 2012 Julian Weitz                                              #
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    any later version.                                                       #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.    #
+# ----------------------------------------------------------------------------#
+import re
+from bimiconfig import BimiConfig
+
+
+## Generates the summary and credit mails from the templates in the config
+#
+#  Templates are compiled once into a render plan, which is cached until
+#  the template text in the config changes. A plan is a list of steps:
+#
+#    ('text', string)                    static lines
+#    ('kings', prefix, tokens)           one line per row of BimiBase.kings()
+#    ('accInfos', prefix, tokens)        one line per row of BimiBase.accountBalances()
+#
+#  tokens is a list of (is_field, string) tuples, string being either
+#  literal text or the name of a placeholder like $name. Rendering appends
+#  to a list which is joined once, so it's linear in the number of rows.
+#
+class BimiMail:
+    _plans = {} ##< Maps option names to tuples (template text, compiled plan)
+
+    ## Placeholders per line type. Only their first occurrence in a line gets substituted.
+    _line_fields = {'kings': ['name', 'drink', 'amount'],
+                    'accInfos': ['name', 'balance']}
+
+
+    ## Combines several mails into one
+    #
+    #  The body contains the subject and body of every mail, separated by a
+    #  line. The subject is the one of the first mail plus the number of
+    #  the other ones.
+    #
+    #  \param mails \b List of dictionaries containing 'body' and 'subject' strings
+    #  \return      \b Dictionary containing the 'body' and 'subject' strings of the combined mail
+    #
+    @staticmethod
+    def batch(mails):
+        if len(mails) == 1:
+            return mails[0]
+        body = []
+        for mail in mails:
+            if body:
+                body.append(u'\n' + u'-'*72 + u'\n\n')
+            body.append(mail['subject'] + u'\n\n' + mail['body'])
+        return {'subject': u'{0} (+{1} more)'.format(mails[0]['subject'], len(mails) - 1),
+                'body': u''.join(body)}
+
+
+    ## Returns the subject and body of the credit mail
+    #
+    #  \param account_name \b String containing the name of the account which recived the credit
+    #  \param credit       \b Float containing the amount of added credit
+    #  \return             \b Dictionary containing the 'body' and 'subject' strings of the credit mail
+    #
+    @staticmethod
+    def credit(account_name, credit):
+        settings = BimiConfig.settings()
+        values = {'amount': unicode(credit) + settings.currency, 'name': account_name}
+        return {'body': BimiMail._renderTokens(BimiMail._plan('credit_mail_text', ['amount', 'name']), values),
+                'subject': BimiMail._renderTokens(BimiMail._plan('credit_mail_subject', ['amount', 'name']), values)}
+
+
+    ## Returns the subject and body of the summary mail of several floors
+    #
+    #  The data bases are read in parallel by the workers of pool. The
+    #  accounts of all floors are listed with the names of their floors.
+    #  The kings are those who have consumed the most of a drink on any
+    #  floor, i.e. drinks are identified by their names.
+    #
+    #  \param pool \b BimiPool containing the data bases of the floors
+    #  \return     \b Dictionary containing the 'body' and 'subject' strings of the summary mail
+    #
+    @staticmethod
+    def floorSummary(pool):
+        kings = {}
+        accounts = []
+        for path, (floor_kings, floor_accounts) in pool.map(BimiMail._summaryData):
+            floor = pool.name(path).decode('utf-8')
+            for name, drink, quaffed in floor_kings or []:
+                best = kings.get(drink)
+                if best is None or best[0][2] < quaffed:
+                    kings[drink] = [(u'{0} ({1})'.format(name, floor), drink, quaffed)]
+                elif best[0][2] == quaffed:
+                    best.append( (u'{0} ({1})'.format(name, floor), drink, quaffed) )
+            for aid, name, balance in floor_accounts or []:
+                accounts.append( (aid, u'{0} ({1})'.format(name, floor), balance) )
+        kings = sorted([king for drink_kings in kings.values() for king in drink_kings])
+        return BimiMail._renderSummary(kings, accounts)
+
+
+    ## Returns the subject and body of the summary mail
+    #
+    #  BimiBase.kings() and accountBalances() are only called if the template
+    #  contains the corresponding line.
+    #
+    #  \param db \b BimiBase the data is read from
+    #  \return   \b Dictionary containing the 'body' and 'subject' strings of the summary mail
+    #
+    @staticmethod
+    def summary(db):
+        return BimiMail._renderSummary(*BimiMail._summaryData(db))
+
+
+    ## Returns the kings and accounts needed by the summary template, runs in the worker threads
+    #
+    #  \return \b Tuple (kings, accounts), None for the lines the template doesn't contain
+    #
+    @staticmethod
+    def _summaryData(db):
+        kinds = [step[0] for step in BimiMail._plan('summary_mail_text', None)]
+        return (db.kings() if 'kings' in kinds else None,
+                db.accountBalances() if 'accInfos' in kinds else None)
+
+
+    ## Compiles the summary mail template into a plan
+    @staticmethod
+    def _compileSummary(text):
+        plan = []
+        static = []
+        for line in text.split('\n'):
+            for kind in ['kings', 'accInfos']:
+                marker = '$' + kind + ':'
+                if marker in line:
+                    prefix, sep, pattern = line.partition(marker)
+                    if static:
+                        plan.append( ('text', u''.join(static)) )
+                        static = []
+                    plan.append( (kind, prefix, BimiMail._tokenize(pattern, BimiMail._line_fields[kind], True)) )
+                    break
+            else:
+                static.append(line + u'\n')
+        if static:
+            plan.append( ('text', u''.join(static)) )
+        return plan
+
+
+    ## Returns the cached plan of a template option, compiles it if the text has changed
+    #
+    #  \param option \b String containing the name of the template option in BimiSettings
+    #  \param fields \b List of placeholders substituted everywhere in the text, None for the summary template
+    #  \return       \b List of plan steps or tokens
+    #
+    @staticmethod
+    def _plan(option, fields):
+        text = getattr(BimiConfig.settings(), option) or u''
+        cached = BimiMail._plans.get(option)
+        if cached is None or cached[0] != text:
+            if fields is None:
+                plan = BimiMail._compileSummary(text)
+            else:
+                plan = BimiMail._tokenize(text, fields, False)
+            cached = (text, plan)
+            BimiMail._plans[option] = cached
+        return cached[1]
+
+
+    ## Appends one line per account to body
+    #
+    #  \param accounts \b Iterable of tuples (aid, name, balance in cents)
+    #
+    @staticmethod
+    def _renderAccInfos(body, prefix, tokens, accounts, deposit, cur_symbol):
+        names_balances = [(name, u'{0:.2f}'.format(balance/100.0 - deposit)) for aid, name, balance in accounts]
+        if not names_balances:
+            body.append(prefix + u'No one lives in BimiTool-land ;_;\n')
+            return
+        len_acc = max([len(item[0]) for item in names_balances])
+        len_balance = max([len(item[1]) for item in names_balances])
+        for name, balance in names_balances:
+            body.append(prefix)
+            body.append(BimiMail._renderTokens(tokens, {'name': name.ljust(len_acc),
+                                                        'balance': balance.rjust(len_balance) + cur_symbol}))
+            body.append(u'\n')
+
+
+    ## Appends one line per king to body
+    #
+    #  \param kings \b Iterable of tuples (account name, drink name, quaffed)
+    #
+    @staticmethod
+    def _renderKings(body, prefix, tokens, kings):
+        kings = [(name, drink, unicode(quaffed)) for name, drink, quaffed in kings]
+        if not kings:
+            body.append(prefix + u'The Rabble is delighted, there are no Kings and Queens!\n')
+            return
+        len_acc = max([len(item[0]) for item in kings])
+        len_drink = max([len(item[1]) for item in kings])
+        len_quaffed = max([len(item[2]) for item in kings])
+        for name, drink, quaffed in kings:
+            body.append(prefix)
+            body.append(BimiMail._renderTokens(tokens, {'name': name.ljust(len_acc),
+                                                        'drink': drink.ljust(len_drink),
+                                                        'amount': quaffed.rjust(len_quaffed)}))
+            body.append(u'\n')
+
+
+    ## Renders the summary template with the rows returned by _summaryData()
+    @staticmethod
+    def _renderSummary(kings, accounts):
+        settings = BimiConfig.settings()
+        body = []
+        for step in BimiMail._plan('summary_mail_text', None):
+            if step[0] == 'text':
+                body.append(step[1])
+            elif step[0] == 'kings':
+                BimiMail._renderKings(body, step[1], step[2], kings)
+            else:
+                BimiMail._renderAccInfos(body, step[1], step[2], accounts, settings.deposit, settings.currency)
+        return {'subject': settings.summary_mail_subject, 'body': u''.join(body)}
+
+
+    ## Joins tokens, replacing fields by their values
+    @staticmethod
+    def _renderTokens(tokens, values):
+        return u''.join([values[string] if is_field else string for is_field, string in tokens])
+
+
+    ## Splits text into literal and placeholder tokens
+    #
+    #  \param text       \b String containing placeholders like $name
+    #  \param fields     \b List of placeholder names without $
+    #  \param first_only \b Bool, if True only the first occurrence of every placeholder is a field
+    #  \return           \b List of tuples (is_field, string)
+    #
+    @staticmethod
+    def _tokenize(text, fields, first_only):
+        tokens = []
+        seen = set()
+        pos = 0
+        for match in re.finditer('|'.join([re.escape('$' + field) for field in fields]), text):
+            field = match.group()[1:]
+            if first_only and field in seen:
+                continue
+            seen.add(field)
+            tokens.append( (False, text[pos:match.start()]) )
+            tokens.append( (True, field) )
+            pos = match.end()
+        tokens.append( (False, text[pos:]) )
+        return tokens
@@ -0,0 +1,155 @@
+# vim: set fileencoding=utf-8
+# ----------------------------------------------------------------------------#
+#    Copyright 2012 Julian Weitz                                              #
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    any later version.                                                       #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.    #
+# ----------------------------------------------------------------------------#
+import os, threading, multiprocessing
+from bimiworker import BimiWorker
+
+
+## Keeps one BimiWorker, i.e. one open data base, per floor
+#
+#  Every floor has a data base file of its own. The worker of a floor is
+#  started when it's used for the first time and keeps its BimiBase until
+#  stop(), so switching between floors doesn't reopen anything. map()
+#  runs a function on all floors at once. Every worker is a thread of its
+#  own and sqlite3 releases the GIL while SQLite executes a statement, so
+#  the queries of different data bases run in parallel. With a single CPU
+#  the threads only compete for the GIL, there map() runs the floors one
+#  after another.
+#
+#  pool = BimiPool(['floor1.sqlite', 'floor2.sqlite'], openDataBase)
+#  for path, balances in pool.map(BimiBase.accountBalances):
+#      print(pool.name(path), balances)
+#  pool.stop()
+#
+class BimiPool:
+    ## Creates the pool, the workers are started by worker() or map()
+    #
+    #  \param paths           \b List of strings containing the paths of the data bases
+    #  \param open_db         \b Function returning the BimiBase of a path, called in the worker thread
+    #  \param idle_add        \b Function like GLib.idle_add(function, *args), None calls the
+    #                            callbacks right away in the worker threads
+    #  \param busy_callback   \b Function called with True when the first worker gets busy and with
+    #                            False when all are idle again, or None
+    #  \param failed_callback \b Function called with the path if a data base can't be opened, or None
+    #  \param parallel        \b Bool, if True map() runs all floors at once, None if there is more than one CPU
+    #
+    def __init__(self, paths, open_db, idle_add=None, busy_callback=None, failed_callback=None, parallel=None):
+        self.paths = list(paths)
+        self._names = dict(zip(self.paths, self.floorNames(self.paths)))
+        self._open_db = open_db
+        self._idle_add = idle_add or self._callNow
+        self._busy_callback = busy_callback
+        self._failed_callback = failed_callback
+        self.parallel = multiprocessing.cpu_count() > 1 if parallel is None else parallel
+        self._lock = threading.Lock() ##< Protects _workers and _num_busy
+        self._workers = {}            ##< Maps paths to started BimiWorkers
+        self._num_busy = 0            ##< Number of workers which have requests to run
+
+
+    ## Reports busy if the first worker gets busy and idle if the last one becomes idle
+    def _busy(self, busy):
+        with self._lock:
+            self._num_busy += 1 if busy else -1
+            changed = self._num_busy == (1 if busy else 0)
+        if changed:
+            self._busy_callback(busy)
+
+
+    ## Calls function with args in the calling thread, used without a main loop
+    @staticmethod
+    def _callNow(function, *args):
+        function(*args)
+
+
+    ## Returns unique names of the floors for the GUI and the reports
+    #
+    #  The name of a floor is the name of its data base file without
+    #  extension. If several files have the same name, e.g. every floor has
+    #  its own bmt_db.sqlite, the name of the directory is prepended.
+    #
+    #  \param paths \b List of strings containing the paths of the data bases
+    #  \return      \b List of strings in the order of paths
+    #
+    @staticmethod
+    def floorNames(paths):
+        stems = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+        names = [stem if stems.count(stem) == 1 else
+                 '{0}-{1}'.format(os.path.basename(os.path.dirname(os.path.abspath(path))), stem)
+                 for path, stem in zip(paths, stems)]
+        return [name if names.count(name) == 1 else '{0}-{1}'.format(name, i + 1) for i, name in enumerate(names)]
+
+
+    ## Runs func on all floors, in parallel if parallel is set, and waits for the results
+    #
+    #  Must not be called by a worker thread. If func fails on a floor, the
+    #  other floors are still waited for and the first exception is raised.
+    #
+    #  \param func  \b Function called as func(db, *args) in the worker threads, e.g. an unbound
+    #                  method of BimiBase
+    #  \param args  \b List of further arguments of func
+    #  \param paths \b List of paths of the floors, None for all
+    #  \return      \b List of tuples (path, return value of func) in the order of paths
+    #
+    def map(self, func, args=[], paths=None):
+        paths = self.paths if paths is None else paths
+        requests = []
+        if self.parallel:
+            requests = [self.worker(path).submit(func, args) for path in paths]
+        results = []
+        error = None
+        for i, path in enumerate(paths):
+            # The workers have already logged the errors
+            try:
+                request = requests[i] if requests else self.worker(path).submit(func, args)
+                results.append( (path, BimiWorker.wait(request)) )
+            except Exception as err:
+                error = error or err
+        if error is not None:
+            raise error
+        return results
+
+
+    ## Returns the name of a floor, see floorNames()
+    def name(self, path):
+        return self._names[path]
+
+
+    ## Stops all workers after their submitted requests have been executed
+    def stop(self):
+        with self._lock:
+            workers = self._workers.values()
+            self._workers = {}
+        for worker in workers:
+            worker.stop()
+
+
+    ## Returns the worker of a floor, starts it if needed
+    #
+    #  \param path \b String, one of paths
+    #  \return     \b BimiWorker
+    #
+    def worker(self, path):
+        with self._lock:
+            if path not in self._workers:
+                failed = None
+                if self._failed_callback is not None:
+                    failed = lambda: self._failed_callback(path)
+                worker = BimiWorker(lambda: self._open_db(path), self._idle_add,
+                                    self._busy if self._busy_callback is not None else None, failed)
+                worker.start()
+                self._workers[path] = worker
+            return self._workers[path]
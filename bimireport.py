@@ -0,0 +1,153 @@
+# vim: set fileencoding=utf-8
+# ----------------------------------------------------------------------------#
+#    Copyright 2012 Julian Weitz                                              #
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    any later version.                                                       #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.    #
+# ----------------------------------------------------------------------------#
+import csv
+from bimiconfig import BimiConfig
+
+
+## Generates the sales reports from BimiBase.salesReport()
+#
+#  revenue   revenue, purchase cost and margin of all drinks per period
+#  drinks    units, revenue and margin per product and period
+#  accounts  units and spent money per account and period
+#  balances  current balance of every account minus the deposit like in the
+#            GUI and the mails, the periods don't matter
+#
+#  floorRows() computes a report for several data bases, one per floor.
+#  The sums of all floors are shown per period and drink, accounts are
+#  listed per floor.
+#
+#  rows = BimiReport.rows(db, 'drinks', 'year', first='2024')
+#  BimiReport.write(sys.stdout, rows)
+#
+class BimiReport:
+    ## Maps report names to the group passed to BimiBase.salesReport() and the columns
+    reports = {'revenue': (None, ['period', 'units', 'revenue', 'cost', 'margin']),
+               'drinks': ('drink', ['period', 'drink', 'units', 'revenue', 'cost', 'margin']),
+               'accounts': ('account', ['period', 'account', 'units', 'spent']),
+               'balances': (None, ['account', 'balance'])}
+
+
+    ## Returns the rows of a report in cents, runs in the worker threads of floorRows()
+    #
+    #  \return \b List of tuples (period, name, units, revenue, cost) like BimiBase.salesReport(),
+    #             or (name, balance) for the balances report
+    #
+    @staticmethod
+    def _data(db, report, period, first, last):
+        if report == 'balances':
+            return [(name, balance) for aid, name, balance in db.accountBalances()]
+        return db.salesReport(period, BimiReport.reports[report][0], first, last)
+
+
+    ## Returns the rows of a report for several floors including the header
+    #
+    #  The data bases are queried in parallel by the workers of pool. The
+    #  sales of all floors are summed up in cents before they are converted,
+    #  the accounts and balances reports get a floor column.
+    #
+    #  \param pool \b BimiPool containing the data bases of the floors
+    #  \return     \b List of tuples like rows()
+    #
+    @staticmethod
+    def floorRows(pool, report, period='month', first=None, last=None):
+        results = pool.map(BimiReport._data, [report, period, first, last])
+        if report in ['revenue', 'drinks']:
+            sums = {}
+            for path, sales in results:
+                for row in sales:
+                    # Keyed by period and drink name, the ids differ between the floors
+                    item = sums.setdefault(row[:2], [0, 0, 0])
+                    for i in range(3):
+                        item[i] += row[2 + i]
+            data = sorted([key + tuple(item) for key, item in sums.items()])
+            return BimiReport._format(report, data)
+
+        data = []
+        for path, rows in results:
+            data.extend([(pool.name(path).decode('utf-8'),) + row for row in rows])
+        if report == 'accounts':
+            # Stable, so the floors stay in the order of the pool within a period
+            data.sort(key=lambda row: row[1])
+        return BimiReport._format(report, data, True)
+
+
+    ## Converts rows returned by _data() to the rows of a report
+    #
+    #  \param floors \b Bool, True if every row starts with the name of its floor
+    #
+    @staticmethod
+    def _format(report, data, floors=False):
+        group, columns = BimiReport.reports[report]
+        if report == 'balances':
+            deposit = BimiConfig.settings().deposit
+            rows = [row[:-1] + (row[-1]/100.0 - deposit,) for row in data]
+        elif report == 'revenue':
+            rows = [(period, units, revenue/100.0, cost/100.0, (revenue - cost)/100.0)
+                    for period, name, units, revenue, cost in data]
+        elif report == 'drinks':
+            rows = [(period, name, units, revenue/100.0, cost/100.0, (revenue - cost)/100.0)
+                    for period, name, units, revenue, cost in data]
+        elif floors:
+            rows = [(period, floor, name, units, revenue/100.0) for floor, period, name, units, revenue, cost in data]
+        else:
+            rows = [(period, name, units, revenue/100.0) for period, name, units, revenue, cost in data]
+        if floors:
+            columns = columns[:columns.index('account')] + ['floor'] + columns[columns.index('account'):]
+        return [tuple(columns)] + rows
+
+
+    ## Returns the rows of a report including the header
+    #
+    #  \param db     \b BimiBase the sales are read from
+    #  \param report \b String, a key of reports
+    #  \param period \b String, 'month' or 'year'
+    #  \param first  \b String 'YYYY' or 'YYYY-MM' of the first period, None for the oldest
+    #  \param last   \b String 'YYYY' or 'YYYY-MM' of the last period, None for the newest
+    #  \return       \b List of tuples, the first one containing the column names. Money
+    #                   values are floats in the currency, not in cents.
+    #
+    @staticmethod
+    def rows(db, report, period='month', first=None, last=None):
+        return BimiReport._format(report, BimiReport._data(db, report, period, first, last))
+
+
+    ## Writes the rows of a report as aligned table or as csv
+    #
+    #  \param output   \b File the report is written to
+    #  \param rows     \b List of tuples returned by rows()
+    #  \param csv_file \b Bool, if True the rows are written as csv without currency symbols
+    #
+    @staticmethod
+    def write(output, rows, csv_file=False):
+        if csv_file:
+            writer = csv.writer(output)
+            for row in rows:
+                writer.writerow([value.encode('utf-8') if isinstance(value, unicode) else value for value in row])
+            return
+
+        currency = BimiConfig.settings().currency
+        cells = [[unicode(value) for value in rows[0]]]
+        for row in rows[1:]:
+            cells.append([u'{0:.2f}{1}'.format(value, currency) if isinstance(value, float) else
+                          unicode(value) if value is not None else u'-' for value in row])
+        widths = [max([len(row[i]) for row in cells]) for i in range(len(cells[0]))]
+        numeric = [len(rows) > 1 and isinstance(rows[1][i], (int, long, float)) for i in range(len(cells[0]))]
+        for row in cells:
+            line = u'  '.join([cell.rjust(widths[i]) if numeric[i] else cell.ljust(widths[i])
+                               for i, cell in enumerate(row)])
+            output.write(line.rstrip().encode('utf-8') + '\n')
@@ -0,0 +1,330 @@
+# vim: set fileencoding=utf-8
+# ----------------------------------------------------------------------------#
+#    Copyright 2012 Julian Weitz                                              #
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    any later version.                                                       #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.    #
+# ----------------------------------------------------------------------------#
+import sys, time, logging, datetime, threading
+from collections import deque
+
+
+## Counters of one BimiBase method
+class _MethodStats:
+    def __init__(self, num_samples):
+        self.calls = 0
+        self.seconds = 0.0
+        self.statements = 0
+        self.rows = 0
+        self.commit_seconds = 0.0                  ##< Time spent in COMMIT, i.e. mostly waiting for fsync
+        self.durations = deque(maxlen=num_samples) ##< Durations of the most recent calls
+
+
+## A statement which may still have rows to be fetched
+class _Statement:
+    def __init__(self, sql, params, shape, method, depth):
+        self.sql = sql
+        self.params = params ##< Parameters of the statement or of the first row of executemany
+        self.shape = shape   ##< String like '3' for three parameters or '100x3' for executemany
+        self.method = method
+        self.depth = depth   ##< Length of the method stack when the statement was executed
+        self.seconds = 0.0
+        self.rows = 0
+        self.finished = False
+
+
+## Cursor proxy which times every statement until its last row has been fetched
+class _StatsCursor(object):
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+        self._statement = None ##< _Statement executed last, None once it has been recorded
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        cursor = iter(self._cursor)
+        while True:
+            start = time.time()
+            try:
+                row = next(cursor)
+            except StopIteration:
+                self._fetched(start, 0)
+                self._finish()
+                return
+            self._fetched(start, 1)
+            yield row
+
+    def _fetched(self, start, num_rows):
+        if self._statement is not None:
+            self._statement.seconds += time.time() - start
+            self._statement.rows += num_rows
+
+    def _finish(self):
+        if self._statement is not None:
+            self._stats._finish(self._statement)
+            self._statement = None
+
+    def close(self):
+        self._finish()
+        self._cursor.close()
+
+    def execute(self, sql, params=()):
+        self._finish()
+        start = time.time()
+        self._cursor.execute(sql, params)
+        self._statement = self._stats._begin(sql, params, str(len(params)), time.time() - start)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self._finish()
+        if isinstance(seq_of_params, (list, tuple)):
+            first = seq_of_params[0] if seq_of_params else ()
+            shape = '{0}x{1}'.format(len(seq_of_params), len(first))
+        else:
+            first = None
+            shape = '?'
+        start = time.time()
+        self._cursor.executemany(sql, seq_of_params)
+        self._statement = self._stats._begin(sql, first, shape, time.time() - start)
+        self._finish()
+        return self
+
+    def fetchall(self):
+        start = time.time()
+        rows = self._cursor.fetchall()
+        self._fetched(start, len(rows))
+        self._finish()
+        return rows
+
+    def fetchmany(self, *args):
+        start = time.time()
+        rows = self._cursor.fetchmany(*args)
+        self._fetched(start, len(rows))
+        return rows
+
+    def fetchone(self):
+        start = time.time()
+        row = self._cursor.fetchone()
+        self._fetched(start, 0 if row is None else 1)
+        return row
+
+
+## Connection proxy which hands out _StatsCursors and times commits
+class _StatsConnection(object):
+    def __init__(self, connection, stats):
+        object.__setattr__(self, '_connection', connection)
+        object.__setattr__(self, '_stats', stats)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._connection, name, value)
+
+    def commit(self):
+        start = time.time()
+        self._connection.commit()
+        self._stats._finish(self._stats._begin('COMMIT', (), '0', time.time() - start))
+
+    def cursor(self):
+        return _StatsCursor(self._connection.cursor(), self._stats)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+
+## Records the statements executed by BimiBase
+#
+#  Pass a BimiStats to BimiBase and every statement gets timed from
+#  execute() until its last row has been fetched, because SQLite runs a
+#  query while its rows are fetched. Statements are counted for the
+#  public BimiBase method executing them, commits show up as COMMIT.
+#  One BimiStats can be shared by BimiBase instances in several threads.
+#
+#  Statements taking at least slow_ms milliseconds are appended to the
+#  slow query log, or logged as warnings if there is no log file.
+#
+#  stats = BimiStats(slow_ms=100)
+#  db = BimiBase(path, stats=stats)
+#  db.consumeDrinks(1, [(2, 1)])
+#  print(stats.report())
+#
+class BimiStats:
+    _num_samples = 4096 ##< Number of the most recent calls of a method used for the percentiles
+
+    ## Creates an empty record
+    #
+    #  \param slow_ms       \b Integer milliseconds a statement has to take to get into the
+    #                          slow query log, or None
+    #  \param slow_log_path \b String containing the path of the slow query log, or None
+    #
+    def __init__(self, slow_ms=None, slow_log_path=None):
+        self._logger = logging.getLogger('BimiStats')
+        self.slow_ms = slow_ms
+        self.slow_log_path = slow_log_path
+        self._lock = threading.Lock()   ##< Protects _methods, _statements and the slow query log
+        self._local = threading.local() ##< Per thread: methods, stack of running BimiBase methods
+        self._methods = {}              ##< Maps method names to _MethodStats
+        self._statements = {}           ##< Maps SQL to lists [count, seconds, rows, params of the last execution]
+
+
+    ## Starts recording a statement
+    def _begin(self, sql, params, shape, seconds):
+        methods = self._methodStack()
+        if methods:
+            method = methods[-1]
+        else:
+            # Not called by a public method, e.g. a migration, use the name of the calling method
+            method = sys._getframe(2).f_code.co_name
+        statement = _Statement(' '.join(sql.split()), params, shape, method, len(methods))
+        statement.seconds = seconds
+        self._local.pending.append(statement)
+        return statement
+
+
+    ## Records a call of a BimiBase method, see BimiBase._recordStats()
+    #
+    #  \param method \b Function called as method(*args, **kwargs)
+    #  \return       \b Return value of method
+    #
+    def call(self, method, args, kwargs):
+        methods = self._methodStack()
+        methods.append(method.__name__)
+        start = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            seconds = time.time() - start
+            methods.pop()
+            # Statements whose rows haven't all been fetched end with their method
+            for statement in [statement for statement in self._local.pending if statement.depth > len(methods)]:
+                self._finish(statement)
+            with self._lock:
+                stats = self._methodStats(method.__name__)
+                stats.calls += 1
+                stats.seconds += seconds
+                stats.durations.append(seconds)
+
+
+    ## Wraps a sqlite3 connection, so all its statements get recorded
+    #
+    #  \param connection \b sqlite3.Connection
+    #  \return           \b Proxy of connection
+    #
+    def connection(self, connection):
+        return _StatsConnection(connection, self)
+
+
+    ## Returns EXPLAIN QUERY PLAN of every statement recorded so far
+    #
+    #  The statements are explained with the parameters of their last
+    #  execution. db must not record into this BimiStats.
+    #
+    #  \param db \b BimiBase, e.g. opened read-only
+    #  \return   \b String containing the statements and their plans
+    #
+    def explain(self, db):
+        with self._lock:
+            statements = sorted([(sql, item[3]) for sql, item in self._statements.items()])
+        lines = []
+        for sql, params in statements:
+            if sql.split(' ', 1)[0].upper() not in ['SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH']:
+                continue
+            lines.append(sql)
+            if params is None:
+                params = [None]*sql.count('?')
+            for detail in db.explain(sql, params):
+                lines.append('    ' + detail)
+        return '\n'.join(lines)
+
+
+    ## Records a statement once it is done, writes it to the slow query log if needed
+    def _finish(self, statement):
+        if statement.finished:
+            return
+        statement.finished = True
+        self._local.pending.remove(statement)
+        with self._lock:
+            stats = self._methodStats(statement.method)
+            stats.statements += 1
+            stats.rows += statement.rows
+            if statement.sql.upper().startswith('COMMIT'):
+                stats.commit_seconds += statement.seconds
+            item = self._statements.setdefault(statement.sql, [0, 0.0, 0, None])
+            item[0] += 1
+            item[1] += statement.seconds
+            item[2] += statement.rows
+            item[3] = statement.params
+            if self.slow_ms is not None and statement.seconds*1000 >= self.slow_ms:
+                self._logSlow(statement)
+
+
+    ## Writes a statement to the slow query log, must be called holding _lock
+    def _logSlow(self, statement):
+        line = u'{0} {1:.1f}ms {2} rows={3} params={4} {5}'.format(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                                                                  statement.seconds*1000, statement.method,
+                                                                  statement.rows, statement.shape, statement.sql)
+        if self.slow_log_path is None:
+            self._logger.warning('Slow query: %s', line)
+            return
+        try:
+            with open(self.slow_log_path, 'a') as log_file:
+                log_file.write(line.encode('utf-8') + '\n')
+        except IOError as err:
+            self._logger.error('Writing the slow query log %s failed! [io: %s]', self.slow_log_path, err)
+            self.slow_log_path = None
+            self._logger.warning('Slow query: %s', line)
+
+
+    ## Returns the stack of BimiBase methods running in the current thread
+    def _methodStack(self):
+        if not hasattr(self._local, 'methods'):
+            self._local.methods = []
+            self._local.pending = [] ##< _Statements which haven't been recorded yet
+        return self._local.methods
+
+
+    ## Returns the _MethodStats of a method, must be called holding _lock
+    def _methodStats(self, name):
+        if name not in self._methods:
+            self._methods[name] = _MethodStats(self._num_samples)
+        return self._methods[name]
+
+
+    ## Returns the per method counters and the most expensive statements as a table
+    #
+    #  \param num_statements \b Integer number of statements listed, ordered by total time
+    #  \return               \b String
+    #
+    def report(self, num_statements=10):
+        lines = ['{0:<20} {1:>7} {2:>9} {3:>9} {4:>9} {5:>10} {6:>10} {7:>10}'.format(
+                 'method', 'calls', 'p50 ms', 'p99 ms', 'total ms', 'statements', 'rows', 'commit ms')]
+        with self._lock:
+            for name, stats in sorted(self._methods.items(), key=lambda item: -item[1].seconds):
+                durations = sorted(stats.durations)
+                if durations:
+                    p50 = '{0:.2f}'.format(durations[int(round(0.50*(len(durations) - 1)))]*1000)
+                    p99 = '{0:.2f}'.format(durations[int(round(0.99*(len(durations) - 1)))]*1000)
+                else:
+                    p50 = p99 = '-'
+                lines.append('{0:<20} {1:>7} {2:>9} {3:>9} {4:>9.1f} {5:>10} {6:>10} {7:>10.1f}'.format(
+                             name, stats.calls, p50, p99, stats.seconds*1000, stats.statements, stats.rows,
+                             stats.commit_seconds*1000))
+            statements = sorted(self._statements.items(), key=lambda item: -item[1][1])[:num_statements]
+        lines.append('')
+        lines.append('{0:>9} {1:>7} {2:>10}  {3}'.format('total ms', 'count', 'rows', 'statement'))
+        for sql, item in statements:
+            lines.append('{0:>9.1f} {1:>7} {2:>10}  {3}'.format(item[1]*1000, item[0], item[2], sql[:100]))
+        return '\n'.join(lines)
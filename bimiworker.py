@@ -0,0 +1,171 @@
+# vim: set fileencoding=utf-8
+# ----------------------------------------------------------------------------#
+#    Copyright 2012 Julian Weitz                                              #
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    any later version.                                                       #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.    #
+# ----------------------------------------------------------------------------#
+import logging, threading
+from Queue import Queue
+
+
+## A request waiting in the queue of BimiWorker
+class _Request:
+    def __init__(self, func, args, callback, key):
+        self.func = func
+        self.args = args
+        self.callback = callback
+        self.key = key
+        self.cancelled = False         ##< True if a newer request with the same key replaced this one
+        self.done = threading.Event()  ##< Set once the request has been executed, cancelled or dropped
+        self.result = None             ##< Return value of func
+        self.error = None              ##< Exception raised by func, or IOError if the data base isn't open
+
+
+## Thread which owns the BimiBase and runs all data base requests of the GUI
+#
+#  Requests are executed one after another in the order they were
+#  submitted, so a reload submitted after a write sees the write. Results
+#  are passed to the callbacks in the thread running the GLib main loop
+#  via idle_add, i.e. callbacks may use GTK.
+#
+#  worker = BimiWorker(openDataBase, GLib.idle_add)
+#  worker.start()
+#  worker.submit(BimiBase.consumeDrinks, [aid, [(did, 2)]])
+#  worker.submit(BimiBase.accounts, [], showAccounts, key='accounts')
+#
+class BimiWorker(threading.Thread):
+    ## Creates the worker, the data base is opened by start()
+    #
+    #  \param open_db         \b Function returning a BimiBase, called in the worker thread,
+    #                            because a sqlite3 connection can only be used by the
+    #                            thread which created it
+    #  \param idle_add        \b Function like GLib.idle_add(function, *args)
+    #  \param busy_callback   \b Function called with True when the first request is submitted
+    #                            and with False when no request is left, or None
+    #  \param failed_callback \b Function called without arguments if open_db fails, or None
+    #
+    def __init__(self, open_db, idle_add, busy_callback=None, failed_callback=None):
+        threading.Thread.__init__(self, name='BimiWorker')
+        self.daemon = True
+        self._logger = logging.getLogger('BimiWorker')
+        self._open_db = open_db
+        self._idle_add = idle_add
+        self._busy_callback = busy_callback
+        self._failed_callback = failed_callback
+        self._queue = Queue()
+        self._lock = threading.Lock() ##< Protects _keys and _num_requests
+        self._keys = {}               ##< Maps keys to the last queued _Request with that key
+        self._num_requests = 0        ##< Number of submitted requests which haven't finished yet
+
+
+    ## Calls callback with args and returns False, so idle_add calls it once
+    @staticmethod
+    def _call(callback, *args):
+        callback(*args)
+        return False
+
+
+    ## Counts a request as finished and reports if the worker became idle
+    def _finished(self):
+        with self._lock:
+            self._num_requests -= 1
+            if self._num_requests == 0 and self._busy_callback is not None:
+                self._idle_add(self._call, self._busy_callback, False)
+
+
+    ## Runs the requests until stop() is called
+    def run(self):
+        try:
+            db = self._open_db()
+        except (Exception, SystemExit) as err:
+            self._logger.critical('Opening the data base failed! [err: %s]', err)
+            db = None
+            if self._failed_callback is not None:
+                self._idle_add(self._call, self._failed_callback)
+
+        while True:
+            request = self._queue.get()
+            if request is None:
+                break
+            with self._lock:
+                if request.key is not None and self._keys.get(request.key) is request:
+                    del self._keys[request.key]
+            if not request.cancelled and db is not None:
+                try:
+                    request.result = request.func(db, *request.args)
+                    if request.callback is not None:
+                        self._idle_add(self._call, request.callback, request.result)
+                except Exception as err:
+                    request.error = err
+                    self._logger.error('%s failed! [err: %s]', getattr(request.func, '__name__', request.func), err)
+            elif db is None:
+                request.error = IOError('The data base could not be opened.')
+            request.done.set()
+            self._finished()
+
+
+    ## Stops the worker after all submitted requests have been executed
+    #
+    #  Blocks until the worker thread has finished, i.e. writes which are
+    #  still queued don't get lost.
+    #
+    def stop(self):
+        if self.is_alive():
+            self._queue.put(None)
+            self.join()
+
+
+    ## Queues a request
+    #
+    #  If key is given and a request with the same key is still queued, that
+    #  one is dropped. E.g. several reloads of a view requested while the
+    #  worker is busy with a write end up as one reload after the write.
+    #
+    #  \param func     \b Function called as func(db, *args) in the worker thread,
+    #                     e.g. an unbound method of BimiBase
+    #  \param args     \b List of further arguments of func
+    #  \param callback \b Function called with the return value of func in the GLib main loop, or None
+    #  \param key      \b Hashable identifying requests which can be coalesced, or None
+    #  \return         \b Request which can be passed to wait()
+    #
+    def submit(self, func, args=[], callback=None, key=None):
+        request = _Request(func, list(args), callback, key)
+        with self._lock:
+            if key is not None:
+                if key in self._keys:
+                    self._keys[key].cancelled = True
+                self._keys[key] = request
+            self._num_requests += 1
+            # Posted while holding the lock, so busy and idle notifications can't overtake each other
+            if self._num_requests == 1 and self._busy_callback is not None:
+                self._idle_add(self._call, self._busy_callback, True)
+        self._queue.put(request)
+        return request
+
+
+    ## Waits until a request returned by submit() has been executed
+    #
+    #  Must not be called by the worker thread. Raises the exception raised
+    #  by func, or IOError if the data base couldn't be opened. Returns None
+    #  if the request has been replaced by a newer one with the same key.
+    #
+    #  \param request \b Request returned by submit()
+    #  \return        \b Return value of func
+    #
+    @staticmethod
+    def wait(request):
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result